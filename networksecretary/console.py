@@ -0,0 +1,67 @@
+"""An IPython kernel running inside the daemon, for ``nsctl console``.
+
+IPython and pyzmq are only imported when the console is started: they are
+big, slow to import and start several threads, none of which a daemon that
+nobody is debugging needs.
+"""
+
+import sys, os
+import asyncio
+from .util import *
+
+import logging
+logger = logging.getLogger(__name__)
+
+CONNECTION_FILE = RUNDIR / 'ipython.json'
+
+# XXX IPython infests this application with threads!! I'm not sure why.
+#     I'm not even sure in which one the interactive commands are executed.
+# TODO Try to get rid of that.
+class IPythonEmbed:
+    """`ns` is the namespace of the console, `module` the module it pretends
+    to run in."""
+    def __init__(self, ns, module):
+        self.ns = ns
+        self.module = module
+        self.app = None
+        self.connection_file = str(CONNECTION_FILE)
+
+    def start(self):
+        """Start the kernel. Raises ImportError if IPython or pyzmq is missing."""
+        from IPython.kernel.zmq.kernelapp import IPKernelApp
+        import zmq
+
+        self.app = IPKernelApp(transport='ipc')
+        NOP = lambda *a,**kw: None
+        # Don't exit upon parent process exit
+        self.app.init_poller = NOP
+        # Don't redirect stdio
+        self.app.init_io = NOP
+        self.app.init_blackhole = NOP
+        # Don't catch SIGINT
+        self.app.init_signal = NOP
+        self.app.init_connection_file = NOP
+        self.app.log_connection_info = NOP
+
+        self.app.connection_file = self.connection_file
+
+        # Make sure only root can access the sockets and the connection file
+        with umask_ctx(0o077):
+            try: os.unlink(self.app.connection_file)
+            except FileNotFoundError: pass
+            self.app.initialize()
+
+        self.app.kernel.user_module = self.module
+        self.app.kernel.user_ns = self.ns
+        self.app.shell.set_completer_frame()
+
+        self.app.kernel.start()
+
+        for stream in self.app.kernel.shell_streams:
+            fd = stream.socket.getsockopt(zmq.FD)
+            def callback(stream):
+                stream.flush(zmq.POLLIN, 1)
+                stream.flush(zmq.POLLOUT)
+            asyncio.get_event_loop().add_reader(fd, callback, stream)
+    # That wasn't so hard, right? Why do the IPython developers keep on recommending
+    # regular polling as the way of integrating an IPython kernel with a mainloop then?
@@ -0,0 +1,468 @@
+"""The control protocol spoken on ``RUNDIR/ctl.sock``.
+
+Every message is one line of JSON. A request is an object with a ``cmd`` and
+its arguments, optionally with an ``id`` that is copied to the response. A
+line may also hold a JSON array of requests, which are executed in order and
+answered with one array of responses. Responses are ``{"id": ..., "ok": true,
+"result": ...}`` or ``{"id": ..., "ok": false, "error": "..."}``.
+
+Commands:
+
+``get``, path, [depth=0]
+    The value at `path`, e.g. ``ns.ifaces.wlan0.netid``. Objects nested more
+    than `depth` levels deep are returned as their ``repr``. If the path
+    contains ``*``, a ``{path: value}`` dict of all matches.
+``dump``, [path='ns'], [depth=3]
+    Like ``get``, with a default suitable for looking at the whole state.
+``set``, path, value | expr, [prio=1000]
+    Add a value for an attribute to the rulebook context, with the given
+    priority. `expr` is a Python literal (parsed with `ast.literal_eval`), for
+    values JSON cannot express, like sets.
+``unset``, path
+    Remove the value added by ``set``.
+``subscribe``, path, [depth=0], [interval]
+    Send ``{"event": "change", "sub": <id>, "path": ..., "value": ...}`` with
+    the current value of every path matching `path` and then every time one
+    of them changes (a path that disappears is sent once with a null value).
+    Changes are coalesced: the paths are re-read at most once per `interval`
+    seconds and only the latest value is sent.
+``unsubscribe``, sub
+    Cancel a subscription.
+
+The daemon can add more commands, see `CtlServer`.
+
+Paths are dot-separated attribute names or item keys starting at the rulebook
+namespace (i.e. ``ns``), or at ``netns`` for the NetworkStates of other network
+namespaces; names starting with ``_`` are not accessible. A ``*``
+component matches all items of a container (interfaces by name, ESSes by
+ESSID, dict keys), e.g. ``ns.ifaces.*.dhcp_client_obj.lease``.
+
+Change events a client does not read fast enough are queued per connection,
+where newer values of a path replace older ones. If more than
+`Connection.max_pending` paths are waiting, the queue is dropped, an
+``{"event": "overflow", "dropped": <n>}`` marker is sent and then the
+current values of everything subscribed, as after ``subscribe``. (The queue
+always has room for one value of each subscribed path.)
+"""
+
+import os
+import ast
+import json
+import asyncio
+import weakref
+import inspect
+from collections import OrderedDict
+from pathlib import PurePath
+
+from rulebook.abider import RuleAbider
+
+from .util import *
+from .libnetconf import change_listeners
+
+import logging
+logger = logging.getLogger(__name__)
+
+VAL_ID = 'nsctl'
+DEFAULT_PRIO = 1000
+
+
+class CtlError(Exception):
+    pass
+
+
+def parse_path(path):
+    if isinstance(path, str):
+        path = path.split('.')
+    if not isinstance(path, list) or not path or not all(isinstance(p, str) and p for p in path):
+        raise CtlError('Invalid path: %r' % (path,))
+    for p in path:
+        if p.startswith('_'):
+            raise CtlError('Private name in path: %s' % p)
+    return path
+
+def check_arg(name, value, *types):
+    """Raise CtlError unless `value` is an instance of one of `types` (a bool
+    only counts as a bool, not as an int)."""
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        raise CtlError('Invalid %s: %r' % (name, value))
+    return value
+
+def _step(obj, name):
+    if isinstance(obj, dict):
+        try: return obj[name]
+        except KeyError: raise CtlError('No such item: %s' % name)
+    try:
+        return getattr(obj, name)
+    except AttributeError:
+        pass
+    try:
+        return obj[name]
+    except (KeyError, IndexError, TypeError):
+        raise CtlError('No such attribute or item: %s' % name)
+
+def resolve(roots, path, visited=None):
+    """Return the object at `path`. The ids of all objects on the way (the
+    value included) are added to `visited`, if given."""
+    path = parse_path(path)
+    try:
+        obj = roots[path[0]]
+    except KeyError:
+        raise CtlError('Unknown name: %s' % path[0])
+    if visited is not None: visited.add(id(obj))
+    for name in path[1:]:
+        obj = _step(obj, name)
+        if visited is not None: visited.add(id(obj))
+    return obj
+
+#: Attributes that name the items of containers (like InterfaceList) for ``*``.
+CHILD_KEYS = ('name', 'essid', 'netns')
+
+def _children(obj):
+    if isinstance(obj, dict):
+        return [ (str(k), v) for k, v in obj.items() ]
+    if isinstance(obj, (str, bytes)) or not hasattr(obj, '__iter__'):
+        raise CtlError('Cannot match * in %r' % (obj,))
+    ret = []
+    for item in obj:
+        for attr in CHILD_KEYS:
+            key = getattr(item, attr, None)
+            if isinstance(key, str):
+                ret.append((key, item))
+                break
+    return ret
+
+def resolve_all(roots, path, visited=None):
+    """Like `resolve`, but `path` may contain ``*``. Returns a list of
+    ``(path, object)`` for all matches, without the ones that do not exist."""
+    path = parse_path(path)
+    if path[0] not in roots:
+        raise CtlError('Unknown name: %s' % path[0])
+    found = [ ([path[0]], roots[path[0]]) ]
+    if visited is not None: visited.add(id(roots[path[0]]))
+    for name in path[1:]:
+        next = []
+        for prefix, obj in found:
+            if name == '*':
+                children = _children(obj)
+            else:
+                try: children = [ (name, _step(obj, name)) ]
+                except CtlError: continue
+            for key, child in children:
+                if visited is not None: visited.add(id(child))
+                next.append((prefix + [key], child))
+        found = next
+    return found
+
+def _public_attrs(obj):
+    names = set()
+    for cls in reversed(type(obj).__mro__):
+        names.update(k for k, v in vars(cls).items()
+                     if not k.startswith('_') and not callable(v)
+                     and not isinstance(v, (property, classmethod, staticmethod)))
+    names.update(k for k in getattr(obj, '__dict__', {}) if not k.startswith('_'))
+    return sorted(names)
+
+def to_json(obj, depth=0, visited=None):
+    """Convert `obj` to something `json.dumps` accepts. The ids of all objects
+    converted are added to `visited`, if given."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if visited is not None: visited.add(id(obj))
+    if isinstance(obj, PurePath):
+        return str(obj)
+    if isinstance(obj, dict):
+        return { str(k): to_json(v, depth - 1, visited) for k, v in obj.items() }
+    if isinstance(obj, (set, frozenset)):
+        items = [ to_json(v, depth - 1, visited) for v in obj ]
+        try: return sorted(items)
+        except TypeError: return items
+    if isinstance(obj, (list, tuple)):
+        return [ to_json(v, depth - 1, visited) for v in obj ]
+    if depth <= 0 or isinstance(obj, weakref.ref):
+        return repr(obj)
+    if hasattr(obj, '__iter__'):
+        # Containers like InterfaceList and EssList
+        return [ to_json(v, depth - 1, visited) for v in obj ]
+    ret = {}
+    for name in _public_attrs(obj):
+        try: value = getattr(obj, name)
+        except Exception: continue
+        if callable(value) and not isinstance(value, RuleAbider): continue
+        ret[name] = to_json(value, depth - 1, visited)
+    return ret
+
+def _loads(data):
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise CtlError('Malformed request: %s' % e)
+
+
+class Subscription:
+    """Watches one path pattern for a connection. After a change notification
+    for any object on the way to a match (which includes the containers ``*``
+    iterates over) or within `depth` levels of one, the pattern is resolved
+    again and the paths whose values differ from the last ones sent are queued
+    to the connection."""
+    #: Re-read the paths at most this often (seconds).
+    interval = 0.05
+
+    def __init__(self, conn, id, path, depth=0, interval=None):
+        self.conn = conn
+        self.id = id
+        self.path = parse_path(path)
+        self.depth = depth
+        if interval is not None: self.interval = interval
+        self._visited = set()
+        self._last = {}
+        self._handle = None
+        self._next = 0
+
+    def evaluate(self):
+        self._handle = None
+        if self.conn.subs.get(self.id) is not self: return
+        self._next = asyncio.get_event_loop().time() + self.interval
+        visited = set()
+        try:
+            found = resolve_all(self.conn.server.roots, self.path, visited)
+        except CtlError:
+            found = []
+        current = { '.'.join(path): to_json(obj, self.depth, visited) for path, obj in found }
+        self._visited = visited
+        last, self._last = self._last, current
+        changed = [ (path, value) for path, value in current.items()
+                    if path not in last or last[path] != value ]
+        changed += [ (path, None) for path in last.keys() - current.keys() ]
+        for path, value in changed:
+            self.conn.queue_event(self, path, value)
+
+    def forget(self):
+        """Forget what was sent, so that the next evaluation sends everything."""
+        self._last = {}
+        self.cancel()
+
+    def schedule(self):
+        if self._handle is not None: return
+        loop = asyncio.get_event_loop()
+        delay = self._next - loop.time()
+        if delay > 0: self._handle = loop.call_later(delay, self.evaluate)
+        else: self._handle = loop.call_soon(self.evaluate)
+
+    def notify(self, obj, key):
+        if id(obj) in self._visited:
+            self.schedule()
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class Connection:
+    #: The maximum number of paths with a change waiting to be sent.
+    max_pending = 1000
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.subs = {}
+        self._sub_ids = 0
+        self._pending = OrderedDict()
+        self._overflow = 0
+        self._wakeup = asyncio.Event()
+        self.stats = dict(events=0, coalesced=0, dropped=0, overflows=0)
+
+    def send(self, msg):
+        if self.writer is None: return
+        self.writer.write(json.dumps(msg).encode('utf-8') + b'\n')
+
+    def _notify(self, obj, key):
+        for sub in self.subs.values():
+            sub.notify(obj, key)
+
+    def queue_event(self, sub, path, value):
+        key = (sub.id, path)
+        if key in self._pending:
+            self.stats['coalesced'] += 1
+            del self._pending[key]
+        elif (len(self._pending) >= self.max_pending
+                # There must always be room for one value of every path.
+                and len(self._pending) >= sum(len(s._last) for s in self.subs.values())):
+            self.stats['overflows'] += 1
+            self.stats['dropped'] += len(self._pending) + 1
+            self._overflow += len(self._pending) + 1
+            self._pending.clear()
+            for s in self.subs.values(): s.forget()
+            self._wakeup.set()
+            return
+        self._pending[key] = {'event': 'change', 'sub': sub.id, 'path': path, 'value': value}
+        self._wakeup.set()
+
+    @asyncio.coroutine
+    def _event_writer(self):
+        """Write out queued events as fast as the client reads them."""
+        while self.writer is not None:
+            yield from self._wakeup.wait()
+            self._wakeup.clear()
+            if self._overflow:
+                self.send({'event': 'overflow', 'dropped': self._overflow})
+                self._overflow = 0
+                yield from self.writer.drain()
+                for sub in self.subs.values(): sub.schedule()
+            while self._pending and self.writer is not None:
+                key, msg = self._pending.popitem(last=False)
+                self.send(msg)
+                self.stats['events'] += 1
+                yield from self.writer.drain()
+
+    @asyncio.coroutine
+    def serve(self):
+        event_writer = asyncio.Task(self._event_writer())
+        try:
+            while True:
+                line = yield from self.reader.readline()
+                if not line: break
+                if not line.strip(): continue
+                try:
+                    req = _loads(line)
+                except CtlError as e:
+                    self.send({'id': None, 'ok': False, 'error': str(e)})
+                    continue
+                if isinstance(req, list):
+                    self.send([ self.handle(r) for r in req ])
+                else:
+                    self.send(self.handle(req))
+                yield from self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            change_listeners.discard(self._notify)
+            for sub in self.subs.values(): sub.cancel()
+            self.subs = {}
+            event_writer.cancel()
+            self.writer.close()
+            self.writer = None
+            if self._sub_ids:
+                logger.debug('Control connection closed, subscription stats: %r', self.stats)
+
+    def handle(self, req):
+        id = req.get('id') if isinstance(req, dict) else None
+        try:
+            if not isinstance(req, dict) or not isinstance(req.get('cmd'), str):
+                raise CtlError('Request must be an object with a "cmd"')
+            func = (getattr(self, 'cmd_' + req['cmd'], None)
+                    or self.server.commands.get(req['cmd']))
+            if func is None:
+                raise CtlError('Unknown command: %s' % req['cmd'])
+            args = { k: v for k, v in req.items() if k not in ('cmd', 'id') }
+            try:
+                inspect.signature(func).bind(**args)
+            except TypeError as e:
+                raise CtlError('Bad arguments for %s: %s' % (req['cmd'], e))
+            result = func(**args)
+        except CtlError as e:
+            return {'id': id, 'ok': False, 'error': str(e)}
+        except Exception as e:
+            # A bad request must not take the daemon down with it.
+            logger.exception('CTL request %r failed', req)
+            return {'id': id, 'ok': False, 'error': 'Internal error: %s: %s' % (type(e).__name__, e)}
+        return {'id': id, 'ok': True, 'result': result}
+
+    def cmd_get(self, path, depth=0):
+        check_arg('depth', depth, int)
+        if '*' in parse_path(path):
+            return { '.'.join(p): to_json(obj, depth)
+                     for p, obj in resolve_all(self.server.roots, path) }
+        return to_json(resolve(self.server.roots, path), depth)
+
+    def cmd_dump(self, path='ns', depth=3):
+        return self.cmd_get(path, depth)
+
+    def _target(self, path):
+        path = parse_path(path)
+        if len(path) < 2:
+            raise CtlError('Cannot assign to %s' % path[0])
+        return (resolve(self.server.roots, path[:-1]), 'attr', path[-1])
+
+    def cmd_set(self, path, value=None, expr=None, prio=DEFAULT_PRIO):
+        check_arg('prio', prio, int, float)
+        if expr is not None:
+            check_arg('expr', expr, str)
+            try: value = ast.literal_eval(expr)
+            except (ValueError, SyntaxError) as e:
+                raise CtlError('Invalid literal %r: %s' % (expr, e))
+        target = self._target(path)
+        logger.info('CTL set %s = %r (prio %s)', path, value, prio)
+        self.server.context_for(path).add_value(target, value, prio, VAL_ID)
+
+    def cmd_unset(self, path):
+        target = self._target(path)
+        logger.info('CTL unset %s', path)
+        try:
+            self.server.context_for(path).remove_value(target, VAL_ID)
+        except (KeyError, ValueError):
+            raise CtlError('Not set: %s' % path)
+
+    def cmd_subscribe(self, path, depth=0, interval=None):
+        parse_path(path)
+        check_arg('depth', depth, int)
+        if interval is not None and check_arg('interval', interval, int, float) < 0:
+            raise CtlError('Invalid interval: %r' % interval)
+        self._sub_ids += 1
+        sub = self.subs[self._sub_ids] = Subscription(self, self._sub_ids, path, depth, interval)
+        change_listeners.add(self._notify)
+        # Send the current values after the response.
+        sub.schedule()
+        return sub.id
+
+    def cmd_unsubscribe(self, sub):
+        check_arg('sub', sub, int)
+        s = self.subs.pop(sub, None)
+        if s is None:
+            raise CtlError('No such subscription: %s' % sub)
+        s.cancel()
+        for key in [ k for k in self._pending if k[0] == sub ]:
+            del self._pending[key]
+        if not self.subs:
+            change_listeners.discard(self._notify)
+
+
+class CtlServer:
+    """Serves the control protocol on a UNIX socket. `commands` maps names of
+    additional commands to functions taking the request arguments as keyword
+    arguments; they may raise CtlError.
+
+    With `netns` (a NetnsMap), its NetworkStates are available under
+    ``netns.<name>`` and values for them are set in the rulebook context
+    ``netns_contexts[name]``."""
+    def __init__(self, ns, ctx, commands=None, netns=None, netns_contexts=None):
+        self.roots = {'ns': ns}
+        if netns is not None: self.roots['netns'] = netns
+        self.ctx = ctx
+        self.netns_contexts = netns_contexts or {}
+        self.commands = commands or {}
+        self.server = None
+
+    def context_for(self, path):
+        path = parse_path(path)
+        if path[0] != 'netns': return self.ctx
+        try: return self.netns_contexts[path[1]]
+        except (IndexError, KeyError): raise CtlError('No such network namespace')
+
+    @asyncio.coroutine
+    def start(self, path):
+        path = str(path)
+        try: os.unlink(path)
+        except FileNotFoundError: pass
+        with umask_ctx(0o077):
+            self.server = yield from asyncio.start_unix_server(self._accept, path)
+
+    def _accept(self, reader, writer):
+        logger.debug('New control connection')
+        run_task(Connection(self, reader, writer).serve())
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
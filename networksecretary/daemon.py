@@ -1,11 +1,24 @@
 #!/usr/bin/python
 
+import time
+_import_start = time.monotonic()
+
 import sys, os, argparse
+import hashlib
+import json
+import signal
 import asyncio
 import traceback
+from contextlib import contextmanager
 import rulebook
 from .util import *
-from .libnetconf import NetworkState
+from .libnetconf import NetworkState, PersistentStorage, WPASupplicant, DHCPClient, LinkEventCoalescer, NetnsMap
+from . import storage
+from . import libnetconf
+from . import inotify
+from .ctl import CtlServer, CtlError
+from .netns import NETNS_RUN_DIR, list_netns
+from .supervisor import supervisor
 import rulebook.runtime
 
 import logging
@@ -13,84 +26,271 @@ logger = logging.getLogger(__name__)
 
 logging.basicConfig(level=logging.DEBUG)
 
-try:
-    from IPython.kernel.zmq.kernelapp import IPKernelApp
-    import zmq
-except ImportError:
-    logger.warn("IPython and/or pyzmq not available. Interactive console will not work.")
-    HAVE_IPYTHON = False
-else:
-    HAVE_IPYTHON = True
-
-if HAVE_IPYTHON:
-    # XXX IPython infests this application with threads!! I'm not sure why.
-    #     I'm not even sure in which one the interactive commands are executed.
-    # TODO Try to get rid of that.
-    class IPythonEmbed:
-        def __init__(self, ns):
-            self.ns = ns
-            self.app = IPKernelApp(transport='ipc')
-            NOP = lambda *a,**kw: None
-            # Don't exit upon parent process exit
-            self.app.init_poller = NOP
-            # Don't redirect stdio
-            self.app.init_io = NOP
-            self.app.init_blackhole = NOP
-            # Don't catch SIGINT
-            self.app.init_signal = NOP
-            self.app.init_connection_file = NOP
-            self.app.log_connection_info = NOP
-
-            self.app.connection_file = str(RUNDIR / 'ipython.json')
-
-        def start(self):
-            # Make sure only root can access the sockets and the connection file
-            with umask_ctx(0o077):
-                try: os.unlink(self.app.connection_file)
-                except FileNotFoundError: pass
-                self.app.initialize()
-
-            self.app.kernel.user_module = sys.modules[__name__]
-            self.app.kernel.user_ns = self.ns
-            self.app.shell.set_completer_frame()
-
-            self.app.kernel.start()
-
-            for stream in self.app.kernel.shell_streams:
-                fd = stream.socket.getsockopt(zmq.FD)
-                def callback(stream):
-                    stream.flush(zmq.POLLIN, 1)
-                    stream.flush(zmq.POLLOUT)
-                asyncio.get_event_loop().add_reader(fd, callback, stream)
-    # That wasn't so hard, right? Why do the IPython developers keep on recommending
-    # regular polling as the way of integrating an IPython kernel with a mainloop then?
-
+_import_time = time.monotonic() - _import_start
 
 
 class Daemon:
     def __init__(self):
         self.rulebooks = {}
+        self._rule_hashes = {}
         self.loop = asyncio.get_event_loop()
-        if HAVE_IPYTHON:
-            self.ipython = IPythonEmbed({'daemon': self})
+        self.args = self.arg_parser.parse_args([])
+        self.console = None
+        self.ns = None
+        self.netns = NetnsMap()
+        self.netns_ctx = {}
+        self.netns_rules = {}
+        self._reload_lock = asyncio.Lock()
+        self._shutting_down = False
+        self.startup_times = [('imports', _import_time)]
+
+    @contextmanager
+    def _phase(self, name):
+        """Time one phase of the startup for the report in `initialize`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.startup_times.append((name, time.monotonic() - start))
 
-    # arg_parser = argparse.ArgumentParser()
+    arg_parser = argparse.ArgumentParser()
     # arg_parser.add_argument('-c', nargs=1, dest='config_path', help="Specify alternative configuration directory.")
     # arg_parser.add_argument('-C', action='store_false', dest='want_builtin', default=True,
     #                         help="Do not load builtin rules.")
-    # def parse_cmdline(self, argv):
-    #     args = self.arg_parser.parse_args(argv)
+    arg_parser.add_argument('--storage', choices=sorted(storage.BACKENDS), default='files',
+            help="How to keep persistent data in %s: one JSON file per record (default)"
+                 " or a single append-only log." % DATA_DIR)
+    arg_parser.add_argument('--fsync', choices=storage.FSYNC_POLICIES, default='batch',
+            help="When to fsync persistent data: never, once per written batch (default)"
+                 " or after every file.")
+    arg_parser.add_argument('--flush-delay', type=float, default=2.0, metavar='SECONDS',
+            help="Collect changes to persistent data for this long before writing them out.")
+    arg_parser.add_argument('--dhcp-engine', choices=['native', 'udhcpc'], default='native',
+            help="Use the built-in DHCP client (default) or udhcpc.")
+    arg_parser.add_argument('--wpa-pool', action='store_true',
+            help="Run a single wpa_supplicant for all wireless interfaces.")
+    arg_parser.add_argument('--console', action='store_true',
+            help="Start the IPython console right away. Otherwise it is started on the"
+                 " first ``nsctl console`` or on SIGUSR1.")
+    arg_parser.add_argument('--event-window', type=float, default=0.05, metavar='SECONDS',
+            help="Merge link events and network configuration commits within this time"
+                 " (0 to apply each one immediately).")
+    arg_parser.add_argument('--warm-restart', action='store_true',
+            help="On exit, leave wpa_supplicant running and save the state of the interfaces,"
+                 " so that the next start takes over without disrupting connectivity (e.g."
+                 " for an upgrade). Under systemd, this needs KillMode=process.")
+    arg_parser.add_argument('--netns', action='append', default=[], metavar='NAME',
+            help="Also manage the network namespace NAME (as created by ``ip netns add``),"
+                 " once it exists. May be given more than once.")
+    arg_parser.add_argument('--all-netns', action='store_true',
+            help="Also manage all network namespaces in %s, as they come and go." % NETNS_RUN_DIR)
+    arg_parser.add_argument('--max-helpers', type=int, default=4, metavar='N',
+            help="Run at most N short-lived helper processes (scans, network detection,"
+                 " ``ip`` dumps) at once.")
+    def parse_cmdline(self, argv):
+        self.args = self.arg_parser.parse_args(argv)
+
+    def _rule_files(self, dirs):
+        files = []
+        for dir in dirs:
+            if Path(dir).is_dir():
+                files += sorted(Path(dir).resolve() / file.name for file in Path(dir).glob('*.rbk'))
+        return files
+
+    def _load_rules(self, files, ctx, rulebooks):
+        """Load and activate rulebooks from `files` in `ctx`, adding them to `rulebooks`."""
+        for file in files:
+            rbk = rulebooks[file] = self._load_rbk(file, ctx)
+            if rulebooks is self.rulebooks:
+                self._rule_hashes[file] = self._hash_file(file)
+            rbk.set_active(True)
+
+    def _load_rbk(self, file, ctx):
+        """Load the rulebook in `file` into `ctx`, without activating it."""
+        start = time.monotonic()
+        rbk = rulebook.load(file, ctx)[0]
+        logger.info("Loaded rulebook %s in %.1f ms", file, (time.monotonic() - start) * 1000)
+        return rbk
+
+    def _new_context(self, ns):
+        ctx = rulebook.runtime.Context()
+        ctx.ns.ns = ns # Make the NetworkState available under the name 'ns'
+                       # in the namespace of the rulebooks (a bit unfortunate
+                       # clash of acronyms, TODO better naming).
+        ctx.ns.logger = logging.getLogger('ns_rbk' if ns.netns is None else 'ns_rbk.' + ns.netns)
+        return ctx
+
+    def _rule_sets(self):
+        """``(ctx, rulebooks)`` of our own and of every other network namespace."""
+        yield self.ctx, self.rulebooks
+        for name, ctx in self.netns_ctx.items():
+            yield ctx, self.netns_rules[name]
+
+    @staticmethod
+    def _hash_file(file):
+        with file.open('rb') as f:
+            return hashlib.sha1(f.read()).digest()
 
-    def _load_rules(self, dirs):
+    RELOAD_DELAY = 0.5 # Wait for a burst of changes (e.g. an editor saving) to settle.
+    WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM
+                  | inotify.IN_DELETE | inotify.IN_ONLYDIR)
+
+    def _watch_rules(self, dirs):
+        """Reload rulebooks whenever a file in one of `dirs` changes."""
+        self._rule_dirs = dirs
+        self._changed_rules = set()
+        self._reload_handle = None
+        try:
+            self._inotify = inotify.Inotify(self._rules_changed)
+        except OSError as e:
+            logger.warning("inotify not available (%s), rulebooks will not be reloaded", e)
+            return
         for dir in dirs:
-            for file in Path(dir).glob('*.rbk'):
-                self._load_rbk(file)
+            try:
+                self._inotify.add_watch(dir, self.WATCH_MASK)
+            except OSError as e:
+                logger.info("Not watching %s for rulebook changes: %s", dir, e)
+
+    def _rules_changed(self, dir, name, mask):
+        if dir is None:
+            # Events were lost, check everything.
+            self._changed_rules.update(self.rulebooks)
+            self._changed_rules.update(self._rule_files(self._rule_dirs))
+        elif name and name.endswith('.rbk'):
+            self._changed_rules.add(Path(dir).resolve() / name)
+        else:
+            return
+        if self._reload_handle is None:
+            self._reload_handle = self.loop.call_later(self.RELOAD_DELAY,
+                    lambda: run_task(self._reload_rules()))
+
+    @asyncio.coroutine
+    def _reload_rules(self):
+        """Load, replace or unload the rulebooks whose files changed. Other
+        rulebooks and all the objects they control are left alone."""
+        self._reload_handle = None
+        with (yield from self._reload_lock):
+            files, self._changed_rules = sorted(self._changed_rules), set()
+            for file in files:
+                if not file.exists():
+                    if self._rule_hashes.pop(file, None) is not None:
+                        logger.info("Unloading rulebook %s", file)
+                    for ctx, rulebooks in self._rule_sets():
+                        old = rulebooks.pop(file, None)
+                        if old is not None: old.set_active(False)
+                    continue
+                try:
+                    hash = self._hash_file(file)
+                except OSError:
+                    logger.exception("Reading rulebook %s failed, keeping the old version", file)
+                    continue
+                if file in self.rulebooks and self._rule_hashes.get(file) == hash:
+                    continue
+                logger.info("%s rulebook %s", 'Replacing' if file in self.rulebooks else 'Adding', file)
+                failed = False
+                for ctx, rulebooks in list(self._rule_sets()):
+                    old = rulebooks.get(file)
+                    try:
+                        new = self._load_rbk(file, ctx)
+                    except Exception:
+                        logger.exception("Loading rulebook %s failed, keeping the old version", file)
+                        failed = True
+                        continue
+                    # Both in the same pass of the loop, so the rules engine only
+                    # sees the difference between the two versions.
+                    if old is not None: old.set_active(False)
+                    new.set_active(True)
+                    rulebooks[file] = new
+                # After a failure, the next change is loaded again everywhere.
+                if not failed: self._rule_hashes[file] = hash
 
-    def _load_rbk(self, file):
-        file = Path(file).resolve()
-        logger.info("Loading rulebook %s", file)
-        self.rulebooks[file] = rulebook.load(file, self.ctx)[0]
-        self.rulebooks[file].set_active(True)
+    @asyncio.coroutine
+    def _add_netns(self, name):
+        logger.info("Managing network namespace %s", name)
+        ns = NetworkState(netns=name)
+        try:
+            yield from ns.start()
+        except OSError as e:
+            logger.warning("Cannot manage network namespace %s: %s", name, e)
+            yield from ns.stop()
+            return
+        ctx = self._new_context(ns)
+        self.netns_ctx[name] = ctx
+        self.netns_rules[name] = {}
+        self.netns._add(ns)
+        self._load_rules(self._rule_files(self._rule_dirs), ctx, self.netns_rules[name])
+
+    @asyncio.coroutine
+    def _remove_netns(self, name):
+        logger.info("Network namespace %s is gone", name)
+        del self.netns_ctx[name]
+        for rbk in self.netns_rules.pop(name).values():
+            rbk.set_active(False)
+        ns = self.netns._remove(name)
+        yield from ns.stop()
+
+    def _wanted_netns(self):
+        existing = set(list_netns())
+        return existing if self.args.all_netns else existing & set(self.args.netns)
+
+    @asyncio.coroutine
+    def _sync_netns(self):
+        """Start or stop managing namespaces to match what exists now."""
+        self._netns_handle = None
+        with (yield from self._reload_lock):
+            wanted = self._wanted_netns()
+            for name in sorted(set(self.netns_ctx) - wanted):
+                yield from self._remove_netns(name)
+            for name in sorted(wanted - set(self.netns_ctx)):
+                yield from self._add_netns(name)
+
+    NETNS_WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_TO
+                        | inotify.IN_MOVED_FROM | inotify.IN_ONLYDIR)
+
+    def _watch_netns(self):
+        """Follow namespaces being added and deleted with ``ip netns``."""
+        self._netns_handle = None
+        try:
+            if not NETNS_RUN_DIR.exists(): NETNS_RUN_DIR.mkdir(0o755, parents=True)
+            self._netns_inotify = inotify.Inotify(self._netns_changed)
+            self._netns_inotify.add_watch(NETNS_RUN_DIR, self.NETNS_WATCH_MASK)
+        except OSError as e:
+            logger.warning("Cannot watch %s (%s), only namespaces existing now are managed",
+                           NETNS_RUN_DIR, e)
+
+    def _netns_changed(self, dir, name, mask):
+        # Overflows (dir None) as well, all of it is looked at again anyway.
+        if self._netns_handle is None:
+            self._netns_handle = self.loop.call_later(self.RELOAD_DELAY,
+                    lambda: run_task(self._sync_netns()))
+
+    STATE_FILE = RUNDIR / 'state.json'
+
+    def _adopt_state(self):
+        """Take over the state saved by `_save_state` of the previous daemon, if any."""
+        try:
+            with self.STATE_FILE.open() as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning("Cannot read %s: %s", self.STATE_FILE, e)
+            snapshot = None
+        # Only good once, a later start must not take over a stale state.
+        self.STATE_FILE.unlink()
+        if snapshot is None: return
+        for iface, netid in self.ns.adopt(snapshot).items():
+            # Like network detection in default.rbk, so that the netid is
+            # forgotten in the same way once the interface goes down.
+            self.ctx.add_value((iface, 'attr', 'netid'), netid, -1000, 'netdet')
+
+    def _save_state(self):
+        snapshot = self.ns.snapshot()
+        # The wpa_supplicant configs in it may contain passphrases.
+        with umask_ctx(0o077), rewrite_file(self.STATE_FILE) as file:
+            json.dump(snapshot, file)
+        self.ns.detach()
+        logger.info("Saved state of %d interfaces for a warm restart", len(snapshot['ifaces']))
 
     def _exception_handler(self, loop, context):
         exc = context.get('exception')
@@ -116,49 +316,115 @@ class Daemon:
     def initialize(self):
         # Make all exceptions fatal for easier debugging
         self.loop.set_exception_handler(self._exception_handler)
-        tasks = []
+        start = time.monotonic()
+        WPASupplicant.pooled = self.args.wpa_pool
+        WPASupplicant.warm_restart = self.args.warm_restart
+        LinkEventCoalescer.window = NetworkState.commit_delay = self.args.event_window
+        DHCPClient.engine = self.args.dhcp_engine
+        supervisor.limits['helper'] = self.args.max_helpers
+        with self._phase('storage'):
+            PersistentStorage.set_storage(storage.Storage(storage.BACKENDS[self.args.storage](DATA_DIR),
+                    flush_delay=self.args.flush_delay, fsync=self.args.fsync))
         logger.info("Loading network state")
-        self.ns = NetworkState()
-        self.ctx = rulebook.runtime.Context()
-        self.ctx.ns.ns = self.ns # Make the NetworkState available under the name 'ns'
-                                 # in the namespace of the rulebooks (a bit unfortunate
-                                 # clash of acronyms, TODO better naming).
-        self.ctx.ns.logger = logging.getLogger('ns_rbk')
-        yield from self.ns.start()
+        with self._phase('network state'):
+            self.ns = NetworkState()
+            self.ctx = self._new_context(self.ns)
+            self.ctx.ns.netns = self.netns
+            yield from self.ns.start()
+
+        with self._phase('adopting state'):
+            self._adopt_state()
 
         logger.info("Loading configuration")
-        self._load_rules([RULES_BUILTIN, RULES_USER])
-
-        ctl_path = str(RUNDIR / 'ctl.sock')
-        try: os.unlink(ctl_path)
-        except FileNotFoundError: pass
-        yield from asyncio.start_unix_server(self._unix_conn, ctl_path)
-
-        if HAVE_IPYTHON:
-            self.ipython.ns['ns'] = self.ns
-            self.ipython.ns['ctx'] = self.ctx
-            self.ipython.start()
-            logger.info("IPython ready. Connect with: ``nsctl console`` or ``ipython console --existing %s``",
-                    self.ipython.app.connection_file)
-
-    def _unix_conn(self, reader, writer):
-        logger.info('New unix connection')
-        @asyncio.coroutine
-        def conn_coro():
-            while True:
-                line = yield from reader.readline()
-                if not line: break
-                line = line.decode('utf-8').strip()
-                logger.info('Got ctl command: %s', line)
-        run_task(conn_coro())
+        with self._phase('rules'):
+            files = self._rule_files([RULES_BUILTIN, RULES_USER])
+            logger.info("Loading rulebooks %s", ', '.join(map(str, files)))
+            self._load_rules(files, self.ctx, self.rulebooks)
+            self._watch_rules([RULES_BUILTIN, RULES_USER])
+
+        if self.args.netns or self.args.all_netns:
+            with self._phase('network namespaces'):
+                self._watch_netns()
+                yield from self._sync_netns()
+
+        with self._phase('control socket'):
+            self.ctl = CtlServer(self.ns, self.ctx, {'console': self._ctl_console,
+                                                     'procs': supervisor.usage},
+                                 netns=self.netns, netns_contexts=self.netns_ctx)
+            yield from self.ctl.start(RUNDIR / 'ctl.sock')
+
+        if self.args.console:
+            with self._phase('console'):
+                self.start_console()
+
+        self.startup_times.append(('total', _import_time + time.monotonic() - start))
+        logger.info("Startup times: %s", ', '.join('%s %.0f ms' % (name, t * 1000)
+                                                   for name, t in self.startup_times))
+
+    def start_console(self):
+        """Start the IPython console unless it is running already. Returns the
+        path of its connection file."""
+        if self.console is None:
+            from .console import IPythonEmbed
+            console = IPythonEmbed({'daemon': self, 'ns': self.ns, 'ctx': self.ctx,
+                                    'netns': self.netns},
+                                   sys.modules[__name__])
+            start = time.monotonic()
+            try:
+                console.start()
+            except ImportError as e:
+                logger.warning("IPython and/or pyzmq not available (%s). Interactive console"
+                               " will not work.", e)
+                raise
+            except Exception:
+                logger.exception("Cannot start the IPython console")
+                raise
+            self.console = console
+            logger.info("IPython ready in %.0f ms. Connect with: ``nsctl console`` or"
+                        " ``ipython console --existing %s``",
+                        (time.monotonic() - start) * 1000, console.connection_file)
+        return self.console.connection_file
+
+    def _ctl_console(self):
+        try: return self.start_console()
+        except ImportError as e: raise CtlError('Console not available: %s' % e)
+        except Exception as e: raise CtlError('Console failed to start: %s' % e)
+
+    def _sigusr1(self):
+        # Logged by start_console, a signal handler must not raise.
+        try: self.start_console()
+        except Exception: pass
+
+    def shutdown(self):
+        logger.info("Shutting down")
+        self._shutting_down = True
+        self.loop.stop()
 
     def main(self):
-        self.loop.run_until_complete(self.initialize())
-        logger.info("Entering mainloop")
-        self.loop.run_forever()
+        self.loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+        self.loop.add_signal_handler(signal.SIGINT, self.shutdown)
+        self.loop.add_signal_handler(signal.SIGUSR1, self._sigusr1)
+        try:
+            self.loop.run_until_complete(self.initialize())
+            logger.info("Entering mainloop")
+            self.loop.run_forever()
+        finally:
+            if self.args.warm_restart and self.ns is not None:
+                # After a crash, the state may be what caused it.
+                if self._shutting_down: self._save_state()
+                else: logger.warning("Not saving the state after an unclean exit")
+            libnetconf._wpa_pool.terminate()
+            self.loop.run_until_complete(supervisor.shutdown())
+            logger.info("Process statistics: %r", supervisor.stats)
+            if self.ns is not None:
+                logger.info("Event statistics: links %r, commits %r",
+                            self.ns._links.stats, self.ns.stats)
+            PersistentStorage.get_storage().close()
+            logger.info("Storage statistics: %r", PersistentStorage.get_storage().stats)
 
 def main():
     daemon = Daemon()
+    daemon.parse_cmdline(sys.argv[1:])
     daemon.main()
 
 if __name__ == '__main__':
@@ -0,0 +1,423 @@
+"""An in-process DHCPv4 client.
+
+The client runs as a coroutine on the asyncio loop and reports its state
+through the same events ``udhcpc`` passes to its script (``bound``, ``renew``
+and ``deconfig``) with the same variable names (``ip``, ``subnet``, ``router``,
+``dns``, ``serverid``, ...), so DHCPClient can treat both engines alike.
+The only addition is ``tentative``, for a cached lease that is being used
+before the server has confirmed it.
+
+Requests are sent with the BROADCAST flag, so replies can be received on a
+plain UDP socket bound to the interface before it has an address.
+"""
+
+import socket
+import struct
+import random
+import time
+import asyncio
+
+from .util import *
+from .netns import netns_socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+SERVER_PORT = 67
+CLIENT_PORT = 68
+MAGIC = 0x63825363
+BOOTREQUEST = 1
+BOOTREPLY = 2
+FLAG_BROADCAST = 0x8000
+
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+
+OPT_PAD = 0
+OPT_SUBNET = 1
+OPT_ROUTER = 3
+OPT_DNS = 6
+OPT_HOSTNAME = 12
+OPT_DOMAIN = 15
+OPT_BROADCAST = 28
+OPT_REQUESTED_IP = 50
+OPT_LEASE_TIME = 51
+OPT_MSG_TYPE = 53
+OPT_SERVER_ID = 54
+OPT_PARAM_REQ = 55
+OPT_T1 = 58
+OPT_T2 = 59
+OPT_CLIENT_ID = 61
+OPT_END = 255
+
+PARAMS = bytes([OPT_SUBNET, OPT_ROUTER, OPT_DNS, OPT_DOMAIN, OPT_BROADCAST,
+                OPT_LEASE_TIME, OPT_SERVER_ID, OPT_T1, OPT_T2])
+
+BOOTP = struct.Struct('!BBBBIHH4s4s4s4s16s64s128sI')
+
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+
+def mac_bytes(mac):
+    return bytes(int(x, 16) for x in mac.split(':'))
+
+def encode_client_id(client_id, mac):
+    """A client ID that looks like a MAC address is sent as such (hardware type 1,
+    as most clients do), anything else verbatim. The default is our own MAC."""
+    if client_id is None:
+        client_id = mac
+    try:
+        raw = mac_bytes(client_id)
+        if len(raw) == 6: return b'\x01' + raw
+    except ValueError:
+        pass
+    return client_id.encode('utf-8')
+
+def build_packet(msg_type, xid, mac, options, ciaddr='0.0.0.0', broadcast=True):
+    opts = bytes([OPT_MSG_TYPE, 1, msg_type])
+    for code, val in options:
+        opts += bytes([code, len(val)]) + val
+    opts += bytes([OPT_END])
+    return BOOTP.pack(BOOTREQUEST, 1, 6, 0, xid, 0, FLAG_BROADCAST if broadcast else 0,
+                      socket.inet_aton(ciaddr), b'\0'*4, b'\0'*4, b'\0'*4,
+                      mac_bytes(mac).ljust(16, b'\0'), b'', b'', MAGIC) + opts
+
+def parse_options(data):
+    opts = {}
+    offset = 0
+    while offset < len(data):
+        code = data[offset]
+        if code == OPT_END: break
+        if code == OPT_PAD:
+            offset += 1
+            continue
+        if offset + 1 >= len(data): break
+        length = data[offset + 1]
+        # Repeated options are concatenated (RFC 3396)
+        opts[code] = opts.get(code, b'') + data[offset + 2 : offset + 2 + length]
+        offset += 2 + length
+    return opts
+
+def parse_packet(data):
+    """Parse a BOOTREPLY. Returns a ``(xid, chaddr, yiaddr, options)`` tuple or None."""
+    if len(data) < BOOTP.size: return None
+    (op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr,
+            chaddr, sname, file, magic) = BOOTP.unpack_from(data)
+    if op != BOOTREPLY or magic != MAGIC: return None
+    return xid, chaddr[:hlen], socket.inet_ntoa(yiaddr), parse_options(data[BOOTP.size:])
+
+def _ips(val):
+    return [ socket.inet_ntoa(val[i:i+4]) for i in range(0, len(val) - 3, 4) ]
+
+def lease_vars(yiaddr, opts):
+    """Convert an ACK/OFFER into the variables ``udhcpc`` would export."""
+    data = {'ip': yiaddr}
+    if OPT_SUBNET in opts: data['subnet'] = socket.inet_ntoa(opts[OPT_SUBNET][:4])
+    else: data['subnet'] = '255.255.255.255'
+    if OPT_ROUTER in opts: data['router'] = ' '.join(_ips(opts[OPT_ROUTER]))
+    if OPT_DNS in opts: data['dns'] = ' '.join(_ips(opts[OPT_DNS]))
+    if OPT_BROADCAST in opts: data['broadcast'] = socket.inet_ntoa(opts[OPT_BROADCAST][:4])
+    if OPT_DOMAIN in opts: data['domain'] = opts[OPT_DOMAIN].decode('ascii', 'replace')
+    if OPT_SERVER_ID in opts: data['serverid'] = socket.inet_ntoa(opts[OPT_SERVER_ID][:4])
+    if OPT_LEASE_TIME in opts: data['lease'] = str(struct.unpack('!I', opts[OPT_LEASE_TIME][:4])[0])
+    return data
+
+
+def cacheable(lease):
+    """Strip `DHCPv4Client.lease` down to the event variables and ``expiry``,
+    which is what is worth remembering for `DHCPv4Client.cached_lease`."""
+    return { k: v for k, v in lease.items() if k not in ('obtained', 't1', 't2') }
+
+def _event_vars(lease):
+    return { k: v for k, v in lease.items() if k not in ('obtained', 't1', 't2', 'expiry') }
+
+
+class DHCPSocket:
+    """A UDP socket on port 68 bound to one interface. Received replies for
+    our MAC are put into `queue` as ``(xid, yiaddr, options)``, socket errors
+    as the OSError, which `recv` raises."""
+    def __init__(self, ifname, mac, netns=None):
+        self.mac = mac_bytes(mac)
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.sock = netns_socket(netns, socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK
+                                 | socket.SOCK_CLOEXEC)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, ifname.encode('ascii'))
+            self.sock.bind(('', CLIENT_PORT))
+        except OSError:
+            self.sock.close()
+            raise
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # E.g. ENETDOWN; the error is cleared by reading it.
+                self.queue.put_nowait(e)
+                return
+            pkt = parse_packet(data)
+            if pkt is None: continue
+            xid, chaddr, yiaddr, opts = pkt
+            if chaddr != self.mac: continue
+            self.queue.put_nowait((xid, yiaddr, opts))
+
+    def send(self, packet, dest='255.255.255.255'):
+        self.sock.sendto(packet, (dest, SERVER_PORT))
+
+    @asyncio.coroutine
+    def recv(self, xid, types, timeout):
+        """Wait for a reply with the given xid and message type. Returns
+        ``(msg_type, yiaddr, options)`` or None on timeout. Raises the
+        OSError if the socket has failed."""
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0: return None
+            try:
+                item = yield from asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if isinstance(item, OSError): raise item
+            rxid, yiaddr, opts = item
+            msg_type = opts.get(OPT_MSG_TYPE, b'\0')[0]
+            if rxid == xid and msg_type in types:
+                return msg_type, yiaddr, opts
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class DHCPv4Client:
+    """The DHCP client state machine (RFC 2131) for one interface.
+
+    `run` is a coroutine that never returns; cancel it to stop the client.
+    Events are reported as ``on_event(data)`` where ``data['event']`` is one of
+    ``bound``, ``renew`` and ``deconfig``, just like with ``udhcpc-script.sh``.
+    If `request_ip` is given, the client starts in INIT-REBOOT state and asks
+    for that address directly.
+
+    `cached_lease` is a lease remembered from an earlier connection to the same
+    network (the event variables plus ``expiry``, see `cacheable`). If it has
+    not expired yet, it is reported at once with a ``tentative`` event and then
+    confirmed by INIT-REBOOT: an ACK results in ``bound``, a NAK in
+    ``deconfig`` followed by a new lease. If the server does not answer at all,
+    the cached lease is kept for the rest of its time (RFC 2131 3.2).
+
+    `resume_lease` is a `lease` held by the previous run of the daemon (see
+    `NetworkState.snapshot`). If it has not expired, the client goes straight
+    to BOUND with it and its timers, without sending anything.
+
+    The interface is looked for in network namespace `netns` (see `netns`).
+    """
+    DISCOVER_TIMEOUTS = [4, 8, 16, 32, 64]
+    REQUEST_TRIES = 3
+    REQUEST_TIMEOUT = 4
+    INIT_REBOOT_TIMEOUT = 2
+    DEFAULT_LEASE = 3600
+    MIN_TIMEOUT = 0.5
+    SOCKET_RETRY_MIN = 1
+    SOCKET_RETRY_MAX = 60
+
+    def __init__(self, ifname, mac, client_id=None, request_ip=None, cached_lease=None,
+                 resume_lease=None, on_event=None, netns=None):
+        self.ifname = ifname
+        self.mac = mac
+        self.client_id = encode_client_id(client_id, mac)
+        self.request_ip = request_ip
+        self.cached_lease = cached_lease
+        self.resume_lease = resume_lease
+        self.on_event = on_event
+        self.netns = netns
+        self.state = 'INIT'
+        self.lease = None
+        self._sock = None
+
+    def _emit(self, event, data=None):
+        data = dict(data or {})
+        data['event'] = event
+        data['interface'] = self.ifname
+        if self.on_event: self.on_event(data)
+
+    def _options(self, *extra):
+        return [(OPT_CLIENT_ID, self.client_id), (OPT_PARAM_REQ, PARAMS)] + list(extra)
+
+    @asyncio.coroutine
+    def _exchange(self, msg_type, options, expect, timeouts, ciaddr='0.0.0.0', dest='255.255.255.255'):
+        """Send a message, retransmitting after each of `timeouts` (with a bit of
+        jitter), until a reply of one of the `expect` types arrives. A socket
+        error counts as no reply."""
+        xid = random.getrandbits(32)
+        packet = build_packet(msg_type, xid, self.mac, options, ciaddr=ciaddr,
+                              broadcast=(dest == '255.255.255.255'))
+        for timeout in timeouts:
+            try:
+                self._sock.send(packet, dest)
+            except OSError as e:
+                # E.g. a unicast RENEW before the address is configured.
+                logger.debug('DHCP send on %s failed: %s', self.ifname, e)
+                yield from asyncio.sleep(timeout)
+                continue
+            wait = max(timeout * random.uniform(0.9, 1.1), self.MIN_TIMEOUT)
+            try:
+                reply = yield from self._sock.recv(xid, expect, wait)
+            except OSError as e:
+                logger.warning('DHCP receive on %s failed: %s', self.ifname, e)
+                yield from asyncio.sleep(wait)
+                continue
+            if reply is not None: return reply
+        return None
+
+    @asyncio.coroutine
+    def _init_reboot(self):
+        """Returns the ACK or NAK, or None if there is no answer."""
+        return (yield from self._exchange(DHCPREQUEST,
+                self._options((OPT_REQUESTED_IP, socket.inet_aton(self.request_ip))),
+                {DHCPACK, DHCPNAK}, [self.INIT_REBOOT_TIMEOUT] * 2))
+
+    @asyncio.coroutine
+    def _select(self):
+        """DISCOVER, wait for an OFFER and REQUEST it. Retries forever."""
+        timeouts = self.DISCOVER_TIMEOUTS
+        while True:
+            extra = []
+            if self.request_ip:
+                extra.append((OPT_REQUESTED_IP, socket.inet_aton(self.request_ip)))
+            offer = yield from self._exchange(DHCPDISCOVER, self._options(*extra), {DHCPOFFER},
+                                              timeouts)
+            if offer is None:
+                timeouts = self.DISCOVER_TIMEOUTS[-1:]
+                continue
+            msg_type, yiaddr, opts = offer
+            if OPT_SERVER_ID not in opts: continue
+            reply = yield from self._exchange(DHCPREQUEST, self._options(
+                        (OPT_REQUESTED_IP, socket.inet_aton(yiaddr)),
+                        (OPT_SERVER_ID, opts[OPT_SERVER_ID][:4])),
+                    {DHCPACK, DHCPNAK}, [self.REQUEST_TIMEOUT] * self.REQUEST_TRIES)
+            if reply is not None and reply[0] == DHCPACK:
+                return reply
+            self.request_ip = None
+
+    def _bind(self, reply, event):
+        msg_type, yiaddr, opts = reply
+        data = lease_vars(yiaddr, opts)
+        duration = int(data.get('lease', self.DEFAULT_LEASE))
+        now = time.time()
+        t1 = struct.unpack('!I', opts[OPT_T1][:4])[0] if OPT_T1 in opts else duration * 0.5
+        t2 = struct.unpack('!I', opts[OPT_T2][:4])[0] if OPT_T2 in opts else duration * 0.875
+        self.lease = dict(data, obtained=now, t1=now + t1, t2=now + t2, expiry=now + duration)
+        self.request_ip = yiaddr
+        self.state = 'BOUND'
+        logger.info('DHCP on %s: %s %s for %d s', self.ifname, event, yiaddr, duration)
+        self._emit(event, data)
+
+    def _adopt(self, cached):
+        """Enter BOUND with a cached lease nobody has confirmed."""
+        now = time.time()
+        remaining = cached['expiry'] - now
+        self.lease = dict(cached, obtained=now, t1=now + remaining * 0.5,
+                          t2=now + remaining * 0.875)
+        self.state = 'BOUND'
+        logger.info('DHCP on %s: no answer, keeping cached %s for %d s', self.ifname,
+                    cached['ip'], remaining)
+        self._emit('bound', _event_vars(cached))
+
+    def _resume(self, lease):
+        """Enter BOUND with a lease taken over from the previous daemon."""
+        self.lease = dict(lease)
+        self.request_ip = lease['ip']
+        self.state = 'BOUND'
+        logger.info('DHCP on %s: resuming %s for %d s', self.ifname, lease['ip'],
+                    lease['expiry'] - time.time())
+        self._emit('bound', _event_vars(lease))
+
+    @asyncio.coroutine
+    def _extend(self):
+        """RENEWING and REBINDING. Returns True if the lease was extended."""
+        lease = self.lease
+        ip = lease['ip']
+        for self.state, until, dest in [('RENEWING', lease['t2'], lease.get('serverid')),
+                                        ('REBINDING', lease['expiry'], '255.255.255.255')]:
+            if dest is None: continue
+            while time.time() < until:
+                # Retransmit after half of the remaining time, at least 60 s (RFC 2131 4.4.5)
+                wait = max((until - time.time()) / 2, 60)
+                reply = yield from self._exchange(DHCPREQUEST, self._options(), {DHCPACK, DHCPNAK},
+                                                  [min(wait, until - time.time())], ciaddr=ip, dest=dest)
+                if reply is None:
+                    continue
+                if reply[0] == DHCPACK:
+                    self._bind(reply, 'renew')
+                    return True
+                logger.info('DHCP on %s: lease for %s refused', self.ifname, ip)
+                return False
+        return False
+
+    @asyncio.coroutine
+    def _open_socket(self):
+        """Create `_sock`, retrying with backoff while the interface is not
+        usable (e.g. it is being renamed or has just disappeared)."""
+        backoff = self.SOCKET_RETRY_MIN
+        while True:
+            try:
+                self._sock = DHCPSocket(self.ifname, self.mac, self.netns)
+                return
+            except OSError as e:
+                logger.warning('Cannot open DHCP socket on %s, retrying in %d s: %s',
+                               self.ifname, backoff, e)
+            yield from asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.SOCKET_RETRY_MAX)
+
+    @asyncio.coroutine
+    def run(self):
+        yield from self._open_socket()
+        try:
+            reply = None
+            cached = self.cached_lease
+            resumed = self.resume_lease
+            if resumed and resumed.get('expiry', 0) > time.time():
+                self._resume(resumed)
+                cached = None
+            elif cached and cached.get('expiry', 0) > time.time():
+                self.request_ip = cached['ip']
+                logger.info('DHCP on %s: trying cached lease for %s', self.ifname, self.request_ip)
+                self._emit('tentative', _event_vars(cached))
+            else:
+                cached = None
+            if self.request_ip and self.lease is None:
+                self.state = 'INIT-REBOOT'
+                reply = yield from self._init_reboot()
+                if reply is not None and reply[0] == DHCPNAK:
+                    logger.info('DHCP on %s: %s refused', self.ifname, self.request_ip)
+                    if cached: self._emit('deconfig')
+                    reply = None
+                elif reply is None and cached:
+                    self._adopt(cached)
+            while True:
+                if self.lease is None:
+                    if reply is None:
+                        self.state = 'SELECTING'
+                        reply = yield from self._select()
+                    self._bind(reply, 'bound')
+                reply = None
+                while True:
+                    yield from asyncio.sleep(max(self.lease['t1'] - time.time(), 0))
+                    if not (yield from self._extend()): break
+                self._emit('deconfig')
+                self.lease = None
+                self.request_ip = None
+        finally:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,89 @@
+"""Directory watching with inotify(7), via ctypes, on the asyncio loop."""
+
+import os
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class Inotify:
+    """An inotify instance. Events are passed to ``on_event(path, name, mask)``
+    where `path` is the watched path and `name` the file inside it (None for
+    events of the watched path itself). ``IN_Q_OVERFLOW`` (events were lost) is
+    reported with `path` None."""
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.loop = asyncio.get_event_loop()
+        self._watches = {}
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def add_watch(self, path, mask):
+        wd = _check(_get_libc().inotify_add_watch(self.fd, os.fsencode(str(path)), mask))
+        self._watches[wd] = path
+        return wd
+
+    def _on_readable(self):
+        while self.fd is not None:
+            try:
+                data = os.read(self.fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflow, some events were lost")
+                    self.on_event(None, None, mask)
+                    continue
+                path = self._watches.get(wd)
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                if path is None: continue
+                self.on_event(path, os.fsdecode(name) if name else None, mask)
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
@@ -1,20 +1,38 @@
 import sys, os
+import signal
 import re
+import socket
 import asyncio
 from asyncio.subprocess import PIPE, DEVNULL
-import subprocess
 from pathlib import Path
 import weakref
-from ipaddress import IPv4Address, IPv4Network
+import time
+import random
+from ipaddress import IPv4Address, IPv4Network, IPv4Interface
 import json
+from collections import OrderedDict
 
 from rulebook.abider import RuleAbider
 
 from .util import *
+from . import netlink
+from . import storage
+from . import nl80211
+from . import wpactrl
+from . import dhcp
+from .netns import netns_command, ip_netns_args, storage_key, is_wireless
+from .supervisor import supervisor
 
 import logging
 logger = logging.getLogger(__name__)
 
+def _pid_alive(pid):
+    if not pid: return False
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
 class IpRoute2Table:
     CMD = ['ip']
     UNNAMED_COLS = {
@@ -22,10 +40,12 @@ class IpRoute2Table:
         'addr': ('idx', 'name', 'flags'),
         'route': ('dest'),
     }
-    def __init__(self, subcmd):
+    def __init__(self, subcmd, netns=None):
         self.subcmd = subcmd
+        self.netns = netns
         self.data = {}
         self.loop = asyncio.get_event_loop()
+        self.monitor_proc = None
 
     def _parse_line(self, line):
         # Seems too hard to parse for now. The main problem is that some of the words
@@ -48,32 +68,49 @@ class IpRoute2Table:
     @asyncio.coroutine
     def _load(self):
         logger.debug('Loading %s from iproute2', self.subcmd)
-        #self.loop.subprocess_exec(IpRoute2Protocol, self.CMD, '-o', self.name, stderr=sys.stderr)
-        cmd = self.CMD + ['-o', self.subcmd]
-        proc = yield from asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL, stdout=PIPE,
-                start_new_session=True)
-
-        yield from self._parse_output(proc.stdout)
+        cmd = self.CMD + ip_netns_args(self.netns) + ['-o', self.subcmd]
+        proc = yield from supervisor.spawn('ip ' + self.subcmd, cmd, group='helper',
+                stdout=PIPE, start_new_session=True)
+        yield from self._parse_output(proc.proc.stdout)
+        yield from proc.wait()
 
     @asyncio.coroutine
     def _start_monitor(self):
-        #self.loop.subprocess_exec(IpRoute2Protocol, self.CMD, '-o', self.name, stderr=sys.stderr)
-        cmd = self.CMD + ['-o', 'monitor', self.subcmd]
-        self.monitor_proc = yield from asyncio.create_subprocess_exec(*cmd, stdin=DEVNULL,
-                stdout=PIPE, start_new_session=True)
-        self.monitor_task = asyncio.Task(self._parse_output(self.monitor_proc.stdout))
+        cmd = self.CMD + ip_netns_args(self.netns) + ['-o', 'monitor', self.subcmd]
+        self.monitor_proc = yield from supervisor.spawn('ip monitor ' + self.subcmd, cmd,
+                restart=True, on_start=self._monitor_started, stdout=PIPE, start_new_session=True)
+
+    def _monitor_started(self, proc):
+        self.monitor_task = asyncio.Task(self._parse_output(proc.proc.stdout))
+        if proc.restarts:
+            # Whatever happened while it was not running is only in a new dump.
+            run_task(self._load())
 
     @asyncio.coroutine
     def start(self):
         yield from self._start_monitor()
         yield from self._load()
 
-    def __del__(self):
-        self.monitor_proc.terminate()
+    def close(self):
+        if self.monitor_proc is not None:
+            self.monitor_task.cancel()
+            run_task(self.monitor_proc.stop())
+            self.monitor_proc = None
+
 
+#: Functions called as ``listener(obj, key)`` after every change notification
+#: of a `Watchable` (used by the ctl.sock subscriptions).
+change_listeners = set()
 
+class Watchable(RuleAbider):
+    """A RuleAbider whose changes are also reported to `change_listeners`."""
+    def _changed(self, key):
+        super()._changed(key)
+        for listener in list(change_listeners):
+            listener(self, key)
 
-class PersistentStorage(RuleAbider):
+
+class PersistentStorage(Watchable):
     #_instances = weakref.WeakValueDictionary()
     _instances = {}
 
@@ -90,44 +127,132 @@ class PersistentStorage(RuleAbider):
     def __init__(self, key):
         pass
 
+    _storage = None
+
     @classmethod
-    def _get_filename(cls, key):
-        return DATA_DIR / (key + '.json')
+    def get_storage(cls):
+        if cls._storage is None:
+            cls._storage = storage.Storage(storage.FileBackend(DATA_DIR))
+        return cls._storage
 
     @classmethod
-    def exists(cls, key):
-        return cls._get_filename(key).exists()
+    def set_storage(cls, stor):
+        """Replace the storage engine. Must be done before any object is loaded."""
+        cls._storage = stor
 
-    @property
-    def _filename(self):
-        return self._get_filename(self._key)
+    @classmethod
+    def flush(cls):
+        if cls._storage is not None:
+            cls._storage.flush()
+
+    @classmethod
+    def exists(cls, key):
+        return cls.get_storage().exists(key)
 
     def save(self):
         data = { k: v for k, v in vars(self).items() if not k.startswith('_') }
-        with open(str(self._filename) + '.tmp', 'w') as file:
-            json.dump(data, file)
-            file.write('\n') # everybody hates files without final newlines (especially cats ;-))
-        os.rename(str(self._filename) + '.tmp', str(self._filename))
+        self.get_storage().save(self._key, data)
     _rbk_commit = save
 
     def _load(self):
-        if self._filename.exists():
-            with self._filename.open('r') as file:
-                data = json.load(file)
-                for k,v in data.items(): setattr(self, k, v)
+        data = self.get_storage().load(self._key)
+        if data:
+            for k,v in data.items(): setattr(self, k, v)
 
     def __getattr__(self, name):
         if name.startswith('_'):
             raise AttributeError(name)
         return None
 
-def _ip(*a):
-    subprocess.check_call(('ip',)+a, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+class IpBatch:
+    """Collects ``ip`` operations and applies them in a single ``ip -batch -``
+    invocation, without blocking the event loop.
 
+    All operations submitted during one pass of the loop (i.e. one rulebook
+    commit) end up in the same batch; batches are run one after another in
+    submission order. `submit` returns a future resolving to None on success
+    or to the error message ``ip`` printed for that particular operation.
+    """
+    CMD = ['ip', '-force', '-batch', '-']
+    FAILED_RE = re.compile(r'^Command failed -:(\d+)')
+
+    def __init__(self, netns=None):
+        self.cmd = self.CMD[:1] + ip_netns_args(netns) + self.CMD[1:]
+        self._ops = []
+        self._lock = asyncio.Lock()
+        self.batches = 0
+        self.ops = 0
+
+    def submit(self, *args):
+        fut = asyncio.Future()
+        if not self._ops:
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._ops.append((args, fut))
+        return fut
+
+    def _flush(self):
+        ops, self._ops = self._ops, []
+        run_task(self._run(ops))
 
-class Interface(RuleAbider):
+    @asyncio.coroutine
+    def _run(self, ops):
+        with (yield from self._lock):
+            self.batches += 1
+            self.ops += len(ops)
+            script = ''.join(' '.join(args) + '\n' for args, fut in ops)
+            logger.debug('IP_BATCH %d ops:\n%s', len(ops), script)
+            # Not limited like the helpers, commits must not wait for scans.
+            returncode, out, err = yield from supervisor.run('ip -batch', self.cmd,
+                    input=script.encode('utf-8'), group=None, stdout=DEVNULL, stderr=PIPE)
+            err = err.decode('utf-8', 'replace')
+
+            # ``ip`` prints the error message(s) of a failed line followed by
+            # ``Command failed -:<lineno>``.
+            errors = {}
+            msg = []
+            for line in err.splitlines():
+                m = self.FAILED_RE.match(line)
+                if m:
+                    errors[int(m.group(1)) - 1] = ' '.join(msg) or 'failed'
+                    msg = []
+                elif line.strip():
+                    msg.append(line.strip())
+            if returncode != 0 and not errors:
+                errors = { i: err.strip() or 'exit code %d' % returncode for i in range(len(ops)) }
+
+            for i, (args, fut) in enumerate(ops):
+                if i in errors:
+                    logger.error('Command `ip %s` failed: %s', ' '.join(args), errors[i])
+                if not fut.done():
+                    fut.set_result(errors.get(i))
+
+_ip_batches = {} # netns -> IpBatch
+
+def _ip(*a, netns=None):
+    """Queue an ``ip`` command for network namespace `netns`, see IpBatch.submit."""
+    batch = _ip_batches.get(netns)
+    if batch is None:
+        batch = _ip_batches[netns] = IpBatch(netns)
+    return batch.submit(*a)
+
+
+class Interface(Watchable):
+    """A network interface.
+
+    `carrier` follows the kernel's carrier state (kept in `raw_carrier`) with
+    hysteresis: a loss has to last `carrier_down_hold` seconds and a regained
+    carrier `carrier_up_settle` seconds before `carrier` changes. Shorter
+    bounces are not seen by the rules at all, so the netid, the lease and the
+    running DHCP client survive them.
+
+    `netns` is the name of the network namespace the interface is in (None for
+    our own).
+    """
     up = False
     carrier = False
+    raw_carrier = False
+    carrier_down_hold = 2
+    carrier_up_settle = 0.5
     wireless = False
     netid = None
     netdata = None
@@ -135,35 +260,110 @@ class Interface(RuleAbider):
     ignore = False
     addrs = ()
     preference = 0
-    def __init__(self, index, name, mac):
+    _cur_up = None # The last state we told the kernel, None if it did not take
+    _kernel_up = None # The administrative state last reported by the kernel
+    _carrier_handle = None
+    _list = None # weakref to the InterfaceList, see InterfaceList.INDEXES
+    def __init__(self, index, name, mac, netns=None):
         super().__init__()
         self.index = index
         self.name = name
         self.mac = mac
+        self.netns = netns
 
         self.addrs = []
         self.routes = []
         self.up = False
 
         self.dhcp_client_obj = DHCPClient(self)
-        try:
-            self.driver = Path('/sys/class/net/%s/device/driver' % self.name).resolve()
-        except FileNotFoundError:
-            self.driver = None
+        self.driver = None
+        # Sysfs only has the interfaces of our own namespace.
+        if netns is None:
+            try:
+                self.driver = Path('/sys/class/net/%s/device/driver' % self.name).resolve()
+            except FileNotFoundError:
+                pass
 
     def set_netid(self, netid):
         if netid:
-            self.netdata = PersistentStorage('net.' + netid)
+            self.netdata = PersistentStorage(storage_key(self.netns, 'net.' + netid))
         else:
             self.netdata = None
         self.netid = netid
 
+    def _changed(self, key):
+        super()._changed(key)
+        lst = self._list and self._list()
+        if lst is not None and key[0] == 'attr' and key[1] in lst.INDEXES:
+            lst._attr_changed(self, key[1])
+
+    def _raw_carrier_changed(self, carrier):
+        """Called by InterfaceList when the kernel reports a carrier change."""
+        self.raw_carrier = carrier
+        if self._carrier_handle is not None:
+            self._carrier_handle.cancel()
+            self._carrier_handle = None
+        if carrier == self.carrier:
+            logger.debug('Carrier bounce on %s ignored', self.name)
+            return
+        delay = self.carrier_up_settle if carrier else self.carrier_down_hold
+        if delay > 0:
+            self._carrier_handle = asyncio.get_event_loop().call_later(delay, self._apply_carrier)
+        else:
+            self._apply_carrier()
+
+    def _apply_carrier(self):
+        self._carrier_handle = None
+        if self.carrier != self.raw_carrier:
+            self.carrier = self.raw_carrier
+            self._link_changed()
+
+    def _link_changed(self):
+        """Called when `carrier` changes."""
+        pass
+
+    def _kernel_up_changed(self, up):
+        """Called by InterfaceList when the kernel reports the interface going
+        up or down."""
+        self._kernel_up = up
+        if self._cur_up is not None and up != self._cur_up:
+            # Somebody else set it, put it back.
+            logger.info('%s was set %s behind our back', self.name, 'up' if up else 'down')
+            self._cur_up = None
+            asyncio.get_event_loop().call_soon(self.commit)
+
+    def _set_up_done(self, fut, up):
+        if fut.result() is not None and self._cur_up == up:
+            self._cur_up = None # Try again on the next commit.
+
+    def _snapshot(self):
+        data = {'index': self.index, 'mac': self.mac, 'netid': self.netid}
+        dhcp = self.dhcp_client_obj._snapshot()
+        if dhcp is not None: data['dhcp'] = dhcp
+        return data
+
+    def _adopt(self, data, sync):
+        """Take over the state from `_snapshot` of the previous daemon, as far as
+        it still matches the kernel view `sync`."""
+        if data.get('dhcp'):
+            self.dhcp_client_obj._adopt(data['dhcp'], sync)
+
+    def _detach(self):
+        self.dhcp_client_obj._detach()
+
+    def _removed(self):
+        """Called by InterfaceList when the interface is gone."""
+        if self._carrier_handle is not None:
+            # A carrier change still held back must not fire for a removed interface.
+            self._carrier_handle.cancel()
+            self._carrier_handle = None
+
     def commit(self):
         logger.info('IFACE_UPD %s addrs=%r routes=%r', self.name, self.addrs, self.routes)
-        if self.up:
-            _ip('link', 'set', self.name, 'up')
-        else:
-            _ip('link', 'set', self.name, 'down')
+        if self.up != self._cur_up:
+            up = self._cur_up = self.up
+            _ip('link', 'set', self.name, 'up' if up else 'down', netns=self.netns
+                ).add_done_callback(lambda fut: self._set_up_done(fut, up))
     _rbk_commit = commit
 
 
@@ -173,7 +373,11 @@ class Interface(RuleAbider):
 class WiredInterface(Interface):
     pass
 
-class Ess(RuleAbider):
+class Ess(Watchable):
+    signal = None
+    freq = None
+    auth = ()
+    enc = ()
     def __init__(self, essid):
         super().__init__()
         self.essid = essid
@@ -184,41 +388,141 @@ class Ess(RuleAbider):
     def __repr__(self):
         return '<Ess %r at 0x%x>'%(self.essid, id(self))
 
-class EssList(RuleAbider):
+class Bss:
+    """One access point as seen by scans. Not a RuleAbider, rules only see
+    the per-ESS aggregates computed from these."""
+    def __init__(self, bssid):
+        self.bssid = bssid
+        self.essid = None
+        self.freq = None
+        self.signal = None
+        self.signal_avg = None
+        self.signal_ref = None # signal_avg at the time of the last ESS update
+        self.auth = ()
+        self.enc = ()
+        self.last_seen = None
+
+    def __repr__(self):
+        return '<Bss %s %r %s dBm>' % (self.bssid, self.essid, self.signal_avg)
+
+class EssList(Watchable):
     """A smart container for Ess objects. Supported operations:
       * for ess in ess_list: ...
       * essid in ess_list
       * ess_list.<essid>
       * ess_list[essid]
+
+    Scan results are merged into an index of BSSes keyed by BSSID. Only ESSes
+    some of whose BSSes appeared, expired or changed are recomputed, and only
+    the attributes that really changed are assigned. BSSes not seen for
+    `bss_expire` seconds are dropped, after a scan or, as scans may stop, on a
+    timer. The signal is smoothed (exponential moving average with weight
+    `SIGNAL_ALPHA`) and ``ess.signal`` is only updated when it moves by at
+    least `SIGNAL_STEP` dB.
     """
+    bss_expire = 180
+    SIGNAL_ALPHA = 0.3
+    SIGNAL_STEP = 3
+
     def __init__(self):
         super().__init__()
         self._data = {}
+        self.bss = {}
+        self._expire_handle = None
+
+    def _schedule_expiry(self):
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        if not self.bss: return
+        due = min(bss.last_seen for bss in self.bss.values()) + self.bss_expire
+        self._expire_handle = asyncio.get_event_loop().call_later(
+                max(due - time.monotonic(), 0) + 1, self._expire)
+
+    def _expire(self):
+        self._expire_handle = None
+        self._process_scan_results([])
+
+    def _update_bss(self, bss, data, now):
+        """Merge one scan result into `bss`. Return True if anything that
+        matters for the ESS aggregates changed."""
+        chg = False
+        for k in ('essid', 'freq', 'auth', 'enc'):
+            v = data.get(k)
+            if isinstance(v, list): v = tuple(v)
+            if v != getattr(bss, k):
+                setattr(bss, k, v)
+                chg = True
+        signal = data.get('signal')
+        if signal is not None:
+            bss.signal = signal
+            if bss.signal_avg is None:
+                bss.signal_avg = signal
+            else:
+                bss.signal_avg += self.SIGNAL_ALPHA * (signal - bss.signal_avg)
+            if bss.signal_ref is None or abs(bss.signal_avg - bss.signal_ref) >= self.SIGNAL_STEP:
+                bss.signal_ref = bss.signal_avg
+                chg = True
+        bss.last_seen = now
+        return chg
+
+    def _aggregate(self, ess, bsses):
+        """Recompute the attributes of `ess` from its BSSes."""
+        best = max(bsses, key=lambda bss: bss.signal_avg if bss.signal_avg is not None else -1000)
+        attrs = {
+            'bssids': { bss.bssid for bss in bsses },
+            'auth': tuple(sorted({ a for bss in bsses for a in bss.auth })),
+            'enc': tuple(sorted({ e for bss in bsses for e in bss.enc })),
+            'freq': best.freq,
+        }
+        if best.signal_avg is not None:
+            if ess.signal is None or abs(best.signal_avg - ess.signal) >= self.SIGNAL_STEP:
+                attrs['signal'] = round(best.signal_avg)
+        for k, v in attrs.items():
+            if v != getattr(ess, k, None):
+                setattr(ess, k, v)
 
     def _process_scan_results(self, data):
-        ess_map = {}
-        for bss in data:
-            bssid = bss.pop('bssid')
-            essid = bss.pop('essid')
-            ess_itm = ess_map.setdefault(essid, {})
-            ess_itm.update(bss)
-            ess_itm.setdefault('bssids', set()).add(bssid)
-        to_remove = set(self._data.keys()) - set(ess_map.keys())
+        now = time.monotonic()
+        touched = set()
+        for item in data:
+            bssid = item['bssid']
+            bss = self.bss.get(bssid)
+            if bss is None:
+                bss = self.bss[bssid] = Bss(bssid)
+            old_essid = bss.essid
+            if self._update_bss(bss, item, now):
+                touched.add(bss.essid)
+                touched.add(old_essid)
+        for bssid, bss in list(self.bss.items()):
+            if now - bss.last_seen > self.bss_expire:
+                del self.bss[bssid]
+                touched.add(bss.essid)
+        self._schedule_expiry()
+        touched.discard(None)
+        if not touched: return
+
+        byess = {}
+        for bss in self.bss.values():
+            if bss.essid in touched:
+                byess.setdefault(bss.essid, []).append(bss)
+
         changed = []
-        for essid, ess_data in ess_map.items():
-            if essid in self._data:
-                ess = self._data[essid]
-            else: ess = Ess(essid)
-            for k,v in ess_data.items():
-                if v != getattr(ess, k, None):
-                    setattr(ess, k, v)
-                    chg = True
-            if essid not in self._data:
+        for essid in touched:
+            bsses = byess.get(essid)
+            if not bsses:
+                if essid in self._data:
+                    del self._data[essid]
+                    changed.append(essid)
+                continue
+            ess = self._data.get(essid)
+            if ess is None:
+                ess = Ess(essid)
+                self._aggregate(ess, bsses)
                 self._data[essid] = ess
                 changed.append(essid)
-        for essid in to_remove:
-            del self._data[essid]
-            changed.append(essid)
+            else:
+                self._aggregate(ess, bsses)
         for essid in changed:
             self._changed(('attr', essid))
             self._changed(('item', essid))
@@ -244,10 +548,212 @@ class EssList(RuleAbider):
     def __repr__(self):
         return '<EssList %r>' % list(self._data.keys())
 
-class WPASupplicant(RuleAbider):
+class WPASupplicantPool:
+    """A single wpa_supplicant process started with a global control interface.
+    Interfaces are added to and removed from it with INTERFACE_ADD/INTERFACE_REMOVE,
+    so activating a radio does not cost a process launch. Used by WPASupplicant
+    objects when `WPASupplicant.pooled` is set.
+
+    If `adopt_pid` is set to the process left running by the previous daemon
+    (see `detach`), it is re-attached to instead of starting a new one.
+
+    When the process dies, the supervisor starts it again and the interfaces
+    of the WPASupplicants still using it are added back."""
+    GLOBAL_CTRL = 'global'
+
+    def __init__(self):
+        self.proc = None
+        self.pid = None
+        self.adopt_pid = None
+        self._ctrl = None
+        self._lock = asyncio.Lock()
+        self.ifaces = set()
+        self._clients = {} # name -> (config, driver, WPASupplicant)
+
+    @property
+    def _ctrl_path(self):
+        return Path(WPASupplicant.CTRL_PATH) / self.GLOBAL_CTRL
+
+    @asyncio.coroutine
+    def _output_processor(self, stream):
+        while True:
+            line = yield from stream.readline()
+            if not line: break
+            logger.debug('wpa_supplicant: %s', line.decode('utf-8', 'replace').rstrip())
+
+    def _started(self, proc):
+        self.pid = proc.pid
+        if proc.proc.stdout is not None:
+            run_task(self._output_processor(proc.proc.stdout))
+        if proc.restarts:
+            run_task(self._restore())
+
+    def _exited(self, proc):
+        if proc.stopping: return
+        logger.warning('Pooled wpa_supplicant exited')
+        if self._ctrl is not None:
+            self._ctrl.close()
+            self._ctrl = None
+        self.ifaces = set()
+        for config, driver, client in self._clients.values():
+            client._supplicant_exited()
+
+    @asyncio.coroutine
+    def _restore(self):
+        with (yield from self._lock):
+            try:
+                yield from self._ensure_running()
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.error('Cannot connect to the restarted pooled wpa_supplicant: %s', e)
+                return
+            for name, (config, driver, client) in list(self._clients.items()):
+                if name in self.ifaces: continue
+                try:
+                    yield from self._add(name, config, driver)
+                except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+                    logger.error('Adding %s to the pooled wpa_supplicant failed: %s', name, e)
+                    continue
+                run_task(client._reconnect())
+
+    @asyncio.coroutine
+    def _reattach(self):
+        pid, self.adopt_pid = self.adopt_pid, None
+        if not _pid_alive(pid): return False
+        ctrl = wpactrl.WpaCtrl(self._ctrl_path)
+        try:
+            ctrl.connect()
+            ifaces = yield from ctrl.request('INTERFACES')
+        except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+            logger.warning('Cannot re-attach to pooled wpa_supplicant %d: %s', pid, e)
+            ctrl.close()
+            return False
+        self._ctrl = ctrl
+        self.pid = pid
+        self.ifaces = set(ifaces.split())
+        logger.info('Re-attached to pooled wpa_supplicant %d (%s)', pid, ', '.join(sorted(self.ifaces)))
+        return True
+
+    @asyncio.coroutine
+    def _ensure_running(self):
+        if self._ctrl is not None: return
+        if self.adopt_pid and (yield from self._reattach()): return
+        path = self._ctrl_path
+        # Otherwise it is running or about to be restarted, just connect.
+        if self.proc is None:
+            if not path.parent.exists():
+                path.parent.mkdir(0o700)
+            try: path.unlink()
+            except FileNotFoundError: pass
+            cmd = ['wpa_supplicant', '-g' + str(path)]
+            logger.debug("@@@ WPA_POOL_START %r", cmd)
+            # Its stdout must outlive us with warm_restart, see WPASupplicant.warm_restart.
+            self.proc = yield from supervisor.spawn('wpa_supplicant (pool)', cmd, restart=True,
+                    on_start=self._started, on_exit=self._exited,
+                    stdout=DEVNULL if WPASupplicant.warm_restart else PIPE)
+        ctrl = wpactrl.WpaCtrl(path)
+        try:
+            yield from ctrl.wait_connect()
+        except (OSError, asyncio.TimeoutError):
+            ctrl.close()
+            # Unusable; the next call starts a new one instead of adding another.
+            proc, self.proc, self.pid = self.proc, None, None
+            if proc is not None: yield from proc.stop()
+            raise
+        self._ctrl = ctrl
+
+    @asyncio.coroutine
+    def _add(self, name, config, driver):
+        # ifname, confname, driver, ctrl_interface (from the config), driver_param, bridge
+        yield from self._ctrl.command('INTERFACE_ADD %s\t%s\t%s\t\t\t' % (name, config, driver))
+        self.ifaces.add(name)
+
+    @asyncio.coroutine
+    def add_interface(self, name, config, driver, client):
+        """Add interface `name` for WPASupplicant `client`."""
+        with (yield from self._lock):
+            yield from self._ensure_running()
+            self._clients[name] = (config, driver, client)
+            if name in self.ifaces: return
+            yield from self._add(name, config, driver)
+
+    @asyncio.coroutine
+    def has_interface(self, name):
+        with (yield from self._lock):
+            yield from self._ensure_running()
+            return name in self.ifaces
+
+    @asyncio.coroutine
+    def remove_interface(self, name):
+        with (yield from self._lock):
+            self._clients.pop(name, None)
+            if self._ctrl is None or name not in self.ifaces: return
+            self.ifaces.discard(name)
+            yield from self._ctrl.command('INTERFACE_REMOVE %s' % name)
+
+    def _snapshot(self):
+        return self.pid if self._ctrl is not None else None
+
+    def detach(self):
+        """Leave the process running for the next daemon."""
+        if self._ctrl is not None:
+            self._ctrl.close()
+            self._ctrl = None
+        if self.proc is not None: self.proc.detach()
+        self.proc = None
+        self.pid = None
+
+    def terminate(self):
+        if self._ctrl is not None:
+            self._ctrl.close()
+            self._ctrl = None
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc = None
+        elif _pid_alive(self.pid):
+            os.kill(self.pid, signal.SIGTERM)
+
+_wpa_pool = WPASupplicantPool()
+
+class WPASupplicant(Watchable):
+    """Runs wpa_supplicant for an interface and talks to it over its control
+    socket (see `wpactrl`).
+
+    Association events are reflected in `associated`, `bssid` and `temp_disabled`
+    (the reason of the last CTRL-EVENT-SSID-TEMP-DISABLED, cleared on successful
+    association). When only `ssid`, `psk` and `key_mgmt` change, the running
+    supplicant is updated in place with SET_NETWORK/SELECT_NETWORK; other
+    configuration changes rewrite the config file and send RECONFIGURE.
+
+    With `pooled` set, the interface is added to the shared WPASupplicantPool
+    process instead of starting a wpa_supplicant of its own.
+
+    With `warm_restart` set, the supplicants are left running when the daemon
+    exits (`detach`) and the next daemon connects to them again (`_adopt_info`,
+    from `NetworkState.adopt`) instead of starting new ones, so the
+    association is not interrupted. Their output then goes to /dev/null, as a
+    pipe to us would kill them with SIGPIPE once we are gone.
+
+    A supplicant that dies is started again by the supervisor with the
+    current config, and its control socket is connected again. Failed
+    connections to the control socket are retried with a backoff of up to
+    `CTRL_RETRY_MAX` seconds.
+    """
+    pooled = False
+    warm_restart = False
     active = False
     running = False
+    associated = False
+    bssid = None
+    temp_disabled = None
+    proc = None
+    pid = None
+    task = None
     _cur_config = None
+    _net_id = None
+    _adopt_info = None
+    _ctrl_retry = None
+    _ctrl_backoff = None
+    CTRL_RETRY_MAX = 30
 
     driver = 'nl80211'
 
@@ -259,9 +765,9 @@ class WPASupplicant(RuleAbider):
 
     CTRL_PATH = '/run/networksecretary/wpa_supplicant'
     HEADER = '''
-    ctrl_interface=%s
+    ctrl_interface=%(ctrl_path)s
     update_config=0
-    '''  % CTRL_PATH
+    '''
 
     SECTION_TMPL= HEADER + '''
     network={
@@ -276,28 +782,61 @@ class WPASupplicant(RuleAbider):
         self.active = False
         self.running = False
         self._proc_lock = asyncio.Lock()
+        self._update_lock = asyncio.Lock()
+        self._ctrl = None
+        self._ctrl_ready = asyncio.Event()
+
+    # Interfaces in other network namespaces may have the same names as ours,
+    # they get their own config files and control sockets. The pool is only
+    # used in our own namespace.
+    @property
+    def _netns(self):
+        iface = self.iface()
+        return iface.netns if iface is not None else None
+
+    @property
+    def _ifname(self):
+        """The interface name for log messages."""
+        iface = self.iface()
+        return iface.name if iface is not None else '?'
+
+    @property
+    def _pooled(self):
+        return self.pooled and self._netns is None
 
     @property
     def _config(self):
-        return RUNDIR / ('wpa_supplicant.conf.%s' % self.iface().name)
+        if self._netns is None:
+            return RUNDIR / ('wpa_supplicant.conf.%s' % self.iface().name)
+        return RUNDIR / ('wpa_supplicant.%s.conf.%s' % (self._netns, self.iface().name))
+
+    @property
+    def _ctrl_path(self):
+        if self._netns is None:
+            return Path(self.CTRL_PATH)
+        return Path('%s.%s' % (self.CTRL_PATH, self._netns))
 
     def _generate_config(self):
+        ctrl = {'ctrl_path': self._ctrl_path}
         if self.config:
-            return self.HEADER + self.config
+            return self.HEADER % ctrl + self.config
         elif self.ssid and self.section:
-            return self.SECTION_TMPL % vars(self)
+            return self.SECTION_TMPL % dict(vars(self), **ctrl)
         elif self.ssid:
             sec = ''
-            data = {'key_mgmt': self.key_mgmt}
-            if self.psk and len(self.psk) < 64:
-                # TODO escape
-                data['psk'] = '"%s"' % self.psk
-            else:
-                data['psk'] = self.psk
-            for k,v in data.items():
+            for k,v in self._network_params().items():
                 if not v: continue
                 sec += '%s=%s\n'%(k,v)
-            return self.SECTION_TMPL%dict(ssid=self.ssid, section=sec)
+            return self.SECTION_TMPL%dict(ssid=self.ssid, section=sec, **ctrl)
+
+    def _network_params(self):
+        data = {'key_mgmt': self.key_mgmt, 'psk': None}
+        if self.psk:
+            try:
+                data['psk'] = wpactrl.quote_psk(self.psk)
+            except ValueError as e:
+                logger.error('Not using the PSK for %s: %s', self._ifname, e)
+        return data
 
     def _write_config(self, cfg=None):
         if cfg is None:
@@ -305,32 +844,178 @@ class WPASupplicant(RuleAbider):
         with rewrite_file(self._config) as file:
             file.write(cfg)
         self._cur_config = cfg
+        # The generated config has exactly one network (id 0) iff it is a simple one.
+        self._net_id = 0 if (self.ssid and not self.config and not self.section) else None
 
     @asyncio.coroutine
     def _reload(self):
-        cmd = ['wpa_cli', '-p', self.CTRL_PATH, 'reconfigure']
-        proc = yield from asyncio.create_subprocess_exec(*cmd, stdout=sys.stderr)
-        ret = yield from proc.wait()
-        if ret != 0:
-            logger.error('%r failed with exit code %d', cmd, ret)
+        yield from self._ctrl_ready.wait()
+        try:
+            yield from self._ctrl.command('RECONFIGURE')
+        except (wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+            logger.error('Reconfiguring wpa_supplicant on %s failed: %s', self._ifname, e)
+
+    @asyncio.coroutine
+    def _update_network(self):
+        """Switch the network in place, without rewriting the config."""
+        # One update at a time, or two of them could both add a network.
+        with (yield from self._update_lock):
+            yield from self._ctrl_ready.wait()
+            ctrl = self._ctrl
+            try:
+                if self._net_id is None:
+                    self._net_id = int((yield from ctrl.request('ADD_NETWORK')).strip())
+                id = self._net_id
+                yield from ctrl.command('SET_NETWORK %d ssid %s' % (id, wpactrl.quote(self.ssid)))
+                params = self._network_params()
+                # Same defaults as for a network block that does not mention them.
+                yield from ctrl.command('SET_NETWORK %d key_mgmt %s' % (id, params['key_mgmt'] or 'WPA-PSK WPA-EAP'))
+                if params['psk']:
+                    yield from ctrl.command('SET_NETWORK %d psk %s' % (id, params['psk']))
+                yield from ctrl.command('SELECT_NETWORK %d' % id)
+            except (wpactrl.WpaCtrlError, asyncio.TimeoutError, ValueError) as e:
+                logger.error('Updating network on %s failed (%s), reconfiguring', self._ifname, e)
+                self._write_config()
+                yield from self._reload()
 
     def _check_reload(self):
+        if self.iface() is None: return
         cfg = self._generate_config()
         if cfg != self._cur_config:
-            self._write_config(cfg)
-            run_task(self._reload())
+            if self.ssid and not self.config and not self.section and self._ctrl is not None:
+                self._cur_config = cfg
+                run_task(self._update_network())
+            else:
+                self._write_config(cfg)
+                run_task(self._reload())
+
+    def _on_event(self, level, text):
+        logger.debug('WPA_EV %s %s', self._ifname, text)
+        words = text.split()
+        event = words[0] if words else ''
+        if event == 'CTRL-EVENT-CONNECTED':
+            # CTRL-EVENT-CONNECTED - Connection to 00:11:22:33:44:55 completed [id=0 id_str=]
+            self.bssid = words[4] if len(words) > 4 else None
+            self.temp_disabled = None
+            self.associated = True
+        elif event in ('CTRL-EVENT-DISCONNECTED', 'CTRL-EVENT-TERMINATING'):
+            self.associated = False
+            self.bssid = None
+        elif event == 'CTRL-EVENT-SSID-TEMP-DISABLED':
+            # CTRL-EVENT-SSID-TEMP-DISABLED id=0 ssid="foo" auth_failures=1 duration=10 reason=WRONG_KEY
+            reason = [ w[len('reason='):] for w in words if w.startswith('reason=') ]
+            self.temp_disabled = reason[0] if reason else 'unknown'
+            logger.warning('wpa_supplicant on %s: network temporarily disabled (%s)',
+                           self._ifname, self.temp_disabled)
 
     @asyncio.coroutine
-    def _output_processor(self):
-        data = {}
+    def _connect_ctrl(self, name, timeout=wpactrl.WpaCtrl.TIMEOUT, retry=False):
+        """Connect to the control socket. With `retry`, keep trying (see
+        `_reconnect`) until it works, so that the waiters for `_ctrl_ready`
+        are not left hanging."""
+        ctrl = wpactrl.WpaCtrl(self._ctrl_path / name, self._on_event)
+        try:
+            yield from ctrl.wait_connect(timeout)
+            yield from ctrl.attach()
+            status = yield from ctrl.request('STATUS')
+        except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+            ctrl.close()
+            if not retry:
+                logger.error('Cannot connect to wpa_supplicant control socket for %s: %s', name, e)
+                return
+            self._ctrl_backoff = min((self._ctrl_backoff or 0.5) * 2, self.CTRL_RETRY_MAX)
+            logger.error('Cannot connect to wpa_supplicant control socket for %s: %s,'
+                         ' retrying in %d s', name, e, self._ctrl_backoff)
+            self._ctrl_retry = asyncio.get_event_loop().call_later(self._ctrl_backoff,
+                    lambda: run_task(self._reconnect()))
+            return
+        self._ctrl_backoff = None
+        self._ctrl = ctrl
+        # Already associated if we are re-attaching to a running supplicant.
+        status = dict(line.split('=', 1) for line in status.splitlines() if '=' in line)
+        if status.get('wpa_state') == 'COMPLETED':
+            self.bssid = status.get('bssid')
+            self.associated = True
+        self._ctrl_ready.set()
+
+    @asyncio.coroutine
+    def _reattach(self, name, info):
+        """Connect to the supplicant the previous daemon left running. Returns
+        True on success."""
+        if info['pooled'] != self._pooled: return False
+        if self._pooled:
+            try:
+                if not (yield from _wpa_pool.has_interface(name)): return False
+            except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError):
+                return False
+        elif not _pid_alive(info['pid']):
+            return False
+        yield from self._connect_ctrl(name, timeout=1)
+        if self._ctrl is None: return False
+        self.pid = info['pid']
+        self._cur_config = info['config']
+        self._net_id = info['net_id']
+        logger.info('Re-attached to wpa_supplicant on %s (%s)', name,
+                    'associated to %s' % self.bssid if self.associated else 'not associated')
+        return True
+
+    def _snapshot(self):
+        if self._ctrl is None: return None
+        return {'pooled': self._pooled, 'pid': self.pid, 'config': self._cur_config,
+                'net_id': self._net_id}
+
+    def detach(self):
+        """Leave the supplicant running for the next daemon."""
+        self._close_ctrl()
+        if self.task is not None: self.task.cancel()
+        if self.proc is not None: self.proc.detach()
+        self.proc = None
+        self.pid = None
+        self.running = False
+
+    def _close_ctrl(self):
+        if self._ctrl_retry is not None:
+            self._ctrl_retry.cancel()
+            self._ctrl_retry = None
+        self._ctrl_backoff = None
+        self._ctrl_ready.clear()
+        if self._ctrl is not None:
+            self._ctrl.close()
+            self._ctrl = None
+        self.associated = False
+        self.bssid = None
+
+    @asyncio.coroutine
+    def _output_processor(self, stream):
         while True:
-            line = yield from self.proc.stdout.readline()
+            line = yield from stream.readline()
             if not line: break
-            line = line.decode('utf-8').strip()
-            if False:
-                pass # TODO
-            else:
-                logger.error('Unknown line from wpa_supplicant ignored: %r', line)
+            # Events come through the control socket, this is just the log.
+            logger.debug('wpa_supplicant: %s', line.decode('utf-8', 'replace').rstrip())
+
+    def _proc_started(self, proc):
+        self.pid = proc.pid
+        if proc.proc.stdout is not None:
+            self.task = run_task(self._output_processor(proc.proc.stdout))
+        if proc.restarts:
+            run_task(self._reconnect())
+
+    def _proc_exited(self, proc):
+        if not proc.stopping: self._supplicant_exited()
+
+    def _supplicant_exited(self):
+        """The supplicant died and is going to be restarted."""
+        self._close_ctrl()
+        # Changes made in place would be lost otherwise.
+        if self.running and self.iface() is not None: self._write_config()
+
+    @asyncio.coroutine
+    def _reconnect(self):
+        self._ctrl_retry = None
+        with (yield from self._proc_lock):
+            iface = self.iface()
+            if not self.running or iface is None or self._ctrl is not None: return
+            yield from self._connect_ctrl(iface.name, retry=True)
 
     @asyncio.coroutine
     def start(self):
@@ -339,21 +1024,50 @@ class WPASupplicant(RuleAbider):
             self.running = True
             iface = self.iface()
             if iface is None: return
+            info, self._adopt_info = self._adopt_info, None
+            if info is not None and (yield from self._reattach(iface.name, info)):
+                self._check_reload()
+                return
             self._write_config()
-            cmd = ['wpa_supplicant', '-D'+self.driver, '-i'+iface.name, '-c'+str(self._config)]
-            logger.debug("@@@ WPA_START %r", cmd)
-            self.proc = yield from asyncio.create_subprocess_exec(*cmd, stdout=PIPE)
-            logger.debug("@@@ WPA_START DONE")
-            self.task = run_task(self._output_processor())
+            if self._pooled:
+                try:
+                    yield from _wpa_pool.add_interface(iface.name, self._config, self.driver, self)
+                except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+                    logger.error('Adding %s to the pooled wpa_supplicant failed: %s', iface.name, e)
+                    self.running = False
+                    return
+            else:
+                cmd = netns_command(iface.netns, ['wpa_supplicant', '-D'+self.driver,
+                                                  '-i'+iface.name, '-c'+str(self._config)])
+                logger.debug("@@@ WPA_START %r", cmd)
+                self.proc = yield from supervisor.spawn('wpa_supplicant ' + iface.name, cmd,
+                        restart=True, on_start=self._proc_started, on_exit=self._proc_exited,
+                        stdout=DEVNULL if self.warm_restart else PIPE)
+                logger.debug("@@@ WPA_START DONE")
+            yield from self._connect_ctrl(iface.name, retry=True)
 
     @asyncio.coroutine
     def stop(self):
         if not self.running: return
         with (yield from self._proc_lock):
             logger.debug("@@@ WPA_STOP")
-            self.proc.terminate()
-            self.task.cancel()
+            self._close_ctrl()
             self.running = False
+            iface = self.iface()
+            if self.pooled and (iface is None or iface.netns is None):
+                if iface is None: return
+                try:
+                    yield from _wpa_pool.remove_interface(iface.name)
+                except (OSError, wpactrl.WpaCtrlError, asyncio.TimeoutError) as e:
+                    logger.error('Removing %s from the pooled wpa_supplicant failed: %s', iface.name, e)
+            else:
+                if self.proc is not None:
+                    yield from self.proc.stop()
+                elif _pid_alive(self.pid):
+                    os.kill(self.pid, signal.SIGTERM)
+                if self.task is not None: self.task.cancel()
+                self.proc = None
+                self.pid = None
 
     @asyncio.coroutine
     def restart(self):
@@ -370,9 +1084,6 @@ class WPASupplicant(RuleAbider):
             run_task(self.stop())
     _rbk_commit = commit
 
-    def __del__(self):
-        if self.active: self.proc.kill()
-
     def __repr__(self):
         iface = self.iface()
         return '<WPASupplicant for %s, active=%d>'%(iface.name if iface else '?', self.active)
@@ -380,45 +1091,175 @@ class WPASupplicant(RuleAbider):
 
 
 class WirelessInterface(Interface):
+    """A wireless interface.
+
+    While `scan` is set, scans are scheduled adaptively: every
+    `scan_interval_min` seconds when disconnected or when the signal of the ESS
+    we are connected to is below `scan_weak_signal` dBm, backing off
+    exponentially up to `scan_interval` while associated and stable. No scan is
+    started while DHCP or association is in progress, for at most
+    `scan_busy_max` seconds (they may never succeed, e.g. with the network out
+    of range or without a DHCP server), and failed scans (typically EBUSY) are
+    retried after `scan_retry` seconds plus some jitter. The time of the next
+    scan and the reason for it are kept in `next_scan` and `next_scan_reason`.
+    """
     wireless = True
     scan = False
     connect_to = None
+    scan_interval = 60
+    scan_interval_min = 5
+    scan_weak_signal = -75
+    scan_retry = 2
+    scan_busy_max = 30
+    next_scan = None
+    next_scan_reason = None
+    _busy = None # (reason, since) while DHCP or association is in progress
+    _scan_monitor = None
 
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
         self.ess = EssList()
         self.wpa_supplicant = WPASupplicant(self)
+        self._scan_backoff = None
+        self._scan_wakeup = asyncio.Event()
+        # The nl80211 socket only sees the radios of our own namespace.
+        if self.netns is None: run_task(self._register_scan_results())
+
+    @asyncio.coroutine
+    def _register_scan_results(self):
+        # Registered from the start rather than on the first scan, so that the
+        # results of scans triggered by somebody else are seen before it.
+        mon = yield from nl80211.get_scan_monitor()
+        if mon is None or self._list is None: return # no nl80211, or removed already
+        mon.register(self.index, self.ess._process_scan_results)
+        self._scan_monitor = mon
+
+    def _removed(self):
+        super()._removed()
+        if self._scan_monitor is not None:
+            self._scan_monitor.unregister(self.index)
+            self._scan_monitor = None
+
+    def _snapshot(self):
+        data = super()._snapshot()
+        wpa = self.wpa_supplicant._snapshot()
+        if wpa is not None: data['wpa_supplicant'] = wpa
+        return data
+
+    def _adopt(self, data, sync):
+        super()._adopt(data, sync)
+        if data.get('wpa_supplicant'):
+            self.wpa_supplicant._adopt_info = data['wpa_supplicant']
+
+    def _detach(self):
+        super()._detach()
+        self.wpa_supplicant.detach()
 
     @asyncio.coroutine
     def do_scan(self):
+        """Scan once. Returns True on success."""
+        mon = yield from nl80211.get_scan_monitor() if self.netns is None else None
+        if mon is None:
+            return (yield from self._do_scan_cmd())
+        # The results are delivered through the callback registered in
+        # _register_scan_results.
+        try:
+            yield from mon.scan(self.index)
+        except (OSError, asyncio.TimeoutError) as e:
+            # XXX from time to time, the scan fails with EBUSY. We log it, ignore
+            # it and try again a bit later.
+            logger.error('Scan failed on %s: %s', self.name, e)
+            return False
+        return True
+
+    @asyncio.coroutine
+    def _do_scan_cmd(self):
         # XXX The `iw` help explicitly asks us NOT to screen scrape its output.
         # Too bad there is no other simple way.
-        proc = yield from asyncio.create_subprocess_exec(str(LIBDIR / 'wl-scan.sh'), self.name,
-                stdin=DEVNULL, stdout=PIPE)
-        out = (yield from proc.communicate())[0].decode('utf-8')
-        if proc.returncode != 0:
+        returncode, out, err = yield from supervisor.run('wl-scan.sh ' + self.name,
+                netns_command(self.netns, [str(LIBDIR / 'wl-scan.sh'), self.name]))
+        out = out.decode('utf-8')
+        if returncode != 0:
             # XXX from time to time, the scan fails with
             #     command failed: Device or resource busy (-16)
             # Not sure why. We log it, ignore it and try again the next time.
             # TODO investigate this
             logger.error('Scan failed on %s.', self.name)
-            return
+            return False
         data = json.loads(out)
         self.ess._process_scan_results(data)
+        return True
+
+    def _scan_busy_reason(self):
+        """Return why we should not scan now, or None."""
+        dhcp = self.dhcp_client_obj
+        wpa = self.wpa_supplicant
+        if dhcp.running and not dhcp.lease:
+            reason = 'dhcp in progress'
+        elif wpa.running and not wpa.associated and not wpa.temp_disabled:
+            reason = 'association in progress'
+        else:
+            reason = None
+        if reason is None:
+            self._busy = None
+            return None
+        now = time.monotonic()
+        if self._busy is None or self._busy[0] != reason:
+            self._busy = (reason, now)
+        if now - self._busy[1] >= self.scan_busy_max:
+            return None # Taking too long, scan as if disconnected.
+        return reason
+
+    def _scan_delay(self):
+        """Return ``(seconds, reason)`` for the next scan after a successful one."""
+        if not self.carrier:
+            self._scan_backoff = None
+            return self.scan_interval_min, 'disconnected'
+        ess = self.connect_to
+        if ess is not None and ess.signal is not None and ess.signal < self.scan_weak_signal:
+            self._scan_backoff = None
+            return self.scan_interval_min, 'weak signal'
+        if self._scan_backoff is None:
+            self._scan_backoff = self.scan_interval_min
+        else:
+            self._scan_backoff = min(self._scan_backoff * 2, self.scan_interval)
+        return self._scan_backoff, 'stable'
+
+    def _link_changed(self):
+        super()._link_changed()
+        if not self.carrier:
+            # Lost the connection, look for another network right away.
+            self._scan_backoff = None
+            self._scan_wakeup.set()
 
     @asyncio.coroutine
     def scan_coro(self):
         while True:
-            yield from self.do_scan()
-            yield from asyncio.sleep(self.scan_interval)
+            self._scan_wakeup.clear()
+            busy = self._scan_busy_reason()
+            if busy:
+                delay, reason = self.scan_interval_min, busy
+            elif (yield from self.do_scan()):
+                delay, reason = self._scan_delay()
+            else:
+                delay, reason = self.scan_retry * random.uniform(1, 2), 'retry after failure'
+            self.next_scan = time.time() + delay
+            self.next_scan_reason = reason
+            logger.debug('Next scan on %s in %.1f s (%s)', self.name, delay, reason)
+            try:
+                yield from asyncio.wait_for(self._scan_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
     def set_scan(self, scan):
         if scan == self.scan: return
         if scan:
-            import asyncio
+            self._scan_backoff = None
             self._scan_task = run_task(self.scan_coro())
         else:
             self._scan_task.cancel()
+            self.next_scan = None
+            self.next_scan_reason = None
         self.scan = scan
 
     def commit(self):
@@ -429,8 +1270,8 @@ class WirelessInterface(Interface):
 
 class InterfaceMonitor(IpRoute2Table):
     IFACE_RE = re.compile(r'^(Deleted\s+)?(\d+):\s*(\S+):\s*\<([^>]+)\>(?:.*link/ether\s+(\S+))?.*')
-    def __init__(self, lst):
-        super().__init__('link')
+    def __init__(self, lst, netns=None):
+        super().__init__('link', netns)
         self._lst = lst
 
     def _parse_line(self, line):
@@ -445,7 +1286,49 @@ class InterfaceMonitor(IpRoute2Table):
         flags = set(m.group(4).split(','))
         mac = m.group(5)
 
+        self._link_event(deleted, index, name, flags, mac)
+
+    def _link_event(self, deleted, index, name, flags, mac):
         if name == 'lo': return
+        if deleted:
+            self._lst._delete(index)
+            return
+
+        self._lst._update(index, name, flags, mac)
+
+
+class LinkEventCoalescer:
+    """Passes link events from the monitors to an InterfaceList, `window`
+    seconds late. All events for one interface within the window are merged
+    into its last state, and events that would not change anything are
+    dropped, so that a storm of link events (a switch rebooting, a bond
+    failing over) costs one update per interface instead of one per event.
+    With `window` 0, events are applied immediately (but no-ops still
+    dropped). `flush` applies the pending events right away, `flush_index`
+    only if one of them is for a given interface.
+
+    `stats` counts received `events`, those `collapsed` into a later event
+    for the same interface, `noops` and the updates actually `applied`.
+    """
+    window = 0.05
+
+    def __init__(self, lst):
+        self._lst = lst
+        self._pending = OrderedDict()
+        self._handle = None
+        self.loop = asyncio.get_event_loop()
+        self.stats = dict(events=0, collapsed=0, noops=0, applied=0)
+
+    def _push(self, index, state):
+        self.stats['events'] += 1
+        if index in self._pending: self.stats['collapsed'] += 1
+        self._pending[index] = state
+        if self.window <= 0:
+            self.flush()
+        elif self._handle is None:
+            self._handle = self.loop.call_later(self.window, self.flush)
+
+    def _update(self, index, name, flags, mac):
         if not mac:
             # My wireless interface (at least) emits superfluous events in ``ip monitor link``
             # every few seconds. They can be distinguished by lacking a hardware address:
@@ -453,43 +1336,428 @@ class InterfaceMonitor(IpRoute2Table):
             #     link/ether
             # 4: wlan0: <NO-CARRIER,BROADCAST,MULTICAST,UP>
             #     link/ether
-            # 4: wlan0: <NO-CARRIER,BROADCAST,MULTICAST,UP>
-            #     link/ether
             # ...
             # TODO: figure out why
+            # Dropped before merging, so they do not replace a real pending update.
+            self.stats['events'] += 1
+            self.stats['noops'] += 1
             return
+        self._push(index, (name, flags, mac))
 
-        if deleted:
-            self._lst._delete(index)
+    def _delete(self, index):
+        self._push(index, None)
+
+    def _indexes(self):
+        """Indexes of the interfaces in the list, counting pending events."""
+        indexes = self._lst._indexes()
+        for index, state in self._pending.items():
+            if state is None: indexes.discard(index)
+            else: indexes.add(index)
+        return indexes
+
+    def _is_noop(self, index, state):
+        if state is None:
+            return index not in self._lst._data
+        return not self._lst._would_change(index, *state)
+
+    def close(self):
+        """Forget the pending events."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._pending = OrderedDict()
+
+    def flush_index(self, index):
+        """Apply the pending events now if one is for interface `index`. For
+        events about the interface that must not see it in its old state."""
+        if index in self._pending: self.flush()
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending, self._pending = self._pending, OrderedDict()
+        for index, state in pending.items():
+            if self._is_noop(index, state):
+                self.stats['noops'] += 1
+            elif state is None:
+                self._lst._delete(index)
+                self.stats['applied'] += 1
+            else:
+                self._lst._update(index, *state)
+                self.stats['applied'] += 1
+
+
+class NetlinkInterfaceMonitor(InterfaceMonitor):
+    """Like InterfaceMonitor but talks rtnetlink directly instead of spawning
+    ``ip -o link`` and ``ip -o monitor link`` and parsing their output.
+
+    After a receive buffer overrun the links are dumped again, interfaces
+    missing from the dump removed and `on_reload` called, as the events lost
+    may have been about addresses and routes too."""
+    def __init__(self, lst, netns=None):
+        super().__init__(lst, netns)
+        self._sock = None
+        self.on_reload = None
+
+    def _on_event(self, type, payload):
+        if type not in (netlink.RTM_NEWLINK, netlink.RTM_DELLINK): return
+        link = netlink.parse_link(payload)
+        if link['wireless_event'] and type == netlink.RTM_NEWLINK:
+            # These are the superfluous wireless events described in
+            # InterfaceMonitor._link_event (they carry IFLA_WIRELESS).
+            return
+        self._link_event(type == netlink.RTM_DELLINK, link['index'], link['name'],
+                         link['flags'], link['mac'])
 
-        self._lst._update(index, name, flags, mac)
+    def _on_overrun(self):
+        # We lost some events, the only way to get in sync is a full dump.
+        run_task(self._reload())
+
+    @asyncio.coroutine
+    def _reload(self):
+        seen = yield from self._load()
+        if self._sock is None: return
+        for index in self._lst._indexes() - seen:
+            # Removed while we were not listening.
+            self._link_event(True, index, None, None, None)
+        if self.on_reload: self.on_reload()
+
+    @asyncio.coroutine
+    def _load(self):
+        """Dump the links. Returns the set of their indexes."""
+        logger.debug('Loading links from rtnetlink')
+        replies = yield from self._sock.request(netlink.RTM_GETLINK,
+                netlink.IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0), dump=True)
+        seen = set()
+        for type, flags, payload in replies:
+            self._on_event(type, payload)
+            if type == netlink.RTM_NEWLINK:
+                seen.add(netlink.parse_link(payload)['index'])
+        return seen
+
+    @asyncio.coroutine
+    def start(self):
+        self._sock = netlink.NetlinkSocket(netlink.NETLINK_ROUTE, netlink.RTMGRP_LINK, self.netns)
+        self._sock.on_event = self._on_event
+        self._sock.on_overrun = self._on_overrun
+        yield from self._load()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __del__(self):
+        if self._sock is not None: self._sock.close()
+
+
+def _field(fields, name):
+    try: return fields[fields.index(name) + 1]
+    except (ValueError, IndexError): return None
+
+def _addr_key(fields):
+    """``['10.0.0.5/24', 'dev', 'eth0', ...]`` -> ``('10.0.0.5/24', 'eth0')``"""
+    return (str(IPv4Interface(fields[0])), _field(fields, 'dev'))
 
+def _route_key(fields):
+    """``['default', 'via', '10.0.0.1', 'dev', 'eth0']`` ->
+    ``('0.0.0.0/0', '10.0.0.1', 'eth0', 0)`` (dest, gateway, device, metric)"""
+    dest = '0.0.0.0/0' if fields[0] == 'default' else str(IPv4Network(fields[0], strict=False))
+    metric = _field(fields, 'metric') or _field(fields, 'priority') or _field(fields, 'preference')
+    return (dest, _field(fields, 'via'), _field(fields, 'dev'), int(metric or 0))
 
-class InterfaceList(RuleAbider):
+
+class AddrRouteTable(IpRoute2Table):
+    """An IpRoute2Table feeding one part (``addr`` or ``route``, `subcmd`) of
+    an AddrRouteSync."""
+    CMD = ['ip', '-4']
+    def __init__(self, subcmd, sync, netns=None):
+        super().__init__(subcmd, netns)
+        self._sync = sync
+        self._reload_lock = asyncio.Lock()
+
+    @asyncio.coroutine
+    def reload(self):
+        """Replace this part of the view with a new dump from the kernel."""
+        with (yield from self._reload_lock):
+            sync, self._sync = self._sync, AddrRouteSync(self._sync._ifaces)
+            try:
+                yield from self._load()
+                setattr(sync, self.subcmd + 's', getattr(self._sync, self.subcmd + 's'))
+            finally:
+                self._sync = sync
+
+class AddrMonitor(AddrRouteTable):
+    """Feeds IPv4 addresses from ``ip -o addr`` into an AddrRouteSync."""
+    ADDR_RE = re.compile(r'^(Deleted\s+)?\d+:\s*(\S+)\s+inet\s+(\S+)')
+    def __init__(self, sync, netns=None):
+        super().__init__('addr', sync, netns)
+
+    def _parse_line(self, line):
+        m = self.ADDR_RE.match(line)
+        if not m: return
+        self._sync.update('addr', bool(m.group(1)), (str(IPv4Interface(m.group(3))), m.group(2)))
+
+class RouteMonitor(AddrRouteTable):
+    """Feeds IPv4 routes from ``ip -o route`` into an AddrRouteSync. Only routes
+    with the default protocol (``boot``, which is what ``ip route add`` uses
+    and what ``ip route`` does not print) in the main table are considered,
+    so kernel-generated prefix routes and other daemons' routes are left alone."""
+    SPECIAL = {'local', 'broadcast', 'unreachable', 'prohibit', 'blackhole',
+               'throw', 'multicast', 'anycast', 'nat'}
+    def __init__(self, sync, netns=None):
+        super().__init__('route', sync, netns)
+
+    def _parse_line(self, line):
+        fields = line.split()
+        deleted = bool(fields) and fields[0] == 'Deleted'
+        if deleted: fields = fields[1:]
+        if not fields or fields[0] in self.SPECIAL: return
+        if 'proto' in fields or 'table' in fields or 'dev' not in fields: return
+        try:
+            key = _route_key(fields)
+        except ValueError:
+            logger.warning("Invalid 'ip route' line: %s", line)
+            return
+        self._sync.update('route', deleted, key)
+
+class NetlinkAddrRouteMonitor:
+    """Like AddrMonitor and RouteMonitor combined, using rtnetlink."""
+    def __init__(self, sync, netns=None):
+        self._sync = sync
+        self.netns = netns
+        self._sock = None
+        self._reload_lock = asyncio.Lock()
+
+    def _on_event(self, type, payload):
+        if type in (netlink.RTM_NEWADDR, netlink.RTM_DELADDR):
+            addr = netlink.parse_addr(payload)
+            dev = addr and self._sync.ifname(addr['index'])
+            if dev:
+                self._sync.update('addr', type == netlink.RTM_DELADDR, (addr['addr'], dev))
+        elif type in (netlink.RTM_NEWROUTE, netlink.RTM_DELROUTE):
+            route = netlink.parse_route(payload)
+            if (route is None or route['table'] != netlink.RT_TABLE_MAIN
+                    or route['protocol'] != netlink.RTPROT_BOOT
+                    or route['type'] != netlink.RTN_UNICAST):
+                return
+            dev = self._sync.ifname(route['index'])
+            if dev:
+                key = (route['dest'], route['via'], dev, route['metric'])
+                self._sync.update('route', type == netlink.RTM_DELROUTE, key)
+
+    @asyncio.coroutine
+    def _load(self):
+        logger.debug('Loading addresses and routes from rtnetlink')
+        for type, msg in [(netlink.RTM_GETADDR, netlink.IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)),
+                          (netlink.RTM_GETROUTE, netlink.RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0))]:
+            replies = yield from self._sock.request(type, msg, dump=True)
+            for type, flags, payload in replies:
+                self._on_event(type, payload)
+
+    def _on_overrun(self):
+        run_task(self.reload())
+
+    @asyncio.coroutine
+    def reload(self):
+        """Replace the view with a new dump from the kernel."""
+        with (yield from self._reload_lock):
+            if self._sock is None: return
+            sync, self._sync = self._sync, AddrRouteSync(self._sync._ifaces, self._sync._links)
+            try:
+                yield from self._load()
+                sync.addrs, sync.routes = self._sync.addrs, self._sync.routes
+            finally:
+                self._sync = sync
+
+    @asyncio.coroutine
+    def start(self):
+        self._sock = netlink.NetlinkSocket(netlink.NETLINK_ROUTE,
+                netlink.RTMGRP_IPV4_IFADDR | netlink.RTMGRP_IPV4_ROUTE, self.netns)
+        self._sock.on_event = self._on_event
+        self._sock.on_overrun = self._on_overrun
+        yield from self._load()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __del__(self):
+        if self._sock is not None: self._sock.close()
+
+
+class AddrRouteSync:
+    """Kernel-side view of IPv4 addresses and routes, kept up to date by one
+    of the monitors above.
+
+    Addresses are keyed by `_addr_key` and routes by `_route_key`. `diff` compares
+    the view with the desired ``ns.addrs``/``ns.routes`` and returns only the
+    operations needed to get there, so unchanged addresses (and the connections
+    using them) are left alone.
+
+    With `links` (the LinkEventCoalescer feeding `ifaces`), link events still
+    pending for an interface are applied before looking up its name, so that
+    addresses of a new or renamed interface are not lost or misattributed.
+    """
+    def __init__(self, ifaces, links=None):
+        self._ifaces = ifaces
+        self._links = links
+        self.addrs = set()
+        self.routes = set()
+
+    def ifname(self, index):
+        if self._links is not None: self._links.flush_index(index)
+        try: return self._ifaces._data[index].name
+        except KeyError: return None
+
+    def clear(self):
+        self.addrs = set()
+        self.routes = set()
+
+    def update(self, kind, deleted, key):
+        view = self.addrs if kind == 'addr' else self.routes
+        if deleted: view.discard(key)
+        else: view.add(key)
+
+    def diff(self, addrs, routes, managed):
+        """Return a list of ``(kind, deleted, key, ip_args)`` operations. Only entries
+        on interfaces in `managed` are ever removed."""
+        want_addrs = {}
+        for addr in addrs:
+            fields = addr.strip().split()
+            want_addrs[_addr_key(fields)] = fields
+        want_routes = {}
+        for route in routes:
+            fields = route.strip().split()
+            want_routes[_route_key(fields)] = fields
+
+        ops = []
+        # Removing routes first, then addresses, then adding addresses and only
+        # then routes (which may need the addresses for their gateways).
+        for key in self.routes - set(want_routes):
+            dest, via, dev, metric = key
+            if dev not in managed: continue
+            args = ['route', 'del', dest] + (['via', via] if via else []) + ['dev', dev, 'metric', str(metric)]
+            ops.append(('route', True, key, args))
+        for key in self.addrs - set(want_addrs):
+            addr, dev = key
+            if dev not in managed: continue
+            ops.append(('addr', True, key, ['addr', 'del', addr, 'dev', dev]))
+        for key, fields in want_addrs.items():
+            if key in self.addrs: continue
+            if 'brd' not in fields:
+                # Auto-set broadcast address if not explicitly given
+                fields = fields + ['brd', '+']
+            ops.append(('addr', False, key, ['addr', 'add'] + fields))
+        for key, fields in want_routes.items():
+            if key in self.routes: continue
+            ops.append(('route', False, key, ['route', 'add'] + fields))
+        return ops
+
+
+class InterfaceList(Watchable):
     """A smart container for Interface objects. Supported operations:
       * iface_list[iface_index], iface_index in iface_list
       * iface_list[iface_name], iface_name in iface_list
       * iface_list[iface_mac], iface_mac in iface_list
       * iface_list.<iface-name>
       * for iface in iface_list: ...
+      * iface_list.select(driver=..., wireless=..., role=...)
     along with correct change notifications.
+
+    All lookups go through indexes that are updated incrementally when an
+    interface is added, removed or renamed, changes its MAC address or (for
+    the attributes in `INDEXES`) the value of the attribute. Several
+    interfaces may share a MAC address (VLANs, bonds), or for a moment a name
+    (two interfaces swapping names); looking one up returns the one that has
+    had it the longest. `_check_consistency` compares the
+    indexes with what they should be.
     """
-    def __init__(self):
+    INDEXES = ('driver', 'wireless', 'role')
+
+    def __init__(self, netns=None):
         super().__init__()
+        self.netns = netns
         self._data = {}
-        self._byname = {}
-        self._bymac = {}
-
-    def _reindex(self):
-        self._byname = { iface.name: iface for iface in self._data.values() }
-        self._bymac = { iface.mac: iface for iface in self._data.values() }
+        self._byname = {} # name -> {index: iface}
+        self._bymac = {} # mac -> {index: iface}
+        self._byattr = { attr: {} for attr in self.INDEXES } # attr -> value -> {index: iface}
+
+    def _index(self, iface):
+        self._byname.setdefault(iface.name, {})[iface.index] = iface
+        self._bymac.setdefault(iface.mac, {})[iface.index] = iface
+        iface._indexed = {}
+        for attr in self.INDEXES:
+            self._index_attr(iface, attr)
+
+    def _unindex(self, iface):
+        self._unindex_value(self._byname, iface.name, iface)
+        self._unindex_value(self._bymac, iface.mac, iface)
+        for attr, value in iface._indexed.items():
+            self._unindex_value(self._byattr[attr], value, iface)
+        iface._indexed = {}
+
+    @staticmethod
+    def _unindex_value(index, value, iface):
+        bucket = index.get(value)
+        if bucket is None: return
+        bucket.pop(iface.index, None)
+        if not bucket: del index[value]
+
+    def _index_attr(self, iface, attr):
+        value = getattr(iface, attr, None)
+        self._byattr[attr].setdefault(value, {})[iface.index] = iface
+        iface._indexed[attr] = value
+
+    def _attr_changed(self, iface, attr):
+        """Called by Interface when one of the `INDEXES` attributes changes."""
+        if self._data.get(iface.index) is not iface: return
+        old = iface._indexed.get(attr)
+        if getattr(iface, attr, None) == old: return
+        self._unindex_value(self._byattr[attr], old, iface)
+        self._index_attr(iface, attr)
+        self._changed(('iter', None))
+
+    def _check_consistency(self):
+        """Raise AssertionError if the indexes do not match `_data`."""
+        byname = {}
+        bymac = {}
+        byattr = { attr: {} for attr in self.INDEXES }
+        for index, iface in self._data.items():
+            assert iface.index == index, "%r stored under index %d" % (iface, index)
+            byname.setdefault(iface.name, {})[index] = iface
+            bymac.setdefault(iface.mac, {})[index] = iface
+            for attr in self.INDEXES:
+                byattr[attr].setdefault(getattr(iface, attr, None), {})[index] = iface
+        assert self._byname == byname, "name index %r, expected %r" % (self._byname, byname)
+        assert self._bymac == bymac, "MAC index %r, expected %r" % (self._bymac, bymac)
+        assert self._byattr == byattr, "attribute indexes %r, expected %r" % (self._byattr, byattr)
+
+    def _indexes(self):
+        return set(self._data)
 
     def _delete(self, index):
-        try: del self._data[index]
-        except KeyError: pass
-        else:
-            self._reindex()
-            self.changed(('iter', None))
+        iface = self._data.pop(index, None)
+        if iface is None: return
+        self._unindex(iface)
+        iface._list = None
+        iface._removed()
+        for key in [('attr', iface.name), ('item', iface.name), ('item', iface.mac),
+                    ('item', index), ('iter', None)]:
+            self._changed(key)
+
+    @staticmethod
+    def _carrier(flags):
+        return 'UP' in flags and 'NO-CARRIER' not in flags
+
+    def _would_change(self, index, name, flags, mac):
+        """Whether `_update` with these arguments would change anything."""
+        iface = self._data.get(index)
+        return (iface is None or iface.name != name or iface.mac != mac
+                or iface.raw_carrier != self._carrier(flags)
+                or iface._kernel_up != ('UP' in flags))
 
     def _update(self, index, name, flags, mac):
         # The keys/attributes that changed contents (meaning they now refer to a different
@@ -499,7 +1767,7 @@ class InterfaceList(RuleAbider):
         logger.debug('IFACE_UPD %d:%s %r %s', index, name, flags, mac)
 
         # Attributes/items affected by the update. Used to notify Rulebook.
-        carrier = 'UP' in flags and 'NO-CARRIER' not in flags
+        carrier = self._carrier(flags)
         logger.debug('.. carrier %d', carrier)
         if index in self._data:
             iface = self._data[index]
@@ -508,21 +1776,33 @@ class InterfaceList(RuleAbider):
                 changed.append(name)
                 changed.append(('attr', name))
                 changed.append(('attr', iface.name))
+                self._unindex_value(self._byname, iface.name, iface)
+                self._byname.setdefault(name, {})[index] = iface
             if mac != iface.mac:
                 changed.append(iface.mac)
                 changed.append(mac)
+                self._unindex_value(self._bymac, iface.mac, iface)
+                self._bymac.setdefault(mac, {})[index] = iface
             iface.name = name
             iface.mac = mac
-            iface.carrier = carrier
+            if carrier != iface.raw_carrier:
+                iface._raw_carrier_changed(carrier)
+            if ('UP' in flags) != iface._kernel_up:
+                iface._kernel_up_changed('UP' in flags)
         else:
-            wireless = (Path('/sys/class/net') / name / 'wireless').exists()
+            if self.netns is None:
+                wireless = (Path('/sys/class/net') / name / 'wireless').exists()
+            else:
+                wireless = is_wireless(self.netns, name)
             if wireless:
-                iface = WirelessInterface(index, name, mac)
+                iface = WirelessInterface(index, name, mac, self.netns)
             else:
-                iface = WiredInterface(index, name, mac)
-            iface.carrier = carrier
+                iface = WiredInterface(index, name, mac, self.netns)
+            iface.carrier = iface.raw_carrier = carrier
+            iface._kernel_up = 'UP' in flags
             self._data[index] = iface
-            self._reindex()
+            self._index(iface)
+            iface._list = weakref.ref(self)
             changed = [('attr', name), name, mac, index, ('iter', None)]
 
         for key in changed:
@@ -534,13 +1814,25 @@ class InterfaceList(RuleAbider):
     def __iter__(self):
         return iter(self._data.values())
 
+    def select(self, **kw):
+        """Interfaces whose `INDEXES` attributes have the given values, e.g.
+        ``select(wireless=True, role='inet-client')``."""
+        for attr in kw:
+            if attr not in self._byattr:
+                raise TypeError('select() by %r, which is not indexed (INDEXES = %r)'
+                                % (attr, self.INDEXES))
+        buckets = sorted((self._byattr[attr].get(value, {}) for attr, value in kw.items()), key=len)
+        if not buckets: return list(self)
+        return [ iface for index, iface in buckets[0].items()
+                 if all(index in bucket for bucket in buckets[1:]) ]
+
     def __contains__(self, key):
         return (key in self._data) or (key in self._byname) or (key in self._bymac)
 
     def __getitem__(self, key):
-        try: return self._byname[key]
+        try: return next(iter(self._byname[key].values()))
         except KeyError: pass
-        try: return self._bymac[key]
+        try: return next(iter(self._bymac[key].values()))
         except KeyError: pass
         try: return self._data[key]
         except KeyError: pass
@@ -555,61 +1847,279 @@ class InterfaceList(RuleAbider):
 
 
 
-class NetworkState(RuleAbider):
+class NetworkState(Watchable):
+    """The whole network configuration: interfaces and the desired addresses,
+    routes and DNS servers.
+
+    `snapshot` returns what is worth keeping over a restart of the daemon and
+    `adopt` (called after `start`, before the rules are loaded) takes it over
+    again, dropping whatever does not match the kernel any more. Addresses and
+    routes we had configured are not removed for `ADOPT_GRACE` seconds unless
+    the rules say so, giving them time to want them again.
+
+    Link events reach `ifaces` through a LinkEventCoalescer and commits
+    requested by the rules are delayed by `commit_delay` seconds, so that
+    all requests within that time result in one commit. `stats` counts the
+    `commits` done and the requests `collapsed` into them.
+
+    `netns` is the name of the network namespace managed (None for our own).
+    Other namespaces get their DNS servers in ``/etc/netns/<name>/resolv.conf``,
+    which ``ip netns exec`` puts in place of ``/etc/resolv.conf``.
+    """
     _rbk_commit_order = 1000 # Need to commit AFTER interfaces (so that they are already up)
-    def __init__(self):
+    use_netlink = True # Set to False to use the ``ip monitor`` text backend
+    SNAPSHOT_VERSION = 1
+    ADOPT_GRACE = 30
+    commit_delay = 0.05
+    def __init__(self, netns=None):
         super().__init__()
-        self.ifaces = InterfaceList()
-        self._ifmon = InterfaceMonitor(self.ifaces)
+        self.netns = netns
+        self.ifaces = InterfaceList(netns)
+        self._links = LinkEventCoalescer(self.ifaces)
+        self._commit_handle = None
+        self.stats = dict(commits=0, collapsed=0)
+        self._ifmon = None
         self.addrs = set()
         self.routes = set()
+        self._sync = AddrRouteSync(self.ifaces, self._links)
+        self._addrmon = []
+        self._resync_handle = None
+        self._cur_dns_servers = None
+        self._adopted = set()
 
     @asyncio.coroutine
-    def start(self):
+    def _start_monitor(self):
+        if self.use_netlink:
+            try:
+                self._ifmon = NetlinkInterfaceMonitor(self._links, self.netns)
+                self._ifmon.on_reload = self._request_resync
+                yield from self._ifmon.start()
+                # Addresses and routes are only recorded for known interfaces.
+                self._links.flush()
+                self._addrmon = [NetlinkAddrRouteMonitor(self._sync, self.netns)]
+                yield from self._addrmon[0].start()
+                return
+            except OSError as e:
+                logger.warning("rtnetlink not usable (%s), falling back to `ip monitor`", e)
+                self._sync.clear()
+        self._ifmon = InterfaceMonitor(self._links, self.netns)
         yield from self._ifmon.start()
+        self._links.flush()
+        self._addrmon = [AddrMonitor(self._sync, self.netns), RouteMonitor(self._sync, self.netns)]
+        for mon in self._addrmon:
+            yield from mon.start()
 
-    def commit(self):
-        # TODO On every update, we flush all addresses and re-add the current list.
-        #      This is ugly. We need some kind of "synchronization": add new addresses,
-        #      remove no-longer-wanted ones and leave the rest alone. This will require
-        #      more sophisticated iproute2 parsing.
+    @asyncio.coroutine
+    def start(self):
+        yield from self._start_monitor()
+
+    @asyncio.coroutine
+    def stop(self):
+        """Stop monitoring and the DHCP clients and supplicants of all interfaces."""
+        self._links.close()
+        for handle in (self._commit_handle, self._resync_handle):
+            if handle is not None: handle.cancel()
+        self._commit_handle = self._resync_handle = None
+        for mon in [self._ifmon] + self._addrmon:
+            if mon is not None: mon.close()
         for iface in self.ifaces:
-            if not iface.ignore:
-                _ip('addr', 'flush', 'dev', iface.name) # flushes routes too
-        for addr in self.addrs:
-            addr_flds = addr.strip().split()
-            if 'brd' not in addr_flds:
-                # Auto-set broadcast address if not explicitly given
-                addr_flds += ['brd', '+']
-            _ip('addr', 'add', *addr_flds)
-        for route in self.routes:
-            _ip('route', 'add', *route.strip().split())
-        if self.dns_servers is not None:
-            with rewrite_file('/etc/resolv.conf') as file:
+            yield from iface.dhcp_client_obj.stop()
+            if iface.wireless:
+                yield from iface.wpa_supplicant.stop()
+
+    def snapshot(self):
+        return {
+            'version': self.SNAPSHOT_VERSION,
+            'ifaces': { iface.name: iface._snapshot() for iface in self.ifaces },
+            'addrs': sorted(self.addrs),
+            'routes': sorted(self.routes),
+            'wpa_pool': _wpa_pool._snapshot(),
+        }
+
+    def adopt(self, snapshot):
+        """Take over a `snapshot` of the previous daemon. Returns ``{iface: netid}``
+        for the interfaces whose network is still the same, for the caller to
+        set in the way its rules expect."""
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            logger.warning('Ignoring state snapshot of unknown version %r', snapshot.get('version'))
+            return {}
+        netids = {}
+        for name, data in snapshot['ifaces'].items():
+            iface = self.ifaces[name] if name in self.ifaces else None
+            if iface is None or iface.index != data['index'] or iface.mac != data['mac']:
+                logger.info('Interface %s is gone or has changed, not adopting its state', name)
+                continue
+            iface._adopt(data, self._sync)
+            if data['netid'] and iface.carrier:
+                netids[iface] = data['netid']
+        _wpa_pool.adopt_pid = snapshot.get('wpa_pool')
+        self._adopted = ({ ('addr', _addr_key(addr.split())) for addr in snapshot['addrs'] }
+                         & { ('addr', key) for key in self._sync.addrs })
+        self._adopted |= ({ ('route', _route_key(route.split())) for route in snapshot['routes'] }
+                          & { ('route', key) for key in self._sync.routes })
+        if self._adopted:
+            asyncio.get_event_loop().call_later(self.ADOPT_GRACE, self._adopt_expired)
+        logger.info('Adopted state: netids %s, %d addresses and routes',
+                    ', '.join('%s=%s' % (iface.name, netid) for iface, netid in netids.items()) or 'none',
+                    len(self._adopted))
+        return netids
+
+    def _adopt_expired(self):
+        if not self._adopted: return
+        self._adopted = set()
+        self.commit()
+
+    def detach(self):
+        """Let go of everything that should survive the exit of the daemon."""
+        for iface in self.ifaces:
+            iface._detach()
+        _wpa_pool.detach()
+
+    def _request_commit(self):
+        if self.commit_delay <= 0:
+            self.commit()
+        elif self._commit_handle is not None:
+            self.stats['collapsed'] += 1
+        else:
+            self._commit_handle = asyncio.get_event_loop().call_later(self.commit_delay, self.commit)
+
+    def commit(self):
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        self.stats['commits'] += 1
+        managed = { iface.name for iface in self.ifaces if not iface.ignore }
+        ops = self._sync.diff(self.addrs, self.routes, managed)
+        if self._adopted:
+            # Adopted entries that are wanted now (or gone) need no more protection.
+            self._adopted &= { (kind, key) for kind, deleted, key, args in ops if deleted }
+            ops = [ op for op in ops if not (op[1] and (op[0], op[2]) in self._adopted) ]
+        for kind, deleted, key, args in ops:
+            # Update the view right away so that a commit that comes before the
+            # batch is applied does not queue the same operation again.
+            self._sync.update(kind, deleted, key)
+            _ip(*args, netns=self.netns).add_done_callback(self._ip_done)
+        if self.dns_servers is not None and self.dns_servers != self._cur_dns_servers:
+            if self.netns is None:
+                resolv_conf = Path('/etc/resolv.conf')
+            else:
+                resolv_conf = Path('/etc/netns') / self.netns / 'resolv.conf'
+                if not resolv_conf.parent.exists(): resolv_conf.parent.mkdir(parents=True)
+            with rewrite_file(resolv_conf) as file:
                 for ip in self.dns_servers:
                     file.write('nameserver %s\n' % ip)
+            self._cur_dns_servers = set(self.dns_servers)
 
-    _rbk_commit = commit
+    _rbk_commit = _request_commit
+
+    def _ip_done(self, fut):
+        # A failed operation does not tell what the kernel has now: an address
+        # to be deleted may be gone already, one to be added may have been
+        # added by someone else. Ask the kernel rather than guess.
+        if fut.result() is not None: self._request_resync()
+
+    def _request_resync(self):
+        if self._resync_handle is None:
+            self._resync_handle = asyncio.get_event_loop().call_soon(
+                    lambda: run_task(self._resync()))
+
+    @asyncio.coroutine
+    def _resync(self):
+        """Replace the view of addresses and routes with a new dump."""
+        self._resync_handle = None
+        for mon in self._addrmon:
+            try:
+                yield from mon.reload()
+            except OSError as e:
+                logger.warning("Cannot reload addresses and routes: %s", e)
+
+    def __repr__(self):
+        return '<NetworkState%s>' % ('' if self.netns is None else ' ' + self.netns)
+
+class NetnsMap(Watchable):
+    """The NetworkStates of the other network namespaces the daemon manages,
+    by namespace name. Supported operations:
+      * netns[name], name in netns
+      * netns.<name>
+      * for ns in netns: ...
+    along with correct change notifications.
+    """
+    def __init__(self):
+        super().__init__()
+        self._data = {}
+
+    def _add(self, ns):
+        self._data[ns.netns] = ns
+        for key in [('attr', ns.netns), ('item', ns.netns), ('iter', None)]:
+            self._changed(key)
 
-class DHCPLease(RuleAbider):
+    def _remove(self, name):
+        ns = self._data.pop(name, None)
+        if ns is not None:
+            for key in [('attr', name), ('item', name), ('iter', None)]:
+                self._changed(key)
+        return ns
+
+    def __iter__(self):
+        return iter(self._data.values())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'): raise AttributeError(name)
+        try: return self[name]
+        except KeyError: raise AttributeError(name)
+
+    def __repr__(self):
+        return '<NetnsMap [%s]>' % ', '.join(self._data)
+
+class DHCPLease(Watchable):
     addr = None
     ip = None
     dns = set()
     router = None
+    tentative = False # A cached lease not confirmed by the server yet
+
+class DHCPClient(Watchable):
+    """Obtains a lease for an interface, either with the in-process client from
+    `dhcp` (``engine = 'native'``, the default) or with ``udhcpc``.
 
-class DHCPClient(RuleAbider):
+    If `lease_cache` is set (to the PersistentStorage of the current network),
+    the native client remembers each lease in its ``last_lease`` and starts by
+    re-using it, so the address is configured before the DHCP server answers.
+
+    A lease held by the native client when the daemon exited is taken over by
+    the next start (`resume_lease`) as long as its address is still configured.
+    udhcpc cannot be re-attached (it talks to us through a pipe), so it is
+    killed and started again asking for the same address. It is also started
+    again by the supervisor if it dies.
+    """
+    engine = 'native'
     client_id = None
     request_ip = None
+    lease_cache = None
+    resume_lease = None
     active = False
     running = False
     lease = None
+    start_task = None
+    task = None
+    proc = None
+    client = None
+    _script_lease = None
     def __init__(self, iface):
         super().__init__()
         self.iface = weakref.ref(iface, self._iface_removed)
 
-    def _iface_removed(self):
-        self.set_active(False)
-        self.iface = None
+    def _iface_removed(self, ref):
+        if self.running: run_task(self.stop())
 
     def _update_lease(self, lease, data):
         # Convert ip+netmask to the more convenient "1.2.3.4/24" format that can be
@@ -629,20 +2139,60 @@ class DHCPClient(RuleAbider):
     def _process_event(self, data):
         logger.debug('DHCP_EV %r', data)
         event = data.pop('event')
+        if self.client is None:
+            self._script_lease = self._timed_lease(data) if event in ('bound', 'renew') else None
         if event == 'deconfig':
             self.lease = None
-        elif event == 'bound':
+            self._cache_lease(None)
+        elif event in ('bound', 'tentative'):
             lease = DHCPLease()
             self._update_lease(lease, data)
+            lease.tentative = (event == 'tentative')
             self.lease = lease
         elif event == 'renew':
             self._update_lease(self.lease, data)
+        if event in ('bound', 'renew') and self.client is not None:
+            self._cache_lease(dhcp.cacheable(self.client.lease))
+
+    @staticmethod
+    def _timed_lease(data):
+        """The variables of a udhcpc event with the timers of a `dhcp` lease,
+        as the native client would have set them."""
+        now = time.time()
+        duration = int(data.get('lease', dhcp.DHCPv4Client.DEFAULT_LEASE))
+        return dict(data, obtained=now, t1=now + duration * 0.5, t2=now + duration * 0.875,
+                    expiry=now + duration)
+
+    def _snapshot(self):
+        lease = self.client.lease if self.client is not None else self._script_lease
+        if lease is None: return None
+        return {'lease': dict(lease), 'client_id': self.client_id}
+
+    def _adopt(self, data, sync):
+        lease = data['lease']
+        if lease.get('expiry', 0) <= time.time():
+            return
+        addr = str(IPv4Interface('%s/%s' % (lease['ip'], lease['subnet'])))
+        if (addr, self.iface().name) not in sync.addrs:
+            logger.info('Not resuming DHCP lease for %s on %s, the address is gone',
+                        lease['ip'], self.iface().name)
+            return
+        self.resume_lease = data
+
+    def _detach(self):
+        if self.proc is not None: self.proc.kill()
+
+    def _cache_lease(self, lease):
+        cache = self.lease_cache
+        if cache is None or cache.last_lease == lease: return
+        cache.last_lease = lease
+        cache.save()
 
     @asyncio.coroutine
-    def _output_processor(self):
+    def _output_processor(self, stream):
         data = {}
         while True:
-            line = yield from self.proc.stdout.readline()
+            line = yield from stream.readline()
             if not line: break
             line = line.decode('utf-8').strip()
             # Events are blocks of name=value variable assignments, followed by a blank line.
@@ -656,6 +2206,8 @@ class DHCPClient(RuleAbider):
             else:
                 logger.error('Unknown line from DHCP script ignored: %r', line)
 
+    def _udhcpc_started(self, proc):
+        self.task = run_task(self._output_processor(proc.proc.stdout))
 
     @asyncio.coroutine
     def start(self):
@@ -663,24 +2215,41 @@ class DHCPClient(RuleAbider):
         self.running = True
         iface = self.iface()
         if iface is None: return
-        logger.debug("START_DHCP %s %s", self.client_id, self.request_ip)
+        logger.debug("START_DHCP %s %s %s", self.engine, self.client_id, self.request_ip)
+        self.lease = None
+        # A lease from the previous daemon is only good for the same client ID.
+        resume, self.resume_lease = self.resume_lease, None
+        if resume is not None and resume['client_id'] != self.client_id:
+            resume = None
+        if self.engine == 'native':
+            self.proc = None
+            cached = self.lease_cache.last_lease if self.lease_cache is not None else None
+            self.client = dhcp.DHCPv4Client(iface.name, iface.mac, client_id=self.client_id,
+                    request_ip=self.request_ip, cached_lease=cached,
+                    resume_lease=resume and resume['lease'], on_event=self._process_event,
+                    netns=iface.netns)
+            self.task = run_task(self.client.run())
+            return
         cmd = [str(LIBDIR / 'udhcpc-wrapper.sh'), '-i', iface.name, '-f']
         if self.client_id:
             cmd += ['-c', self.client_id]
-        if self.request_ip:
-            cmd += ['-r', self.request_ip]
-        self.proc = yield from asyncio.create_subprocess_exec(*cmd, stdout=PIPE)
-        self.task = run_task(self._output_processor())
-        self.lease = None
+        if self.request_ip or resume:
+            cmd += ['-r', self.request_ip or resume['lease']['ip']]
+        self.proc = yield from supervisor.spawn('udhcpc ' + iface.name,
+                netns_command(iface.netns, cmd), restart=True,
+                on_start=self._udhcpc_started, stdout=PIPE)
 
     @asyncio.coroutine
     def stop(self):
         if not self.running: return
-        # Yes, kill. `udhcpc` should not have any persistent state and we don't want to
+        # Yes, kill. The client should not have any persistent state and we don't want to
         # send DHCPRELEASE.
         if self.start_task: yield from self.start_task
-        self.proc.kill()
-        self.task.cancel()
+        if self.proc is not None: yield from self.proc.stop(kill=True)
+        self.proc = None
+        if self.task is not None: self.task.cancel()
+        self.client = None
+        self._script_lease = None
         self.running = False
         self.lease = None
 
@@ -689,9 +2258,6 @@ class DHCPClient(RuleAbider):
         else: run_task(self.stop())
     _rbk_commit = commit
 
-    def __del__(self):
-        if self.active: self.proc.kill()
-
     def __repr__(self):
         iface = self.iface()
         return '<DHCPClient for %s, active=%d, cid=%s, req=%s, lease=%r>'%(iface.name if iface else '?',
@@ -0,0 +1,462 @@
+"""Network detection.
+
+`detect_dhcp` identifies the network an interface is connected to by sending
+a single DHCPDISCOVER (the offer is never accepted) and fingerprinting the
+DHCPOFFER. The network ID is computed exactly like ``netdet-dhcp-script.sh``
+does (router, subnet and the gateway's MAC address found by an ARP probe),
+so IDs stay the same as with the old scripts. Offers already seen before are
+recognized from a cache without the ARP probe.
+
+`detect` runs several such strategies concurrently (see `STRATEGIES`) and
+takes the first answer. Only the DHCP strategy can identify a network it has
+never seen; the others recognize networks from what was learned on earlier
+detections (the gateway's MAC address, the LLDP chassis ID of the switch, the
+BSSID of the access point) and answer much sooner when they can.
+"""
+
+import abc
+import time
+import socket
+import struct
+import random
+import hashlib
+import asyncio
+
+from .util import *
+from . import dhcp
+from .netns import netns_socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+ETH_P_IP = 0x0800
+ETH_P_ARP = 0x0806
+ETH_P_LLDP = 0x88cc
+ARP = struct.Struct('!HHBBH6s4s6s4s')
+ARP_REQUEST = 1
+ARP_REPLY = 2
+BROADCAST_MAC = b'\xff' * 6
+LLDP_MULTICAST = b'\x01\x80\xc2\x00\x00\x0e'
+LLDP_TLV_END = 0
+LLDP_TLV_CHASSIS_ID = 1
+
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_MULTICAST = 0
+
+# A DISCOVER takes about as long as a lease, but without the fake client ID hack.
+DISCOVER_TIMEOUTS = [2, 3]
+ARP_TIMEOUT = 1
+ARP_TRIES = 3
+
+
+class PacketSocket:
+    """An AF_PACKET datagram socket bound to one interface and EtherType.
+    Received ``(payload, source_mac)`` pairs are put into `queue`."""
+    def __init__(self, ifname, proto, netns=None):
+        self.ifname = ifname
+        self.proto = proto
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.sock = netns_socket(netns, socket.AF_PACKET, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK
+                                 | socket.SOCK_CLOEXEC, socket.htons(proto))
+        try:
+            self.sock.bind((ifname, proto))
+        except OSError:
+            self.sock.close()
+            raise
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.queue.put_nowait((data, addr[4][:6]))
+
+    def add_membership(self, mac):
+        """Receive frames sent to the multicast address `mac` (bytes)."""
+        mreq = struct.pack('iHH8s', socket.if_nametoindex(self.ifname),
+                           PACKET_MR_MULTICAST, len(mac), mac)
+        self.sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+
+    def send(self, data, dest=BROADCAST_MAC):
+        self.sock.sendto(data, (self.ifname, self.proto, 0, 0, dest))
+
+    @asyncio.coroutine
+    def recv(self, match, timeout):
+        """Return the first ``match(payload, source_mac)`` result that is not
+        None, or None after `timeout` seconds."""
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0: return None
+            try:
+                data, src = yield from asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            ret = match(data, src)
+            if ret is not None: return ret
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+def format_mac(mac):
+    # Upper case, like the ``arping`` output the netdet script used to parse.
+    return ':'.join('%02X' % b for b in mac)
+
+@asyncio.coroutine
+def arp_probe(ifname, mac, ip, timeout=ARP_TIMEOUT, tries=ARP_TRIES, netns=None):
+    """Find the MAC address of `ip` with an ARP probe from 0.0.0.0 (like
+    ``arping -D``), so that it works before we have an address. Returns the
+    MAC as a string or None."""
+    sock = PacketSocket(ifname, ETH_P_ARP, netns)
+    try:
+        target = socket.inet_aton(ip)
+        req = ARP.pack(1, ETH_P_IP, 6, 4, ARP_REQUEST, dhcp.mac_bytes(mac), b'\0'*4, b'\0'*6, target)
+        def match(data, src):
+            if len(data) < ARP.size: return None
+            htype, ptype, hlen, plen, op, sha, spa, tha, tpa = ARP.unpack_from(data)
+            if op == ARP_REPLY and spa == target: return sha
+        for i in range(tries):
+            sock.send(req)
+            sha = yield from sock.recv(match, timeout)
+            if sha is not None: return format_mac(sha)
+        return None
+    finally:
+        sock.close()
+
+@asyncio.coroutine
+def discover(ifname, mac, timeouts=DISCOVER_TIMEOUTS, netns=None):
+    """Send a DHCPDISCOVER and return ``(offer_vars, source_mac)`` for the first
+    DHCPOFFER, or None. The offer is never requested, so no lease is taken."""
+    # The OFFER is received on a packet socket to learn its link-layer source,
+    # the DISCOVER is sent from an ordinary UDP socket.
+    psock = PacketSocket(ifname, ETH_P_IP, netns)
+    usock = None
+    try:
+        usock = dhcp.DHCPSocket(ifname, mac, netns)
+        xid = random.getrandbits(32)
+        packet = dhcp.build_packet(dhcp.DHCPDISCOVER, xid, mac,
+                [(dhcp.OPT_CLIENT_ID, dhcp.encode_client_id(None, mac)),
+                 (dhcp.OPT_PARAM_REQ, dhcp.PARAMS)])
+        def match(data, src):
+            ihl = (data[0] & 0x0f) * 4 if data else 0
+            if len(data) < ihl + 8 or data[9] != socket.IPPROTO_UDP: return None
+            dport = struct.unpack_from('!H', data, ihl + 2)[0]
+            if dport != dhcp.CLIENT_PORT: return None
+            pkt = dhcp.parse_packet(data[ihl + 8:])
+            if pkt is None: return None
+            rxid, chaddr, yiaddr, opts = pkt
+            if rxid != xid or opts.get(dhcp.OPT_MSG_TYPE, b'\0')[0] != dhcp.DHCPOFFER: return None
+            return dhcp.lease_vars(yiaddr, opts), format_mac(src)
+        for timeout in timeouts:
+            usock.send(packet)
+            ret = yield from psock.recv(match, timeout)
+            if ret is not None: return ret
+        return None
+    finally:
+        if usock is not None: usock.close()
+        psock.close()
+
+
+def _fingerprint_cache():
+    from .libnetconf import PersistentStorage
+    return PersistentStorage('netdet')
+
+def _netid(router, subnet, macid):
+    # Same as ``echo "$router:$subnet:$macid" | md5sum | cut -c 1-6``
+    netstr = '%s:%s:%s' % (router, subnet, macid)
+    logger.debug('network ident string: %s', netstr)
+    return hashlib.md5((netstr + '\n').encode('utf-8')).hexdigest()[:6]
+
+@asyncio.coroutine
+def detect_dhcp(iface, obs=None):
+    """Detect the network on `iface` from a DHCPOFFER. Returns the netid or None.
+
+    If `obs` is given, the gateway found by the ARP probe is stored in it
+    (as ``obs['gateway'] = (ip, mac)``) so that `detect` can learn it."""
+    if obs is None: obs = {}
+    ret = yield from discover(iface.name, iface.mac, netns=iface.netns)
+    if ret is None:
+        logger.info('NETDET %s: no DHCP offer', iface.name)
+        return None
+    offer, src = ret
+    router = offer.get('router', '')
+    subnet = offer.get('subnet', '')
+    serverid = offer.get('serverid', '')
+    fp = '|'.join([serverid, router, subnet, src])
+
+    cache = _fingerprint_cache()
+    known = cache.fingerprints or {}
+    if fp in known:
+        logger.info('NETDET %s: known offer %s -> %s', iface.name, fp, known[fp])
+        return known[fp]
+
+    macid = None
+    if router:
+        gwip = router.split()[0]
+        gwmac = yield from arp_probe(iface.name, iface.mac, gwip, netns=iface.netns)
+        if gwmac:
+            macid = 'gw:' + gwmac
+            obs['gateway'] = (gwip, gwmac)
+    if macid is None and serverid:
+        dhcp_mac = yield from arp_probe(iface.name, iface.mac, serverid, netns=iface.netns)
+        if dhcp_mac: macid = 'dhcp:' + dhcp_mac
+    if macid is None:
+        return None
+
+    netid = _netid(router, subnet, macid)
+    known = dict(known)
+    known[fp] = netid
+    cache.fingerprints = known
+    cache.save()
+    logger.info('NETDET %s: new offer %s -> %s', iface.name, fp, netid)
+    return netid
+
+
+def parse_lldp_chassis(data):
+    """Return the Chassis ID TLV of a LLDPDU as ``'<subtype>:<hex id>'``, or None."""
+    offset = 0
+    while offset + 2 <= len(data):
+        hdr = struct.unpack_from('!H', data, offset)[0]
+        type, length = hdr >> 9, hdr & 0x1ff
+        body = data[offset + 2 : offset + 2 + length]
+        if type == LLDP_TLV_END: break
+        if type == LLDP_TLV_CHASSIS_ID and len(body) >= 2:
+            return '%d:%s' % (body[0], body[1:].hex())
+        offset += 2 + length
+    return None
+
+@asyncio.coroutine
+def lldp_listen(ifname, timeout, netns=None):
+    """Wait for a LLDP frame and return its chassis ID, or None after `timeout`."""
+    sock = PacketSocket(ifname, ETH_P_LLDP, netns)
+    try:
+        sock.add_membership(LLDP_MULTICAST)
+        return (yield from sock.recv(lambda data, src: parse_lldp_chassis(data), timeout))
+    finally:
+        sock.close()
+
+
+class Strategy(metaclass=abc.ABCMeta):
+    """A way of detecting the network. `run` returns a netid (only when sure) or
+    None; anything it finds out about the network along the way goes to the `obs`
+    dict. When some strategy succeeds, every strategy gets a chance to `learn`
+    the winning netid from what it observed."""
+    name = None
+    #: Seconds after which the strategy is given up.
+    timeout = 5
+    #: Keep running after another strategy has won, only to observe and learn
+    #: (for passive strategies that would otherwise never see anything).
+    learn_after_win = False
+
+    def applies(self, iface):
+        return True
+
+    @abc.abstractmethod
+    @asyncio.coroutine
+    def run(self, iface, obs):
+        pass
+
+    def learn(self, iface, obs, netid):
+        pass
+
+
+class DHCPStrategy(Strategy):
+    """Fingerprint a DHCPOFFER, see `detect_dhcp`."""
+    name = 'dhcp'
+    # The DISCOVER and, for a new offer, the ARP probes of the gateway and
+    # of the DHCP server, with a second to spare.
+    timeout = sum(DISCOVER_TIMEOUTS) + 2 * ARP_TIMEOUT * ARP_TRIES + 1
+
+    @asyncio.coroutine
+    def run(self, iface, obs):
+        return (yield from detect_dhcp(iface, obs))
+
+    def learn(self, iface, obs, netid):
+        if 'gateway' in obs:
+            cache = _fingerprint_cache()
+            gateways = dict(cache.gateways or {})
+            gateways[netid] = list(obs['gateway'])
+            cache.gateways = gateways
+            cache.save()
+
+
+class GatewayStrategy(Strategy):
+    """ARP-probe the gateways of the networks this interface was last connected
+    to; a gateway answering with the MAC address we know identifies its network."""
+    name = 'gateway'
+    timeout = 3
+    #: How many recently seen networks to try.
+    candidates = 3
+
+    def _candidates(self, iface):
+        cache = _fingerprint_cache()
+        gateways = cache.gateways or {}
+        recent = (cache.recent or {}).get(iface.mac, [])
+        return [ (netid, gateways[netid]) for netid in recent[:self.candidates]
+                 if netid in gateways ]
+
+    def applies(self, iface):
+        return bool(self._candidates(iface))
+
+    @asyncio.coroutine
+    def _probe(self, iface, netid, ip, mac):
+        found = yield from arp_probe(iface.name, iface.mac, ip, netns=iface.netns)
+        return netid if found == mac else None
+
+    @asyncio.coroutine
+    def run(self, iface, obs):
+        tasks = [ asyncio.Task(self._probe(iface, netid, ip, mac))
+                  for netid, (ip, mac) in self._candidates(iface) ]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                netid = yield from fut
+                if netid: return netid
+            return None
+        finally:
+            for task in tasks: task.cancel()
+
+
+class LLDPStrategy(Strategy):
+    """Recognize the switch we are connected to by its LLDP chassis ID. Switches
+    usually send LLDP every 30 seconds, so this only helps with those that send
+    it on link-up (most managed ones do)."""
+    name = 'lldp'
+    timeout = 35
+    learn_after_win = True
+
+    @asyncio.coroutine
+    def run(self, iface, obs):
+        chassis = yield from lldp_listen(iface.name, self.timeout, iface.netns)
+        if chassis is None: return None
+        obs['lldp'] = chassis
+        return (_fingerprint_cache().lldp or {}).get(chassis)
+
+    def learn(self, iface, obs, netid):
+        if 'lldp' in obs:
+            cache = _fingerprint_cache()
+            known = dict(cache.lldp or {})
+            if known.get(obs['lldp']) != netid:
+                known[obs['lldp']] = netid
+                cache.lldp = known
+                cache.save()
+
+
+class BSSIDStrategy(Strategy):
+    """Look up the BSSID we are associated to among the access points of known networks."""
+    name = 'bssid'
+    timeout = 1
+
+    def applies(self, iface):
+        return iface.wireless and bool(iface.wpa_supplicant.bssid)
+
+    @asyncio.coroutine
+    def run(self, iface, obs):
+        bssid = obs['bssid'] = iface.wpa_supplicant.bssid.lower()
+        return (_fingerprint_cache().bssids or {}).get(bssid)
+
+    def learn(self, iface, obs, netid):
+        if 'bssid' in obs:
+            cache = _fingerprint_cache()
+            known = dict(cache.bssids or {})
+            if known.get(obs['bssid']) != netid:
+                known[obs['bssid']] = netid
+                cache.bssids = known
+                cache.save()
+
+
+STRATEGIES = [DHCPStrategy(), GatewayStrategy(), LLDPStrategy(), BSSIDStrategy()]
+
+#: Per-strategy counters. `hits` counts runs that returned a netid (`hit_ms_*`
+#: is the time from the start of detection), `wins` those that were first.
+stats = {}
+
+def _stat(name):
+    return stats.setdefault(name, dict(runs=0, hits=0, wins=0, misses=0, timeouts=0, errors=0,
+                                       cancelled=0, hit_ms_total=0, hit_ms_last=None))
+
+def _remember(iface, netid):
+    cache = _fingerprint_cache()
+    recent = dict(cache.recent or {})
+    lst = [netid] + [ n for n in recent.get(iface.mac, []) if n != netid ]
+    recent[iface.mac] = lst[:GatewayStrategy.candidates]
+    cache.recent = recent
+    cache.save()
+
+@asyncio.coroutine
+def _run_strategy(strategy, iface, obs, start):
+    st = _stat(strategy.name)
+    st['runs'] += 1
+    try:
+        netid = yield from asyncio.wait_for(strategy.run(iface, obs), strategy.timeout)
+    except asyncio.TimeoutError:
+        st['timeouts'] += 1
+        logger.debug('NETDET %s: %s timed out', iface.name, strategy.name)
+        return None
+    except asyncio.CancelledError:
+        st['cancelled'] += 1
+        raise
+    except Exception:
+        st['errors'] += 1
+        logger.exception('NETDET %s: %s failed', iface.name, strategy.name)
+        return None
+    if not netid:
+        st['misses'] += 1
+        return None
+    ms = (time.monotonic() - start) * 1000
+    st['hits'] += 1
+    st['hit_ms_total'] += ms
+    st['hit_ms_last'] = ms
+    return netid
+
+@asyncio.coroutine
+def _finish_learning(tasks, iface, obs, netid):
+    yield from asyncio.wait(tasks)
+    for task, strategy in tasks.items():
+        strategy.learn(iface, obs[strategy], netid)
+
+@asyncio.coroutine
+def detect(iface, strategies=None):
+    """Run all applicable `strategies` (default `STRATEGIES`) concurrently and
+    return the netid found by the first one to succeed, or None if all fail.
+    The other strategies are cancelled, then all of them learn the result."""
+    if strategies is None: strategies = STRATEGIES
+    start = time.monotonic()
+    obs = { s: {} for s in strategies }
+    tasks = { asyncio.Task(_run_strategy(s, iface, obs[s], start)): s
+              for s in strategies if s.applies(iface) }
+    logger.info('NETDET %s: trying %s', iface.name, ', '.join(s.name for s in tasks.values()))
+    netid = winner = None
+    try:
+        pending = set(tasks)
+        while pending and netid is None:
+            done, pending = yield from asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() and netid is None:
+                    netid, winner = task.result(), tasks[task]
+    finally:
+        late = {}
+        for task, strategy in tasks.items():
+            if task.done(): continue
+            if netid is not None and strategy.learn_after_win:
+                late[task] = strategy
+            else:
+                task.cancel()
+    if netid is None:
+        logger.info('NETDET %s: nothing detected', iface.name)
+        return None
+    stats[winner.name]['wins'] += 1
+    logger.info('NETDET %s: %s detected %s in %.0f ms', iface.name, winner.name, netid,
+                stats[winner.name]['hit_ms_last'])
+    for strategy in set(tasks.values()):
+        if strategy not in late.values():
+            strategy.learn(iface, obs[strategy], netid)
+    if late:
+        run_task(_finish_learning(late, iface, obs, netid))
+    _remember(iface, netid)
+    return netid
@@ -0,0 +1,279 @@
+"""A minimal asyncio netlink client.
+
+Only the small subset of rtnetlink and generic netlink that Network Secretary
+needs is implemented.
+The socket is registered directly with the asyncio loop; requests are matched
+to replies by sequence number and everything else (multicast notifications)
+is handed to ``on_event``.
+"""
+
+import os
+import socket
+import struct
+import errno
+import asyncio
+
+from .netns import netns_socket
+
+import logging
+logger = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLMSG_OVERRUN = 4
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_WIRELESS = 11
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RTN_UNICAST = 1
+
+ARPHRD_ETHER = 1
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+CTRL_ATTR_MCAST_GROUPS = 7
+CTRL_ATTR_MCAST_GRP_NAME = 1
+CTRL_ATTR_MCAST_GRP_ID = 2
+
+NLMSGHDR = struct.Struct('=IHHII')
+NLATTR = struct.Struct('=HH')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTMSG = struct.Struct('=BBBBBBBBI')
+GENLMSGHDR = struct.Struct('=BBH')
+
+# Names as printed by iproute2 (``print_link_flags`` in ``ip/ipaddress.c``).
+IFF_NAMES = [
+    (0x1, 'UP'), (0x2, 'BROADCAST'), (0x4, 'DEBUG'), (0x8, 'LOOPBACK'),
+    (0x10, 'POINTOPOINT'), (0x20, 'NOTRAILERS'), (0x80, 'NOARP'),
+    (0x100, 'PROMISC'), (0x200, 'ALLMULTI'), (0x400, 'MASTER'), (0x800, 'SLAVE'),
+    (0x1000, 'MULTICAST'), (0x2000, 'PORTSEL'), (0x4000, 'AUTOMEDIA'),
+    (0x8000, 'DYNAMIC'), (0x10000, 'LOWER_UP'), (0x20000, 'DORMANT'), (0x40000, 'ECHO'),
+]
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+def pack_attr(type, data):
+    return NLATTR.pack(NLATTR.size + len(data), type) + data + b'\0' * (_align(len(data)) - len(data))
+
+def parse_attrs(data, offset=0):
+    """Parse a sequence of netlink attributes into a ``{type: payload}`` dict.
+    Nested attributes are left as raw bytes, parse them by another call."""
+    attrs = {}
+    while offset + NLATTR.size <= len(data):
+        length, type = NLATTR.unpack_from(data, offset)
+        if length < NLATTR.size: break
+        attrs[type & NLA_TYPE_MASK] = data[offset + NLATTR.size : offset + length]
+        offset += _align(length)
+    return attrs
+
+def attr_str(val):
+    return val.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+def format_mac(val):
+    return ':'.join('%02x' % b for b in val)
+
+def link_flags(flags):
+    """Convert ``ifi_flags`` to the set of flag names ``ip link`` would print."""
+    ret = { name for bit, name in IFF_NAMES if flags & bit }
+    if (flags & IFF_UP) and not (flags & IFF_RUNNING):
+        ret.add('NO-CARRIER')
+    return ret
+
+def parse_link(payload):
+    """Decode a RTM_NEWLINK/RTM_DELLINK payload. The returned ``mac`` is None
+    for non-Ethernet links, just like the ``link/ether`` match in the text parser."""
+    family, type, index, flags, change = IFINFOMSG.unpack_from(payload)
+    attrs = parse_attrs(payload, IFINFOMSG.size)
+    mac = None
+    if type == ARPHRD_ETHER and IFLA_ADDRESS in attrs:
+        mac = format_mac(attrs[IFLA_ADDRESS])
+    return dict(index=index, name=attr_str(attrs.get(IFLA_IFNAME, b'')), flags=link_flags(flags),
+                mac=mac, wireless_event=IFLA_WIRELESS in attrs)
+
+def parse_addr(payload):
+    """Decode an IPv4 RTM_NEWADDR/RTM_DELADDR payload."""
+    family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(payload)
+    attrs = parse_attrs(payload, IFADDRMSG.size)
+    local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if family != socket.AF_INET or local is None: return None
+    return dict(index=index, addr='%s/%d' % (socket.inet_ntoa(local), prefixlen))
+
+def parse_route(payload):
+    """Decode an IPv4 RTM_NEWROUTE/RTM_DELROUTE payload."""
+    (family, dst_len, src_len, tos, table, protocol,
+            scope, type, flags) = RTMSG.unpack_from(payload)
+    attrs = parse_attrs(payload, RTMSG.size)
+    if family != socket.AF_INET: return None
+    if RTA_TABLE in attrs:
+        table = struct.unpack('=I', attrs[RTA_TABLE])[0]
+    dst = socket.inet_ntoa(attrs[RTA_DST]) if RTA_DST in attrs else '0.0.0.0'
+    gw = attrs.get(RTA_GATEWAY)
+    oif = attrs.get(RTA_OIF)
+    prio = attrs.get(RTA_PRIORITY)
+    return dict(table=table, protocol=protocol, type=type,
+                dest='%s/%d' % (dst, dst_len),
+                via=socket.inet_ntoa(gw) if gw else None,
+                index=struct.unpack('=i', oif)[0] if oif else None,
+                metric=struct.unpack('=I', prio)[0] if prio else 0)
+
+
+class NetlinkError(OSError):
+    pass
+
+
+class NetlinkSocket:
+    """An asynchronous netlink socket.
+
+    ``request`` sends a message and returns a future resolving to the list of
+    ``(type, flags, payload)`` replies, which are told apart by sequence
+    number and port id. Everything else (including messages of other sockets
+    that happen to use the same sequence numbers) goes to ``on_event`` and a
+    receive buffer overrun (we lost some notifications) to ``on_overrun``.
+    The socket talks to network namespace `netns` (see `netns`).
+    """
+    RCVBUF = 1 << 20
+
+    def __init__(self, proto, groups=0, netns=None):
+        self.loop = asyncio.get_event_loop()
+        self.sock = netns_socket(netns, socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK
+                                 | socket.SOCK_CLOEXEC, proto)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        self.sock.bind((0, groups))
+        self.pid = self.sock.getsockname()[0]
+        self.seq = 0
+        self._pending = {}
+        self.on_event = None
+        self.on_overrun = None
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def add_membership(self, group):
+        self.sock.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, group)
+
+    def request(self, type, payload=b'', flags=0, dump=False):
+        self.seq += 1
+        flags |= NLM_F_REQUEST | (NLM_F_DUMP if dump else NLM_F_ACK)
+        fut = asyncio.Future(loop=self.loop)
+        self._pending[self.seq] = (fut, [])
+        msg = NLMSGHDR.pack(NLMSGHDR.size + len(payload), type, flags, self.seq, 0) + payload
+        try:
+            self.sock.send(msg)
+        except OSError as e:
+            del self._pending[self.seq]
+            fut.set_exception(e)
+        return fut
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    logger.warning("Netlink receive buffer overrun, some events were lost")
+                    if self.on_overrun: self.on_overrun()
+                    continue
+                raise
+            if not data: return
+            self._parse(data)
+
+    def _parse(self, data):
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length, type, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size: break
+            payload = data[offset + NLMSGHDR.size : offset + length]
+            offset += _align(length)
+            self._dispatch(type, flags, seq, pid, payload)
+
+    def _dispatch(self, type, flags, seq, pid, payload):
+        if type == NLMSG_NOOP: return
+        pending = self._pending.get(seq) if seq and pid == self.pid else None
+        if pending is None:
+            if type not in (NLMSG_ERROR, NLMSG_DONE) and self.on_event:
+                self.on_event(type, payload)
+            return
+        fut, replies = pending
+        done = False
+        if type == NLMSG_ERROR:
+            err = -struct.unpack_from('=i', payload)[0]
+            done = True
+            if err and not fut.done():
+                fut.set_exception(NetlinkError(err, os.strerror(err)))
+        elif type == NLMSG_DONE:
+            done = True
+        else:
+            replies.append((type, flags, payload))
+        if done:
+            del self._pending[seq]
+            if not fut.done(): fut.set_result(replies)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        for fut, replies in self._pending.values():
+            if not fut.done(): fut.cancel()
+        self._pending = {}
+
+
+@asyncio.coroutine
+def resolve_genl_family(sock, name):
+    """Look up a generic netlink family. Returns ``(family_id, {group_name: group_id})``."""
+    replies = yield from sock.request(GENL_ID_CTRL, GENLMSGHDR.pack(CTRL_CMD_GETFAMILY, 1, 0)
+            + pack_attr(CTRL_ATTR_FAMILY_NAME, name.encode('ascii') + b'\0'))
+    attrs = parse_attrs(replies[0][2], GENLMSGHDR.size)
+    family = struct.unpack('=H', attrs[CTRL_ATTR_FAMILY_ID])[0]
+    groups = {}
+    for grp in parse_attrs(attrs.get(CTRL_ATTR_MCAST_GROUPS, b'')).values():
+        grp = parse_attrs(grp)
+        groups[attr_str(grp[CTRL_ATTR_MCAST_GRP_NAME])] = struct.unpack('=I', grp[CTRL_ATTR_MCAST_GRP_ID])[0]
+    return family, groups
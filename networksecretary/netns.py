@@ -0,0 +1,87 @@
+"""Network namespaces as managed by ``ip netns`` (named by the files in
+``/run/netns``).
+
+Sockets belong to the namespace their creator was in when it created them,
+so `netns_socket` briefly switches the calling thread to the namespace with
+setns(2). Commands are run with ``ip netns exec`` or ``ip -n``. The name None
+stands for the daemon's own namespace everywhere.
+"""
+
+import os
+import fcntl
+import socket
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+from contextlib import contextmanager
+
+CLONE_NEWNET = 0x40000000
+SIOCGIWNAME = 0x8B01
+
+NETNS_RUN_DIR = Path('/run/netns')
+
+_libc = None
+
+def _setns(fd):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if _libc.setns(fd, CLONE_NEWNET) < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+@contextmanager
+def entered(name):
+    """A context manager that runs its body in namespace `name`."""
+    if name is None:
+        yield
+        return
+    own = os.open('/proc/thread-self/ns/net', os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        target = os.open(str(NETNS_RUN_DIR / name), os.O_RDONLY | os.O_CLOEXEC)
+        try: _setns(target)
+        finally: os.close(target)
+        try:
+            yield
+        finally:
+            _setns(own)
+    finally:
+        os.close(own)
+
+def netns_socket(name, *args):
+    """Like ``socket.socket(*args)``, in namespace `name`."""
+    with entered(name):
+        return socket.socket(*args)
+
+def netns_command(name, argv):
+    """`argv` wrapped so that it runs in namespace `name`."""
+    if name is None: return list(argv)
+    return ['ip', 'netns', 'exec', name] + list(argv)
+
+def ip_netns_args(name):
+    """Options to make ``ip`` work in namespace `name`."""
+    return [] if name is None else ['-n', name]
+
+def storage_key(name, key):
+    """The PersistentStorage key for `key` in namespace `name`. Keys of the
+    daemon's own namespace are left as they are."""
+    return key if name is None else 'netns.%s.%s' % (name, key)
+
+def list_netns():
+    try:
+        return sorted(fn.name for fn in NETNS_RUN_DIR.iterdir())
+    except FileNotFoundError:
+        return []
+
+def is_wireless(name, ifname):
+    """Whether interface `ifname` in namespace `name` is wireless. (Sysfs
+    only shows the interfaces of our own namespace.)"""
+    sock = netns_socket(name, socket.AF_INET, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+    try:
+        fcntl.ioctl(sock, SIOCGIWNAME, struct.pack('16s16x', ifname.encode('utf-8')))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
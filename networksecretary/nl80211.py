@@ -0,0 +1,216 @@
+"""Wireless scanning over nl80211 (generic netlink).
+
+This replaces screen-scraping ``iw scan`` output. One shared socket listens
+on the nl80211 ``scan`` multicast group; whenever the kernel announces new
+scan results for an interface we are interested in (no matter who triggered
+the scan), the BSS list is dumped, decoded into the same kind of dicts that
+``parse_iw_scan.pl`` used to produce and handed to the registered callback.
+"""
+
+import struct
+import asyncio
+
+from .util import *
+from . import netlink
+
+import logging
+logger = logging.getLogger(__name__)
+
+NL80211_CMD_GET_SCAN = 32
+NL80211_CMD_TRIGGER_SCAN = 33
+NL80211_CMD_NEW_SCAN_RESULTS = 34
+NL80211_CMD_SCAN_ABORTED = 35
+
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_SCAN_SSIDS = 45
+NL80211_ATTR_BSS = 47
+
+NL80211_BSS_BSSID = 1
+NL80211_BSS_FREQUENCY = 2
+NL80211_BSS_CAPABILITY = 5
+NL80211_BSS_INFORMATION_ELEMENTS = 6
+NL80211_BSS_SIGNAL_MBM = 7
+NL80211_BSS_BEACON_IES = 11
+
+WLAN_CAPABILITY_PRIVACY = 0x10
+
+IE_SSID = 0
+IE_RSN = 48
+IE_VENDOR = 221
+WPA_OUI = b'\x00\x50\xf2\x01'
+
+AKM_NAMES = {
+    1: '802.1x', 2: 'psk', 3: 'ft/802.1x', 4: 'ft/psk', 5: '802.1x/sha-256',
+    6: 'psk/sha-256', 8: 'sae', 9: 'ft/sae', 18: 'owe',
+}
+
+
+def _parse_ies(data):
+    ies = []
+    offset = 0
+    while offset + 2 <= len(data):
+        id, length = data[offset], data[offset + 1]
+        ies.append((id, data[offset + 2 : offset + 2 + length]))
+        offset += 2 + length
+    return ies
+
+def _parse_akms(body):
+    """Parse the body of a RSN IE (or the WPA vendor IE after the OUI)
+    and return the names of the authentication suites."""
+    # version(2) group_cipher(4) pairwise_count(2) pairwise(4*n) akm_count(2) akm(4*n)
+    offset = 2 + 4
+    if len(body) < offset + 2: return ['802.1x']
+    count = struct.unpack_from('<H', body, offset)[0]
+    offset += 2 + 4 * count
+    if len(body) < offset + 2: return ['802.1x']
+    count = struct.unpack_from('<H', body, offset)[0]
+    offset += 2
+    ret = []
+    for i in range(count):
+        suite = body[offset + 4*i : offset + 4*i + 4]
+        if len(suite) < 4: break
+        ret.append(AKM_NAMES.get(suite[3], '%s:%d' % (netlink.format_mac(suite[:3]), suite[3])))
+    return ret
+
+def decode_bss(payload):
+    """Decode one NL80211_CMD_NEW_SCAN_RESULTS dump message into a dict with
+    the keys ``bssid``, ``essid``, ``auth``, ``enc``, ``freq`` and ``signal`` (dBm)."""
+    attrs = netlink.parse_attrs(payload, netlink.GENLMSGHDR.size)
+    if NL80211_ATTR_BSS not in attrs: return None
+    bss = netlink.parse_attrs(attrs[NL80211_ATTR_BSS])
+    if NL80211_BSS_BSSID not in bss: return None
+    data = {'bssid': netlink.format_mac(bss[NL80211_BSS_BSSID])}
+    if NL80211_BSS_FREQUENCY in bss:
+        data['freq'] = struct.unpack('=I', bss[NL80211_BSS_FREQUENCY])[0]
+    if NL80211_BSS_SIGNAL_MBM in bss:
+        data['signal'] = struct.unpack('=i', bss[NL80211_BSS_SIGNAL_MBM])[0] / 100
+    privacy = False
+    if NL80211_BSS_CAPABILITY in bss:
+        privacy = bool(struct.unpack('=H', bss[NL80211_BSS_CAPABILITY])[0] & WLAN_CAPABILITY_PRIVACY)
+
+    auth = set()
+    enc = set()
+    essid = None
+    for id, body in _parse_ies(bss.get(NL80211_BSS_INFORMATION_ELEMENTS)
+                               or bss.get(NL80211_BSS_BEACON_IES, b'')):
+        if id == IE_SSID and essid is None:
+            essid = body.decode('utf-8', 'replace')
+        elif id == IE_RSN:
+            enc.add('rsn')
+            auth.update(_parse_akms(body))
+        elif id == IE_VENDOR and body[:4] == WPA_OUI:
+            enc.add('wpa')
+            auth.update(_parse_akms(body[4:]))
+    # XXX Can WPA and WEP be both allowed on one AP? I have not found any other criterion
+    #     for WEP APs than that they have the Privacy capability and do not have WPA/RSN.
+    if privacy and not enc:
+        auth.add('wep')
+    data['essid'] = essid or ''
+    data['auth'] = sorted(auth)
+    data['enc'] = sorted(enc)
+    return data
+
+
+class ScanMonitor:
+    """Triggers nl80211 scans and delivers their results.
+
+    Interfaces `register` a callback that receives the full list of decoded BSSes
+    each time new scan results are available for them, including results of scans
+    triggered by someone else (e.g. wpa_supplicant).
+    """
+    RESULT_TIMEOUT = 15
+
+    def __init__(self):
+        self._sock = None
+        self._family = None
+        self._listeners = {}
+        self._waiters = {}
+
+    @asyncio.coroutine
+    def start(self):
+        self._sock = netlink.NetlinkSocket(netlink.NETLINK_GENERIC)
+        self._family, groups = yield from netlink.resolve_genl_family(self._sock, 'nl80211')
+        self._sock.add_membership(groups['scan'])
+        self._sock.on_event = self._on_event
+
+    def _msg(self, cmd, ifindex, attrs=b''):
+        return (netlink.GENLMSGHDR.pack(cmd, 0, 0)
+                + netlink.pack_attr(NL80211_ATTR_IFINDEX, struct.pack('=I', ifindex)) + attrs)
+
+    def register(self, ifindex, callback):
+        self._listeners[ifindex] = callback
+
+    def unregister(self, ifindex):
+        self._listeners.pop(ifindex, None)
+
+    def _on_event(self, type, payload):
+        if type != self._family: return
+        cmd = payload[0]
+        attrs = netlink.parse_attrs(payload, netlink.GENLMSGHDR.size)
+        if NL80211_ATTR_IFINDEX not in attrs: return
+        ifindex = struct.unpack('=I', attrs[NL80211_ATTR_IFINDEX])[0]
+        if cmd == NL80211_CMD_NEW_SCAN_RESULTS:
+            if ifindex in self._listeners or ifindex in self._waiters:
+                run_task(self._fetch(ifindex))
+        elif cmd == NL80211_CMD_SCAN_ABORTED:
+            self._wake(ifindex, OSError('Scan aborted'))
+
+    def _wake(self, ifindex, exc=None):
+        for fut in self._waiters.pop(ifindex, []):
+            if fut.done(): continue
+            if exc: fut.set_exception(exc)
+            else: fut.set_result(None)
+
+    @asyncio.coroutine
+    def _fetch(self, ifindex):
+        try:
+            replies = yield from self._sock.request(self._family,
+                    self._msg(NL80211_CMD_GET_SCAN, ifindex), dump=True)
+        except OSError as e:
+            logger.error('Getting scan results for interface %d failed: %s', ifindex, e)
+            self._wake(ifindex, e)
+            return
+        results = [ bss for bss in (decode_bss(payload) for type, flags, payload in replies)
+                    if bss is not None ]
+        callback = self._listeners.get(ifindex)
+        if callback: callback(results)
+        self._wake(ifindex)
+
+    @asyncio.coroutine
+    def scan(self, ifindex):
+        """Trigger a scan and wait until its results have been delivered. Raises
+        OSError on failure (e.g. EBUSY when another scan is in progress)."""
+        fut = asyncio.Future()
+        self._waiters.setdefault(ifindex, []).append(fut)
+        # An active scan: the empty (wildcard) SSID makes the kernel send probe requests.
+        ssids = netlink.pack_attr(NL80211_ATTR_SCAN_SSIDS | netlink.NLA_F_NESTED,
+                                  netlink.pack_attr(1, b''))
+        try:
+            yield from self._sock.request(self._family,
+                    self._msg(NL80211_CMD_TRIGGER_SCAN, ifindex, ssids))
+        except OSError:
+            self._waiters[ifindex].remove(fut)
+            raise
+        yield from asyncio.wait_for(fut, self.RESULT_TIMEOUT)
+
+
+_scan_monitor = None
+_scan_monitor_lock = None
+
+@asyncio.coroutine
+def get_scan_monitor():
+    """Return the shared ScanMonitor, or None if nl80211 is not available."""
+    global _scan_monitor, _scan_monitor_lock
+    # Not created at import time, when the event loop may not exist yet.
+    if _scan_monitor_lock is None: _scan_monitor_lock = asyncio.Lock()
+    with (yield from _scan_monitor_lock):
+        if _scan_monitor is None:
+            mon = ScanMonitor()
+            try:
+                yield from mon.start()
+            except (OSError, KeyError) as e:
+                logger.warning('nl80211 not available (%s), falling back to wl-scan.sh', e)
+                if mon._sock is not None: mon._sock.close()
+                mon = False
+            _scan_monitor = mon
+    return _scan_monitor or None
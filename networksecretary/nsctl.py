@@ -1,29 +1,133 @@
 import sys, os, argparse
+import ast
+import json
+import socket
 from .util import *
 
 parser = argparse.ArgumentParser()
 subparsers = parser.add_subparsers(dest='cmd')
 
+class CtlClient:
+    """A connection to the daemon's control socket, see `networksecretary.ctl`."""
+    def __init__(self, path=RUNDIR / 'ctl.sock'):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(str(path))
+        except OSError as e:
+            sys.exit('nsctl: cannot connect to %s: %s' % (path, e))
+        self.file = self.sock.makefile('rwb')
 
+    def send(self, msg):
+        self.file.write(json.dumps(msg).encode('utf-8') + b'\n')
+        self.file.flush()
 
+    def recv(self):
+        line = self.file.readline()
+        if not line: raise EOFError('Connection closed by the daemon')
+        return json.loads(line.decode('utf-8'))
+
+    def request(self, *reqs):
+        """Send the requests in one batch and return their results. Exits
+        with an error message if any of them fails."""
+        self.send(list(reqs))
+        resps = self.recv()
+        for resp in resps:
+            if not resp['ok']:
+                sys.exit('nsctl: %s' % resp['error'])
+        return [ resp['result'] for resp in resps ]
+
+def _print_value(value, indent=None):
+    if isinstance(value, str): print(value)
+    else: print(json.dumps(value, indent=indent, sort_keys=True))
+
+p_get = subparsers.add_parser('get')
+p_get.add_argument('--depth', type=int, default=0, help='Expand objects this many levels deep.')
+p_get.add_argument('names', metavar='NAME', nargs='+', help='E.g. ``ns.ifaces.wlan0.netid``.')
+
+def do_get(names, depth):
+    results = CtlClient().request(*[ {'cmd': 'get', 'path': name, 'depth': depth}
+                                     for name in names ])
+    if len(names) == 1:
+        _print_value(results[0])
+    else:
+        for name, value in zip(names, results):
+            print(name, json.dumps(value, sort_keys=True))
+
+p_dump = subparsers.add_parser('dump')
+p_dump.add_argument('--depth', type=int, default=3)
+p_dump.add_argument('name', metavar='NAME', nargs='?', default='ns')
+
+def do_dump(name, depth):
+    _print_value(CtlClient().request({'cmd': 'dump', 'path': name, 'depth': depth})[0], indent=2)
+
+p_watch = subparsers.add_parser('watch')
+p_watch.add_argument('--depth', type=int, default=0)
+p_watch.add_argument('--interval', type=float, default=None,
+        help='Report each path at most once per this many seconds.')
+p_watch.add_argument('names', metavar='NAME', nargs='+',
+        help='Paths to watch, ``*`` matches all items, e.g. ``ns.ifaces.*.netid``.')
+
+def do_watch(names, depth, interval):
+    client = CtlClient()
+    client.request(*[ {'cmd': 'subscribe', 'path': name, 'depth': depth, 'interval': interval}
+                      for name in names ])
+    try:
+        while True:
+            msg = client.recv()
+            if not isinstance(msg, dict): continue
+            if msg.get('event') == 'change':
+                print(msg['path'], json.dumps(msg['value'], sort_keys=True), flush=True)
+            elif msg.get('event') == 'overflow':
+                print('nsctl: too slow, %d changes lost, resyncing' % msg['dropped'],
+                      file=sys.stderr, flush=True)
+    except (EOFError, KeyboardInterrupt):
+        pass
 
 p_console = subparsers.add_parser('console')
 
 def do_console():
-    os.execlp('ipython', 'ipython', 'console', '--existing', str(RUNDIR / 'ipython.json'))
+    # The daemon only starts the IPython kernel when it is first asked for it.
+    connection_file = CtlClient().request({'cmd': 'console'})[0]
+    os.execlp('ipython', 'ipython', 'console', '--existing', connection_file)
+
+p_procs = subparsers.add_parser('procs')
+
+def do_procs():
+    procs = CtlClient().request({'cmd': 'procs'})[0]
+    print('%-28s %7s %9s %9s %8s %9s' % ('NAME', 'PID', 'CPU', 'RSS', 'RESTARTS', 'UPTIME'))
+    for proc in procs:
+        print('%-28s %7s %8.2fs %8.1fM %8d %8.0fs' % (proc['name'], proc['pid'], proc['cpu'] or 0,
+              (proc['rss'] or 0) / 2**20, proc['restarts'], proc['uptime'] or 0))
 
 p_set = subparsers.add_parser('set')
 p_set.add_argument('-e', dest='type', default='auto', action='store_const', const='eval',
-        help='treat VALUE as a Python expression')
+        help='treat VALUE as a Python literal')
 p_set.add_argument('-s', dest='type', action='store_const', const='str',
         help='treat VALUE as a string')
+p_set.add_argument('--prio', type=int, default=1000,
+        help='The priority of the value (default 1000, i.e. above the default rules).')
+p_set.add_argument('--unset', action='store_true',
+        help='Remove the value set before instead (VALUE is ignored).')
 p_set.add_argument('name', metavar='NAME', help='The variable/attribute to assign to. E.g. ``ns.ifaces.wlan0.up``.')
-p_set.add_argument('value', metavar='VALUE', help='The value to assign. True/False/None, numbers,'
-        ' lists, dicts and anything in parentheses are parsed as Python expressions (with `eval`).'
-        ' Anything else is treated as a verbatim string. See the `-e` and `-s` options.')
+p_set.add_argument('value', metavar='VALUE', nargs='?', help='The value to assign. True/False/None, numbers,'
+        ' strings in quotes, lists, sets, dicts and tuples are parsed as Python literals (with'
+        ' `ast.literal_eval`). Anything else is treated as a verbatim string. See the `-e` and'
+        ' `-s` options.')
 
-def do_set(name, value, type):
-    pass
+def do_set(name, value, type, prio, unset):
+    if unset:
+        CtlClient().request({'cmd': 'unset', 'path': name})
+        return
+    if value is None:
+        p_set.error('VALUE is required')
+    req = {'cmd': 'set', 'path': name, 'prio': prio}
+    if type == 'auto':
+        try: ast.literal_eval(value)
+        except (ValueError, SyntaxError): type = 'str'
+        else: type = 'eval'
+    if type == 'eval': req['expr'] = value
+    else: req['value'] = value
+    CtlClient().request(req)
 
 def main():
     args = parser.parse_args()
@@ -0,0 +1,281 @@
+"""Storage engine behind PersistentStorage.
+
+A backend knows how to read and write records (plain JSON-serializable dicts)
+by key. `Storage` sits in front of it, keeps dirty records in memory and writes
+them out in batches in the background.
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+
+from .util import *
+
+import logging
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('never', 'batch', 'always')
+
+def fsync_dir(dir):
+    """Make the renames in `dir` durable."""
+    fd = os.open(str(dir), os.O_RDONLY | os.O_DIRECTORY)
+    try: os.fsync(fd)
+    finally: os.close(fd)
+
+
+class FileBackend:
+    """One ``<key>.json`` file per record in a directory. This is the original
+    layout of DATA_DIR.
+
+    The directory is listed once and the set of existing keys is kept in memory,
+    so lookups of keys that do not exist (which is most ESSIDs seen in scans)
+    don't touch the filesystem at all.
+    """
+    def __init__(self, dir):
+        self.dir = Path(dir)
+        self._keys = None
+
+    def _filename(self, key):
+        return self.dir / (key + '.json')
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = { p.name[:-len('.json')] for p in self.dir.glob('*.json') }
+        return self._keys
+
+    def exists(self, key):
+        return key in self.keys()
+
+    def load(self, key):
+        if not self.exists(key): return None
+        try:
+            with self._filename(key).open('r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            self.keys().discard(key)
+            return None
+
+    def write(self, records, fsync='batch'):
+        """Write a ``{key: data}`` dict of records. Each file is replaced atomically."""
+        for key, data in records.items():
+            fn = str(self._filename(key))
+            with open(fn + '.tmp', 'w') as file:
+                json.dump(data, file)
+                file.write('\n') # everybody hates files without final newlines (especially cats ;-))
+                if fsync == 'always':
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.rename(fn + '.tmp', fn)
+            self.keys().add(key)
+        if fsync != 'never' and records:
+            # One fsync of the directory makes all the renames durable.
+            fsync_dir(self.dir)
+
+    def close(self):
+        pass
+
+
+class LogBackend:
+    """All records in a single append-only log file with an in-memory index.
+
+    Every write appends one ``{"k": key, "v": data}`` JSON line. The whole log
+    is read once when the backend is opened; later records override earlier
+    ones. A partially written last line (a crash in the middle of a write) is
+    ignored and cut off, other malformed lines are skipped. When the log grows
+    to more than `COMPACT_RATIO` times the number of live records, it is
+    rewritten with only the live ones.
+
+    If the log does not exist yet, records from the per-file layout in the same
+    directory are imported and the old files moved to ``migrated/``.
+    """
+    COMPACT_RATIO = 4
+    COMPACT_MIN = 256
+
+    def __init__(self, dir, name='store.log'):
+        self.dir = Path(dir)
+        self.path = self.dir / name
+        self._index = {}
+        self._entries = 0
+        if not self.path.exists():
+            self._migrate()
+        self._open()
+
+    def _migrate(self):
+        old = FileBackend(self.dir)
+        keys = sorted(old.keys())
+        for key in keys:
+            data = old.load(key)
+            if data is not None:
+                self._index[key] = data
+        self._compact()
+        if keys:
+            logger.info("Migrated %d records from %s to %s", len(keys), self.dir, self.path)
+            migrated = self.dir / 'migrated'
+            if not migrated.exists(): migrated.mkdir(0o700)
+            for key in keys:
+                fn = old._filename(key)
+                os.rename(str(fn), str(migrated / fn.name))
+            fsync_dir(migrated)
+            fsync_dir(self.dir)
+
+    def _open(self):
+        good = 0
+        self._index = {}
+        self._entries = 0
+        with self.path.open('rb') as file:
+            for lineno, line in enumerate(file, 1):
+                if not line.endswith(b'\n'): break
+                good += len(line)
+                try:
+                    rec = json.loads(line.decode('utf-8'))
+                    self._index[rec['k']] = rec['v']
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning("Skipping malformed record at %s:%d (%r)", self.path, lineno, e)
+                    continue
+                self._entries += 1
+        self._file = self.path.open('ab')
+        if self._file.tell() != good:
+            logger.warning("Discarding %d bytes of garbage at the end of %s",
+                           self._file.tell() - good, self.path)
+            self._file.truncate(good)
+        logger.debug("Loaded %d records (%d log entries) from %s",
+                     len(self._index), self._entries, self.path)
+
+    def _compact(self):
+        with rewrite_file(self.path) as file:
+            for key, data in self._index.items():
+                file.write(json.dumps({'k': key, 'v': data}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        # Make the rename durable too, or after a crash the old log could be
+        # back, without what is appended to the new one from now on.
+        fsync_dir(self.dir)
+        self._entries = len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def exists(self, key):
+        return key in self._index
+
+    def load(self, key):
+        return self._index.get(key)
+
+    def write(self, records, fsync='batch'):
+        for key, data in records.items():
+            self._file.write((json.dumps({'k': key, 'v': data}) + '\n').encode('utf-8'))
+            if fsync == 'always':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._index[key] = data
+            self._entries += 1
+        self._file.flush()
+        if fsync == 'batch':
+            os.fsync(self._file.fileno())
+        if self._entries > max(self.COMPACT_MIN, self.COMPACT_RATIO * len(self._index)):
+            logger.info("Compacting %s (%d entries, %d live)", self.path, self._entries, len(self._index))
+            self._file.close()
+            self._compact()
+            self._file = self.path.open('ab')
+
+    def close(self):
+        self._file.close()
+
+BACKENDS = {
+    'files': FileBackend,
+    'log': LogBackend,
+}
+
+
+class Storage:
+    """Write-coalescing cache in front of a backend.
+
+    `save` only remembers the record; all records saved within `flush_delay`
+    seconds are written in one batch in a worker thread. Saving the same key
+    several times within the window results in a single write. Call `flush`
+    before exiting to write out whatever is still pending.
+
+    Writes to the backend never overlap (`_write_lock`), whether they come
+    from the worker thread or from `flush`. Records of a failed background
+    write are queued again, unless they were saved anew in the meantime.
+    """
+    def __init__(self, backend, flush_delay=2.0, fsync='batch'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Invalid fsync policy: %r" % fsync)
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.fsync = fsync
+        self._dirty = {}
+        self._inflight = {}
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self._write_lock = threading.Lock()
+        self.stats = dict(saves=0, writes=0, flushes=0, last_flush_ms=0, max_flush_ms=0)
+
+    def exists(self, key):
+        return key in self._dirty or key in self._inflight or self.backend.exists(key)
+
+    def load(self, key):
+        if key in self._dirty: return self._dirty[key]
+        if key in self._inflight: return self._inflight[key]
+        return self.backend.load(key)
+
+    def save(self, key, data):
+        self.stats['saves'] += 1
+        # Take a snapshot, the caller may go on modifying the objects inside. This
+        # also makes unserializable data fail right here and not in the writer.
+        self._dirty[key] = json.loads(json.dumps(data))
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.flush_delay, self._flush_bg)
+
+    def _write(self, records):
+        start = time.monotonic()
+        with self._write_lock:
+            self.backend.write(records, self.fsync)
+        ms = (time.monotonic() - start) * 1000
+        self.stats['writes'] += len(records)
+        self.stats['flushes'] += 1
+        self.stats['last_flush_ms'] = ms
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], ms)
+        logger.debug('Flushed %d records in %.1f ms (%d saves, %d writes so far)',
+                     len(records), ms, self.stats['saves'], self.stats['writes'])
+
+    def _flush_bg(self):
+        self._timer = None
+        run_task(self._flush_async())
+
+    @asyncio.coroutine
+    def _flush_async(self):
+        with (yield from self._lock):
+            records, self._dirty = self._dirty, {}
+            if not records: return
+            self._inflight = records
+            try:
+                yield from asyncio.get_event_loop().run_in_executor(None, self._write, records)
+            except Exception:
+                logger.exception('Writing %d records failed, will retry', len(records))
+                for key, data in records.items():
+                    self._dirty.setdefault(key, data)
+                if self._timer is None:
+                    self._timer = asyncio.get_event_loop().call_later(self.flush_delay, self._flush_bg)
+            finally:
+                self._inflight = {}
+
+    def flush(self):
+        """Synchronously write all pending records (to be used on shutdown)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # A background write may still be running (it is waited for by
+        # `_write`) or about to fail, so its records are written again.
+        records = dict(self._inflight)
+        records.update(self._dirty)
+        self._dirty = {}
+        if records:
+            self._write(records)
+
+    def close(self):
+        self.flush()
+        self.backend.close()
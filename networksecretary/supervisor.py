@@ -0,0 +1,277 @@
+"""Supervision of the child processes of the daemon.
+
+Every process the daemon runs (wpa_supplicant, udhcpc, ``ip`` and the helper
+scripts) is started through the `supervisor`. It waits for each one to exit,
+so none is left behind as a zombie, starts long-running ones again when they
+die, limits how many short-lived helpers run at once and stops whatever is
+left when the daemon exits (`Supervisor.shutdown`). `Supervisor.usage`
+reports the CPU time and memory of the running processes and how many times
+each was restarted.
+"""
+
+import os
+import time
+import signal
+import asyncio
+from asyncio.subprocess import PIPE, DEVNULL
+
+from .util import *
+
+import logging
+logger = logging.getLogger(__name__)
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def proc_usage(pid):
+    """``(cpu_seconds, rss_bytes)`` of process `pid`, or None if it is gone.
+    The CPU time includes the children it has waited for (e.g. the commands
+    run by a shell script)."""
+    try:
+        with open('/proc/%d/stat' % pid) as file:
+            stat = file.read()
+        with open('/proc/%d/statm' % pid) as file:
+            statm = file.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # Skip the pid and the command name, which may contain spaces; the rest
+    # starts with field 3 (state) of proc(5).
+    fields = stat[stat.rindex(')') + 2:].split()
+    utime, stime, cutime, cstime = map(int, fields[11:15])
+    return (utime + stime + cutime + cstime) / _CLK_TCK, int(statm.split()[1]) * _PAGE_SIZE
+
+
+class Process:
+    """A child process started by `Supervisor.spawn`.
+
+    `proc` is the asyncio.subprocess.Process of the current run. With
+    `restart` set, the process is started again whenever it exits without
+    being stopped, after `Supervisor.RESTART_MIN` seconds, doubling up to
+    `RESTART_MAX` as long as it keeps dying within `RESTART_RESET` seconds.
+    ``on_start(process)`` is called after every start (with `restarts` 0 for
+    the first one), e.g. to read the new pipes, and ``on_exit(process)`` after
+    every exit (with `stopping` set if it was asked to). Exceptions from
+    these callbacks are logged and otherwise ignored.
+
+    With ``start_new_session``, signals go to the whole process group, so that
+    the commands of a pipeline in a script do not outlive it.
+    """
+    def __init__(self, supervisor, name, argv, restart, group, on_start, on_exit, kwargs):
+        self.supervisor = supervisor
+        self.name = name
+        self.argv = list(argv)
+        self.restart = restart
+        self.group = group
+        self.on_start = on_start
+        self.on_exit = on_exit
+        self._kwargs = kwargs
+        self.proc = None
+        self.pid = None
+        self.returncode = None
+        self.started = None
+        self.restarts = 0
+        self.stopping = False
+        self._slot = None
+        self._task = None
+        self._done = asyncio.Event()
+
+    @property
+    def running(self):
+        return self.pid is not None
+
+    @asyncio.coroutine
+    def _exec(self):
+        slot = self.supervisor._slot(self.group)
+        if slot is not None: yield from slot.acquire()
+        try:
+            self.proc = yield from asyncio.create_subprocess_exec(*self.argv, **self._kwargs)
+        except:
+            if slot is not None: slot.release()
+            raise
+        self._slot = slot
+        self.pid = self.proc.pid
+        self.started = time.monotonic()
+        self.returncode = None
+        logger.debug('Started %s (%d): %s', self.name, self.pid, ' '.join(self.argv))
+        self._callback(self.on_start)
+
+    def _callback(self, func):
+        if func is None: return
+        try:
+            func(self)
+        except Exception:
+            logger.exception('Callback %r of %s failed', func, self.name)
+
+    def _release(self):
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+    @asyncio.coroutine
+    def _supervise(self):
+        sup = self.supervisor
+        backoff = sup.RESTART_MIN
+        try:
+            while True:
+                try:
+                    self.returncode = yield from self.proc.wait()
+                finally:
+                    self._release()
+                self.pid = None
+                ran = time.monotonic() - self.started
+                self._callback(self.on_exit)
+                if self.stopping or not self.restart:
+                    logger.debug('%s exited with code %d', self.name, self.returncode)
+                    return
+                if ran >= sup.RESTART_RESET: backoff = sup.RESTART_MIN
+                logger.warning('%s exited with code %d after %.1f s, restarting in %.1f s',
+                               self.name, self.returncode, ran, backoff)
+                while True:
+                    yield from asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, sup.RESTART_MAX)
+                    self.restarts += 1
+                    sup.stats['restarts'] += 1
+                    try:
+                        yield from self._exec()
+                        break
+                    except OSError as e:
+                        logger.error('Restarting %s failed: %s', self.name, e)
+                    except Exception:
+                        logger.exception('Restarting %s failed', self.name)
+        except asyncio.CancelledError:
+            pass # By `stop` while waiting to restart, or by `detach`.
+        finally:
+            self._release()
+            sup._procs.discard(self)
+            self._done.set()
+
+    def send_signal(self, sig):
+        if self.pid is None: return
+        try:
+            if self._kwargs.get('start_new_session'):
+                os.killpg(self.pid, sig)
+            else:
+                self.proc.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        """Like `stop` but does not wait for the process to exit."""
+        self.stopping = True
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.stopping = True
+        self.send_signal(signal.SIGKILL)
+
+    @asyncio.coroutine
+    def stop(self, kill=False):
+        """Stop the process for good: send it SIGTERM (SIGKILL with `kill`),
+        followed by SIGKILL if it has not exited in `Supervisor.STOP_TIMEOUT`
+        seconds, and wait for it."""
+        self.stopping = True
+        if self.pid is None:
+            # Waiting to be restarted.
+            if self._task is not None: self._task.cancel()
+        else:
+            self.send_signal(signal.SIGKILL if kill else signal.SIGTERM)
+            try:
+                yield from asyncio.wait_for(self._done.wait(), self.supervisor.STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning('%s (%d) did not exit, killing it', self.name, self.pid)
+                self.send_signal(signal.SIGKILL)
+        yield from self._done.wait()
+
+    @asyncio.coroutine
+    def wait(self):
+        """Wait until the process has exited for good. Returns its exit code."""
+        yield from self._done.wait()
+        return self.returncode
+
+    def detach(self):
+        """Stop looking after the process, leaving it running."""
+        self.stopping = True
+        if self._task is not None: self._task.cancel()
+
+    def __repr__(self):
+        return '<Process %s, pid=%s, restarts=%d>' % (self.name, self.pid, self.restarts)
+
+
+class Supervisor:
+    """Starts and keeps track of child processes, see the module docs.
+
+    `limits` caps the number of processes of a group running at once; `spawn`
+    waits for a free slot. Long-running processes should not be in a limited
+    group. `stats` counts the processes `spawned` and the `restarts`.
+    """
+    RESTART_MIN = 1
+    RESTART_MAX = 60
+    RESTART_RESET = 30 # A run this long means the process works, start over with RESTART_MIN.
+    STOP_TIMEOUT = 3
+    limits = {'helper': 4}
+
+    def __init__(self):
+        self._procs = set()
+        self._slots = {}
+        self.stats = dict(spawned=0, restarts=0)
+
+    def _slot(self, group):
+        if group not in self.limits: return None
+        slot = self._slots.get(group)
+        if slot is None:
+            slot = self._slots[group] = asyncio.Semaphore(self.limits[group])
+        return slot
+
+    @asyncio.coroutine
+    def spawn(self, name, argv, restart=False, group=None, on_start=None, on_exit=None, **kwargs):
+        """Start `argv` and return its Process. `name` is for the logs and
+        `usage`. The other keyword arguments are passed on to
+        `asyncio.create_subprocess_exec`; stdin defaults to /dev/null.
+        Raises OSError if the process cannot be started."""
+        kwargs.setdefault('stdin', DEVNULL)
+        process = Process(self, name, argv, restart, group, on_start, on_exit, kwargs)
+        yield from process._exec()
+        self._procs.add(process)
+        self.stats['spawned'] += 1
+        process._task = run_task(process._supervise())
+        return process
+
+    @asyncio.coroutine
+    def run(self, name, argv, input=None, group='helper', **kwargs):
+        """Run a short-lived command to completion, feeding it `input` (bytes).
+        Returns ``(returncode, stdout, stderr)``; stdout is captured unless
+        given otherwise. The command runs in a session of its own and is
+        killed (with everything it started) if the caller is cancelled."""
+        kwargs.setdefault('stdout', PIPE)
+        kwargs.setdefault('start_new_session', True)
+        if input is not None: kwargs['stdin'] = PIPE
+        process = yield from self.spawn(name, argv, group=group, **kwargs)
+        try:
+            out, err = yield from process.proc.communicate(input)
+            yield from process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        return process.returncode, out, err
+
+    @asyncio.coroutine
+    def shutdown(self):
+        """Stop all processes, except the detached ones."""
+        procs = list(self._procs)
+        if not procs: return
+        logger.info('Stopping %d child processes', len(procs))
+        yield from asyncio.gather(*[ process.stop() for process in procs ])
+
+    def usage(self):
+        """A list of ``{name, pid, restarts, uptime, cpu, rss}`` (seconds and
+        bytes) for the running processes."""
+        now = time.monotonic()
+        ret = []
+        for process in sorted(self._procs, key=lambda p: p.name):
+            usage = proc_usage(process.pid) if process.pid else None
+            ret.append({'name': process.name, 'pid': process.pid, 'restarts': process.restarts,
+                        'uptime': now - process.started if process.pid else None,
+                        'cpu': usage and usage[0], 'rss': usage and usage[1]})
+        return ret
+
+supervisor = Supervisor()
@@ -0,0 +1,152 @@
+"""An asyncio client for the wpa_supplicant control interface.
+
+This speaks the same datagram protocol as ``wpa_cli``/``wpa_ctrl.c``: the
+client binds its own UNIX socket, sends text commands to the supplicant's
+socket and gets text replies back. After ``ATTACH``, unsolicited event
+messages (``<level>CTRL-EVENT-...``) arrive on the same socket.
+"""
+
+import os
+import socket
+import string
+import asyncio
+import itertools
+from collections import deque
+
+from .util import *
+
+import logging
+logger = logging.getLogger(__name__)
+
+_counter = itertools.count()
+
+
+class WpaCtrlError(Exception):
+    pass
+
+
+class WpaCtrl:
+    """A connection to one wpa_supplicant control socket. Events are passed to
+    ``on_event(level, text)``."""
+    TIMEOUT = 10
+
+    def __init__(self, path, on_event=None):
+        self.path = str(path)
+        self.on_event = on_event
+        self.sock = None
+        self._local = None
+        self._replies = deque()
+        self.loop = asyncio.get_event_loop()
+
+    def connect(self):
+        """Connect to the socket. Raises OSError if it does not exist (yet)."""
+        self._local = str(RUNDIR / ('wpa_ctrl_%d-%d' % (os.getpid(), next(_counter))))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK
+                             | socket.SOCK_CLOEXEC)
+        try:
+            try: os.unlink(self._local)
+            except FileNotFoundError: pass
+            sock.bind(self._local)
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            self._unlink()
+            raise
+        self.sock = sock
+        self.loop.add_reader(sock.fileno(), self._on_readable)
+
+    @asyncio.coroutine
+    def wait_connect(self, timeout=TIMEOUT, interval=0.1):
+        """Connect, retrying until the supplicant has created its socket."""
+        deadline = self.loop.time() + timeout
+        while True:
+            try:
+                self.connect()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.loop.time() > deadline: raise
+            yield from asyncio.sleep(interval)
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def _on_readable(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error('Error reading from %s: %s', self.path, e)
+                self.close()
+                return
+            msg = data.decode('utf-8', 'replace')
+            if msg.startswith('<') and '>' in msg:
+                level, text = msg[1:].split('>', 1)
+                if self.on_event: self.on_event(int(level), text.strip())
+                continue
+            # Replies come in the order of requests. A reply to a request
+            # that has timed out is consumed by its (cancelled) future.
+            if self._replies:
+                fut = self._replies.popleft()
+                if not fut.done(): fut.set_result(msg)
+            else:
+                logger.warning('Unexpected reply from %s: %r', self.path, msg)
+
+    @asyncio.coroutine
+    def request(self, cmd, timeout=TIMEOUT):
+        """Send a command and return the reply text."""
+        if self.sock is None:
+            raise WpaCtrlError('Not connected to %s' % self.path)
+        fut = asyncio.Future()
+        self._replies.append(fut)
+        self.sock.send(cmd.encode('utf-8'))
+        return (yield from asyncio.wait_for(fut, timeout))
+
+    @asyncio.coroutine
+    def command(self, cmd):
+        """Send a command that is expected to reply ``OK``."""
+        reply = yield from self.request(cmd)
+        if reply.strip() != 'OK':
+            raise WpaCtrlError('%s: %s' % (cmd.split()[0], reply.strip()))
+
+    @asyncio.coroutine
+    def attach(self):
+        yield from self.command('ATTACH')
+
+    def _unlink(self):
+        if self._local:
+            try: os.unlink(self._local)
+            except FileNotFoundError: pass
+            self._local = None
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+        self._unlink()
+        while self._replies:
+            fut = self._replies.popleft()
+            if not fut.done(): fut.cancel()
+
+
+def quote(s):
+    """Quote a string value (e.g. SSID) for SET_NETWORK. Anything that is not
+    printable ASCII is passed as hex, which wpa_supplicant accepts as well."""
+    if all(32 <= ord(c) < 127 and c != '"' for c in s):
+        return '"%s"' % s
+    return s.encode('utf-8').hex()
+
+def quote_psk(psk):
+    """Format a PSK for SET_NETWORK or a network block: a passphrase (8 to 63
+    printable ASCII characters) in double quotes, a 64 hex digit PSK as it is.
+    Raises ValueError for anything else."""
+    if len(psk) == 64 and all(c in string.hexdigits for c in psk):
+        return psk
+    # wpa_supplicant takes everything up to the last double quote, so those
+    # need no escaping.
+    if 8 <= len(psk) <= 63 and all(32 <= ord(c) < 127 for c in psk):
+        return '"%s"' % psk
+    raise ValueError('invalid PSK (not a 8 to 63 character passphrase or 64 hex digits)')
@@ -0,0 +1,108 @@
+"""Tests of the incrementally maintained indexes of InterfaceList.
+
+Run with ``python -m unittest discover tests``. The interface names are made
+up, so none of them is found in /sys and all are WiredInterfaces.
+"""
+
+import asyncio
+import unittest
+
+from networksecretary.libnetconf import InterfaceList
+
+UP = {'UP', 'LOWER_UP'}
+MAC1 = '02:00:00:00:00:01'
+MAC2 = '02:00:00:00:00:02'
+
+
+class InterfaceListTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.lst = InterfaceList()
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def update(self, index, name, mac):
+        self.lst._update(index, name, UP, mac)
+        self.lst._check_consistency()
+
+    def delete(self, index):
+        self.lst._delete(index)
+        self.lst._check_consistency()
+
+    def test_add(self):
+        self.update(2, 'nstest0', MAC1)
+        self.update(3, 'nstest1', MAC2)
+        iface = self.lst._data[2]
+        self.assertIs(self.lst['nstest0'], iface)
+        self.assertIs(self.lst[MAC1], iface)
+        self.assertIs(self.lst[2], iface)
+        self.assertIs(self.lst.nstest0, iface)
+        self.assertEqual({i.name for i in self.lst}, {'nstest0', 'nstest1'})
+        self.assertEqual(len(self.lst.select(wireless=False)), 2)
+
+    def test_delete(self):
+        self.update(2, 'nstest0', MAC1)
+        self.update(3, 'nstest1', MAC2)
+        self.delete(2)
+        self.assertNotIn('nstest0', self.lst)
+        self.assertNotIn(MAC1, self.lst)
+        self.assertNotIn(2, self.lst)
+        self.assertEqual(self.lst.select(wireless=False), [self.lst[3]])
+        self.delete(2)
+        self.delete(3)
+        self.assertEqual(list(self.lst), [])
+
+    def test_rename(self):
+        self.update(2, 'nstest0', MAC1)
+        iface = self.lst[2]
+        self.update(2, 'nslan0', MAC1)
+        self.assertNotIn('nstest0', self.lst)
+        self.assertIs(self.lst['nslan0'], iface)
+        self.assertEqual(iface.name, 'nslan0')
+
+    def test_mac_change(self):
+        self.update(2, 'nstest0', MAC1)
+        iface = self.lst[2]
+        self.update(2, 'nstest0', MAC2)
+        self.assertNotIn(MAC1, self.lst)
+        self.assertIs(self.lst[MAC2], iface)
+
+    def test_shared_mac(self):
+        # Like a bond and its VLAN.
+        self.update(2, 'nsbond0', MAC1)
+        self.update(3, 'nsbond0.10', MAC1)
+        self.assertIs(self.lst[MAC1], self.lst[2])
+        self.delete(2)
+        self.assertIs(self.lst[MAC1], self.lst[3])
+        self.update(3, 'nsbond0.10', MAC2)
+        self.assertNotIn(MAC1, self.lst)
+
+    def test_swapped_names(self):
+        self.update(2, 'nstest0', MAC1)
+        self.update(3, 'nstest1', MAC2)
+        a, b = self.lst[2], self.lst[3]
+        self.update(2, 'nstest1', MAC1)
+        # Both have the name for a moment, the one that had it first wins.
+        self.assertIs(self.lst['nstest1'], b)
+        self.assertNotIn('nstest0', self.lst)
+        self.update(3, 'nstest0', MAC2)
+        self.assertIs(self.lst['nstest0'], b)
+        self.assertIs(self.lst['nstest1'], a)
+
+    def test_select(self):
+        self.update(2, 'nstest0', MAC1)
+        self.update(3, 'nstest1', MAC2)
+        self.lst[2].role = 'inet-client'
+        self.lst._check_consistency()
+        self.assertEqual(self.lst.select(role='inet-client'), [self.lst[2]])
+        self.assertEqual(self.lst.select(role='inet-client', wireless=True), [])
+        self.assertEqual(len(self.lst.select()), 2)
+        with self.assertRaises(TypeError):
+            self.lst.select(name='nstest0')
+
+
+if __name__ == '__main__':
+    unittest.main()